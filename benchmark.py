@@ -0,0 +1,238 @@
+'''
+Benchmarks every computational stage, on representative and stress-size
+constraints, and the cold start of importing the solvers and running main.py.
+
+Examples:
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.25
+'''
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+import numpy as np
+from helper_conversions import Constraints
+from helper_precision import PRESETS
+
+# Constraint sets every stage is timed on
+CASES = {
+    "representative": {},
+    "stress": {
+        "Resistance": 400, "NumberOfLayers": 12, "OuterRadius": 100,
+        "GapBetweenTraces": 0.02,
+    },
+}
+
+
+def stages(constraints: Constraints, output_dir: str) -> dict:
+    '''
+    Returns: Dictionary of stage name to a function running that stage once
+    '''
+    import main
+    import spiral_simple_square as square
+    import spiral_simple_circle as circle
+    import spiral_dynamic_square as dynamic
+    import output_KiCad_square_spiral
+    import output_svg_circle_spiral
+    import helper_magnetics
+
+    c = constraints
+    ohms = c.resistance / c.number_of_layers
+    r = c.outer_radius
+
+    # Representative inputs, taken from the optimal designs
+    square_spiral = square.spiral_of_resistance.uncached(ohms, True, c)
+    circle_spiral = circle.spiral_of_resistance.uncached(ohms, True, c)
+    shape = dynamic.spiral_of_resistance(ohms, True, return_shape=True, constraints=c)
+    square_length, square_spacing = square_spiral[4], square_spiral[3]
+    circle_length, circle_spacing = circle_spiral[4], circle_spiral[3]
+    square_layers = [(square_spacing, int(square_spiral[2]))] * c.number_of_layers
+    segments = helper_magnetics.square_segments(square_layers, c)
+    grid = np.linspace(-1.5 * r, 1.5 * r, 10)
+
+    def kicad_square():
+        output_KiCad_square_spiral.format_layer.cache_clear()
+        width = square_spacing - c.gap_between_traces
+        for layer in range(c.number_of_layers):
+            output_KiCad_square_spiral.get_spiral(
+                square_spacing, int(square_spiral[2]), width, layer, c)
+
+    def dynamic_spiral():
+        # spiral_of_resistance() with its shape, solving without the cache
+        multiplier, _ = dynamic.solve.uncached(ohms, True, dynamic.real_radius_proportional, c)
+        return dynamic.spiral(multiplier, dynamic.real_radius_proportional, True,
+                              return_shape=True, constraints=c)
+
+    def kicad_dynamic():
+        for layer in range(c.number_of_layers):
+            shape.get_KiCad_text(layer, c)
+
+    def svg_circle():
+        output_svg_circle_spiral.save_curve_svg(
+            r, circle_spacing, circle_spiral[2], circle_spacing - c.gap_between_traces,
+            os.path.join(output_dir, "spiral.svg"), c.tolerances.svg_step)
+
+    return {
+        "square.spiral": lambda: square.spiral(square_length, square_spacing, r),
+        "circle.spiral": lambda: circle.spiral(circle_length, circle_spacing, r),
+        "square.max_trace_length": lambda: square.max_trace_length(ohms, True, c),
+        "circle.max_trace_length": lambda: circle.max_trace_length(ohms, True, c),
+        "square.spiral_of_resistance":
+            lambda: square.spiral_of_resistance.uncached(ohms, True, c),
+        "circle.spiral_of_resistance":
+            lambda: circle.spiral_of_resistance.uncached(ohms, True, c),
+        "dynamic.solve":
+            lambda: dynamic.solve.uncached(ohms, True, dynamic.real_radius_proportional, c),
+        "dynamic.spiral_of_resistance_vectorized":
+            lambda: dynamic.spiral_of_resistance_vectorized(
+                np.linspace(0.1, 2, 100) * ohms, True, constraints=c),
+        "dynamic.spiral_of_resistance": dynamic_spiral,
+        "main.optimize_design": lambda: main.optimize_design.uncached(c),
+        "output.kicad_square": kicad_square,
+        "output.kicad_dynamic": kicad_dynamic,
+        "output.svg_circle": svg_circle,
+        "magnetics.magnetic_moment": lambda: helper_magnetics.magnetic_moment(segments),
+        "magnetics.square_inductance": lambda: helper_magnetics.square_inductance(square_layers, c),
+        "magnetics.field_on_grid":
+            lambda: helper_magnetics.field_on_grid(grid, grid, grid, segments),
+    }
+
+
+def time_function(func, repeat: int = 5, min_time: float = 0.2) -> dict:
+    '''
+    Times a function, calling it enough times per measurement
+    to take at least min_time seconds.
+
+    Returns:
+        - Dictionary of the median and minimum seconds per call
+    '''
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time and number < 1_000_000:
+        number *= 4
+    per_call = [t / number for t in timer.repeat(repeat, number)]
+    return {
+        "median_s": statistics.median(per_call),
+        "min_s": min(per_call),
+        "calls": number * repeat,
+    }
+
+
+def startup_commands(output_dir: str, precision: str = None) -> dict:
+    '''
+    Returns: Dictionary of stage name to a command timed from a cold start,
+             in a new Python process every time
+    '''
+    design = [sys.executable, "main.py", "--output", os.path.join(output_dir, "KiCad_spiral.txt")]
+    if precision:
+        design += ["--precision", precision]
+    return {
+        "import.main": [sys.executable, "-c", "import main"],
+        "import.spiral_dynamic_square": [sys.executable, "-c", "import spiral_dynamic_square"],
+        "main.cli": design,
+    }
+
+
+def run_command(command: list):
+    subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def run(name_filter: str = "", repeat: int = 5, min_time: float = 0.2,
+        precision: str = None) -> dict:
+    '''
+    Times every stage on every case, then the cold starts.
+
+    Parameters:
+        name_filter (str): Only run benchmarks whose name contains this
+        repeat (int): Number of measurements per benchmark
+        min_time (float): Minimum seconds per measurement
+        precision (str): Precision preset, instead of the Precision of config.ini
+
+    Returns:
+        - Dictionary of "case/stage" names to timings
+    '''
+    results = {}
+    base = Constraints.from_config()
+    if precision:
+        base = base.replace(precision=precision)
+
+    def time_stage(name, func):
+        if name_filter in name:
+            results[name] = time_function(func, repeat, min_time)
+            print(f"{name:50s} {results[name]['median_s'] * 1e3:10.4f} ms", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for case, changes in CASES.items():
+            constraints = base.replace(**changes)
+            for stage, func in stages(constraints, output_dir).items():
+                time_stage(f"{case}/{stage}", func)
+
+        for stage, command in startup_commands(output_dir, precision).items():
+            time_stage(f"startup/{stage}", lambda: run_command(command))
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    '''
+    Compares timings against a baseline.
+
+    Parameters:
+        results (dict): Timings from run()
+        baseline (dict): Timings from an earlier run()
+        threshold (float): Relative slowdown counted as a regression
+
+    Returns:
+        - List of (name, baseline seconds, new seconds) of regressed benchmarks
+    '''
+    regressions = []
+    for name, timing in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["median_s"]
+        new = timing["median_s"]
+        ratio = new / old
+        flag = "REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{name:50s} {old * 1e3:10.4f} -> {new * 1e3:10.4f} ms ({ratio:5.2f}x) {flag}")
+        if flag:
+            regressions.append((name, old, new))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", help="Save the timings as a JSON baseline")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="Compare against a JSON baseline, exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative slowdown counted as a regression (default 0.25)")
+    parser.add_argument("--filter", default="", help="Only run benchmarks containing this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--precision", choices=list(PRESETS),
+                        help="Solver tolerances, instead of the Precision of config.ini")
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat, args.min_time, args.precision)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "precision": args.precision or Constraints.from_config().precision,
+                "results": results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
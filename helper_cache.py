@@ -0,0 +1,333 @@
+import atexit
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+from collections import OrderedDict
+from helper_conversions import default_constraints
+
+'''
+Memoization of spiral calculations, in memory and optionally on disk.
+
+Results are keyed on the function, its arguments and the values of the
+constraints it depends on. The in-memory cache is a size-bounded LRU.
+The on-disk cache is an SQLite file shared across runs and processes, and is
+enabled with enable_disk_cache() or the MAGNETORQUER_CACHE environment variable.
+'''
+
+# Constraints a single spiral depends on
+# (unlike resistance and number_of_layers, which only matter to the whole design)
+SPIRAL_FIELDS = (
+    "outer_radius", "gap_between_traces", "outer_layer_thickness",
+    "inner_layer_thickness", "copper_resistivity", "trace_thickness_per_oz", "precision",
+)
+
+
+class Cache:
+    '''
+    LRU cache with an optional SQLite backing file, and hit/miss statistics.
+    '''
+
+    def __init__(self, max_size: int = 4096, path=None, max_disk_size: int = 1_000_000,
+                 flush_every: int = 256):
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.flush_every = flush_every
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.path = None
+        self.connection = None
+        self.pid = None
+        self.used = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None:
+            self.open_disk(path)
+
+    def open_disk(self, path):
+        # The file is only opened on first use, so importing this module opens nothing
+        with self.lock:
+            self._close()
+            self.path = os.fspath(path)
+
+    @property
+    def db(self):
+        # SQLite connections must not be shared across fork(), so each process
+        # opens its own, and drops the recency updates it inherited
+        if self.path is None:
+            return None
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB, used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+            self.connection.commit()
+            self.pid = os.getpid()
+            self.used = {}
+        return self.connection
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            db = self.db
+            if db is not None:
+                row = db.execute(
+                    "SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    # Recency is written in batches, rather than a commit per hit
+                    self.used[key] = time.time()
+                    if len(self.used) >= self.flush_every:
+                        self._flush()
+                    self.disk_hits += 1
+                    value = pickle.loads(row[0])
+                    self._remember(key, value)
+                    return value
+
+            self.misses += 1
+            return default
+
+    def put(self, key: str, value):
+        with self.lock:
+            self._remember(key, value)
+            db = self.db
+            if db is not None:
+                self.used.pop(key, None)
+                db.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                    (key, pickle.dumps(value), time.time()))
+                # Evict the least recently used entries beyond the size limit
+                self._flush(commit=False)
+                db.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                    "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_disk_size,))
+                db.commit()
+
+    def _flush(self, commit: bool = True):
+        # Writes the pending recency updates of disk hits
+        if self.used:
+            self.connection.executemany(
+                "UPDATE cache SET used = ? WHERE key = ?",
+                [(used, key) for key, used in self.used.items()])
+            self.used = {}
+            if commit:
+                self.connection.commit()
+
+    def _close(self):
+        if self.connection is not None and self.pid == os.getpid():
+            self._flush()
+            self.connection.close()
+        self.connection = None
+        self.pid = None
+        self.used = {}
+
+    def close(self):
+        '''
+        Writes pending updates and closes this process's connection to the disk cache.
+        It is reopened on the next lookup.
+        '''
+        with self.lock:
+            self._close()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            db = self.db
+            if db is not None:
+                self.used = {}
+                db.execute("DELETE FROM cache")
+                db.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": len(self.memory),
+        }
+
+
+cache = Cache(path=os.environ.get("MAGNETORQUER_CACHE"))
+atexit.register(cache.close)
+
+
+def enable_disk_cache(path, max_size: int = 1_000_000):
+    '''
+    Backs the cache with an SQLite file, so results survive across runs.
+
+    Parameters:
+        path (str): Path of the SQLite file (created if missing)
+        max_size (int): Maximum number of results kept in the file
+    '''
+    cache.max_disk_size = max_size
+    cache.open_disk(path)
+
+
+def _code_key(code) -> str:
+    # Bytecode, names and constants (with nested functions' code) of a function
+    consts = (_code_key(c) if inspect.iscode(c) else repr(c) for c in code.co_consts)
+    return f"{code.co_code.hex()}:{code.co_names}:({','.join(consts)})"
+
+
+def _key_part(value) -> str:
+    # Functions (e.g. trace width laws) are identified by name and a hash of
+    # their code, defaults and closure, so lambdas, closures and edited functions
+    # get their own results. Other callables are identified by their repr,
+    # numbers by their exact float value
+    if callable(value) and hasattr(value, "__qualname__"):
+        name = f"{value.__module__}.{value.__qualname__}"
+        code = getattr(value, "__code__", None)
+        if code is None:
+            return name
+        closure = []
+        for cell in getattr(value, "__closure__", None) or ():
+            try:
+                closure.append(_key_part(cell.cell_contents))
+            except ValueError:
+                closure.append("<empty>")
+        defaults = [_key_part(v) for v in getattr(value, "__defaults__", None) or ()]
+        defaults += [f"{k}={_key_part(v)}" for k, v in (getattr(value, "__kwdefaults__", None) or {}).items()]
+        digest = hashlib.sha256("|".join((_code_key(code), *closure, *defaults)).encode()).hexdigest()[:16]
+        return f"{name}#{digest}"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(float(value))
+    return repr(value)
+
+
+def memoize(fields=None):
+    '''
+    Decorator that caches a function's results in the shared cache.
+    The function must take a `constraints` argument.
+
+    Parameters:
+        fields (tuple): Constraints fields the function depends on (all by default)
+    '''
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            constraints = arguments.pop("constraints") or default_constraints()
+
+            key = "|".join((
+                name,
+                repr(constraints.key(fields)),
+                *(f"{k}={_key_part(v)}" for k, v in arguments.items()),
+            ))
+            result = cache.get(key)
+            if result is None:
+                result = func(*args, **kwargs)
+                cache.put(key, result)
+            return result
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
+
+
+class TestCache(unittest.TestCase):
+
+    def test_functions_as_arguments(self):
+        calls = []
+
+        @memoize(fields=())
+        def apply(x, law, constraints=None):
+            calls.append(x)
+            return law(x)
+
+        def scaled(k):
+            return lambda x: k * x
+
+        cache.clear()
+        self.assertEqual(apply(2, lambda x: x), 2)
+        self.assertEqual(apply(2, lambda x: x * 3), 6)
+        self.assertEqual(apply(2, scaled(4)), 8)
+        self.assertEqual(apply(2, scaled(5)), 10)
+        self.assertEqual(len(calls), 4)
+
+        # The same law again, by another function object, is a hit
+        self.assertEqual(apply(2, scaled(5)), 10)
+        self.assertEqual(apply(2, lambda x: x * 3), 6)
+        self.assertEqual(len(calls), 4)
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            first = Cache(max_size=2, path=path, max_disk_size=3)
+            for i in range(4):
+                first.put(f"key{i}", i)
+            self.assertEqual(len(first.memory), 2)
+            self.assertEqual(first.evictions, 2)
+            first.close()
+
+            # A new run only finds the most recent results on disk
+            second = Cache(path=path)
+            self.assertIsNone(second.get("key0"))
+            self.assertEqual(second.get("key3"), 3)
+            self.assertEqual(second.get("key3"), 3)
+            self.assertEqual((second.hits, second.disk_hits, second.misses), (1, 1, 1))
+            second.close()
+
+    def test_disk_recency(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            first = Cache(max_size=0, path=path, max_disk_size=3, flush_every=2)
+            for i in range(3):
+                first.put(f"key{i}", i)
+
+            # Hits are recorded in batches, and before evicting
+            self.assertEqual(first.get("key0"), 0)
+            self.assertEqual(len(first.used), 1)
+            first.put("key3", 3)
+            self.assertEqual(first.used, {})
+            self.assertEqual(first.get("key0"), 0)
+            self.assertIsNone(first.get("key1"))
+            self.assertEqual(first.get("key2"), 2)
+            self.assertEqual(first.used, {})
+            first.close()
+
+    def test_lazy_connection(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            lazy = Cache(path=path)
+            self.assertIsNone(lazy.connection)
+            self.assertFalse(os.path.exists(path))
+            lazy.put("key", 1)
+            parent = lazy.connection
+            self.assertIsNotNone(parent)
+
+            # A forked process opens a connection of its own
+            with unittest.mock.patch("os.getpid", return_value=os.getpid() + 1):
+                lazy.memory.clear()
+                self.assertEqual(lazy.get("key"), 1)
+                self.assertIsNot(lazy.connection, parent)
+                lazy.close()
+            parent.close()
@@ -1,5 +1,8 @@
+import dataclasses
+from dataclasses import dataclass, field
 from pathlib import Path
 from configparser import ConfigParser
+from helper_precision import Precision, get_precision
 
 '''
 Helper Conversion Functions
@@ -11,67 +14,230 @@ config.read(Path(__file__).with_name('config.ini'))
 config = config['Configuration']
 
 
-def get_ohms_per_mm(trace_width_mm: float, exterior_layer: bool) -> float:
+@dataclass(frozen=True)
+class Constraints:
+    '''
+    Immutable, pre-parsed set of magnetorquer constraints (the values of config.ini),
+    with the derived constants that the calculations need precomputed.
+
+    Every calculation takes one of these as its `constraints` argument.
+    If it's left out, default_constraints() (config.ini) is used.
+    '''
+    resistance: float
+    number_of_layers: int
+    outer_radius: float
+    gap_between_traces: float
+    outer_layer_thickness: float
+    inner_layer_thickness: float
+    copper_resistivity: float
+    trace_thickness_per_oz: float
+    layer_thicknesses: tuple = None
+    precision: str = "standard"
+
+    # Derived constants
+    exterior_thickness_m: float = field(init=False, repr=False, compare=False)
+    interior_thickness_m: float = field(init=False, repr=False, compare=False)
+    exterior_resistivity_ratio: float = field(init=False, repr=False, compare=False)
+    interior_resistivity_ratio: float = field(init=False, repr=False, compare=False)
+    tolerances: Precision = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        m_per_oz = self.trace_thickness_per_oz / 1000
+        derived = {
+            "exterior_thickness_m": self.outer_layer_thickness * m_per_oz,
+            "interior_thickness_m": self.inner_layer_thickness * m_per_oz,
+            "tolerances": get_precision(self.precision),
+        }
+        # Resistivity over thickness: ohms per square of trace
+        derived["exterior_resistivity_ratio"] = (
+            self.copper_resistivity / derived["exterior_thickness_m"])
+        derived["interior_resistivity_ratio"] = (
+            self.copper_resistivity / derived["interior_thickness_m"])
+
+        if self.layer_thicknesses is not None:
+            thicknesses = tuple(float(t) for t in self.layer_thicknesses)
+            if len(thicknesses) != self.number_of_layers:
+                raise ValueError("LayerThicknesses must list one thickness per layer")
+            derived["layer_thicknesses"] = thicknesses
+
+        for name, value in derived.items():
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_config(cls, section=None) -> "Constraints":
+        '''
+        Parses a config.ini section (the shared configuration by default).
+        '''
+        if section is None:
+            section = config
+
+        layer_thicknesses = None
+        if "LayerThicknesses" in section:
+            layer_thicknesses = tuple(
+                float(t) for t in section["LayerThicknesses"].split(","))
+
+        return cls(
+            resistance=section.getfloat("Resistance"),
+            number_of_layers=section.getint("NumberOfLayers"),
+            outer_radius=section.getfloat("OuterRadius"),
+            gap_between_traces=section.getfloat("GapBetweenTraces"),
+            outer_layer_thickness=section.getfloat("OuterLayerThickness"),
+            inner_layer_thickness=section.getfloat("InnerLayerThickness"),
+            copper_resistivity=section.getfloat("CopperResistivity"),
+            trace_thickness_per_oz=section.getfloat("TraceThicknessPerOz"),
+            layer_thicknesses=layer_thicknesses,
+            precision=section.get("Precision", "standard"),
+        )
+
+    # config.ini names of the fields
+    CONFIG_NAMES = {
+        "Resistance": "resistance",
+        "NumberOfLayers": "number_of_layers",
+        "OuterRadius": "outer_radius",
+        "GapBetweenTraces": "gap_between_traces",
+        "OuterLayerThickness": "outer_layer_thickness",
+        "InnerLayerThickness": "inner_layer_thickness",
+        "CopperResistivity": "copper_resistivity",
+        "TraceThicknessPerOz": "trace_thickness_per_oz",
+        "LayerThicknesses": "layer_thicknesses",
+        "Precision": "precision",
+    }
+
+    def replace(self, **changes) -> "Constraints":
+        '''
+        Returns a copy with some values changed. Accepts field names
+        or config.ini names, e.g. replace(Resistance=50, number_of_layers=6)
+        '''
+        changes = {self.CONFIG_NAMES.get(k, k): v for k, v in changes.items()}
+        if "number_of_layers" in changes:
+            changes["number_of_layers"] = int(changes["number_of_layers"])
+        if changes.get("layer_thicknesses") is not None:
+            changes["layer_thicknesses"] = tuple(changes["layer_thicknesses"])
+        return dataclasses.replace(self, **changes)
+
+    def resistivity_ratio(self, exterior: bool) -> float:
+        '''
+        Returns: Copper resistivity over trace thickness (ohms) for the layer type
+        '''
+        if exterior:
+            return self.exterior_resistivity_ratio
+        return self.interior_resistivity_ratio
+
+    def key(self, fields=None) -> tuple:
+        '''
+        Returns: Hashable tuple of the given fields' values (all by default)
+        '''
+        if fields is None:
+            fields = [f.name for f in dataclasses.fields(self) if f.init]
+        return tuple(getattr(self, name) for name in fields)
+
+
+_default_constraints = None
+
+
+def default_constraints() -> Constraints:
+    '''
+    Returns: Constraints parsed from the shared configuration (config.ini)
+    '''
+    global _default_constraints
+    if _default_constraints is None:
+        _default_constraints = Constraints.from_config()
+    return _default_constraints
+
+
+def get_ohms_per_mm(trace_width_mm: float, exterior_layer: bool,
+                    constraints: Constraints = None) -> float:
     '''
     Parameters:
         - Width of PCB trace in mm
         - Boolean whether the trace is on PCB exterior layer
+        - Constraints (config.ini by default)
     Returns: ohms per mm of trace length
     '''
     if trace_width_mm <= 0:
         return float("nan")
 
-    thickness_m = get_trace_thickness(exterior_layer)
-
-    p = config.getfloat("CopperResistivity")
+    constraints = constraints or default_constraints()
 
-    ohms_per_mm = p / (thickness_m * trace_width_mm)
+    ohms_per_mm = constraints.resistivity_ratio(exterior_layer) / trace_width_mm
 
     return ohms_per_mm
 
 
-def get_trace_thickness(exterior_layer: bool) -> float:
+def get_trace_thickness(exterior_layer: bool, constraints: Constraints = None) -> float:
     '''
     Parameters:
         - Boolean whether the trace is on PCB exterior layer
+        - Constraints (config.ini by default)
     Returns: Thickness of trace (in meters)
     '''
+    constraints = constraints or default_constraints()
+
     if exterior_layer:
-        oz_thickness = config.getfloat("OuterLayerThickness")
-    else:
-        oz_thickness = config.getfloat("InnerLayerThickness")
+        return constraints.exterior_thickness_m
+    return constraints.interior_thickness_m
+
 
-    m_per_oz = config.getfloat("TraceThicknessPerOz") / 1000
+def get_layer_thicknesses(constraints: Constraints = None) -> list:
+    '''
+    Parameters:
+        - Constraints (config.ini by default)
+    Returns: Thickness of every copper layer (in oz), from front to back.
+             LayerThicknesses if set, else the outer layers get
+             OuterLayerThickness and the inner layers InnerLayerThickness.
+    '''
+    constraints = constraints or default_constraints()
+
+    if constraints.layer_thicknesses is not None:
+        return list(constraints.layer_thicknesses)
+
+    inner = [constraints.inner_layer_thickness] * (constraints.number_of_layers - 2)
+    outer = constraints.outer_layer_thickness
+    return [outer, *inner, outer]
 
-    thickness_m = oz_thickness * m_per_oz
 
-    return thickness_m
+def exterior_equivalent_ohms(ohms, thickness_oz: float, constraints: Constraints = None):
+    '''
+    Trace width depends on resistance only through resistance * thickness,
+    so a spiral of these ohms on a layer of this thickness has the same
+    geometry as an exterior layer spiral of the returned ohms.
 
+    Parameters:
+        - Resistance of the spiral in ohms
+        - Thickness of the spiral's layer in oz
+        - Constraints (config.ini by default)
+    Returns: Resistance (in ohms) giving the same spiral on an exterior layer
+    '''
+    constraints = constraints or default_constraints()
+    return ohms * thickness_oz / constraints.outer_layer_thickness
 
-def int_ohms_from_ext_ohms(exterior_resistance: float) -> float:
+
+def int_ohms_from_ext_ohms(exterior_resistance: float, constraints: Constraints = None) -> float:
     '''
     Parameters:
         - Resistance per spiral on the exterior layer
+        - Constraints (config.ini by default)
     Returns: Resistance (in ohms) per inner spiral required to meet total resistance config
     '''
+    constraints = constraints or default_constraints()
     return (
-        (config.getfloat("Resistance") - 2 * exterior_resistance) /
-        (config.getint("NumberOfLayers") - 2)
+        (constraints.resistance - 2 * exterior_resistance) /
+        (constraints.number_of_layers - 2)
     )
 
 
-def spacing_from_length(length_mm: float, resistance: float, exterior: bool) -> float:
+def spacing_from_length(length_mm: float, resistance: float, exterior: bool,
+                        constraints: Constraints = None) -> float:
     '''
     Parameters:
         - Length of trace in mm
         - Desired resistance in ohms
         - Boolean whether the trace is on PCB exterior
+        - Constraints (config.ini by default)
     Returns: Total spacing (in mm) between centers of adjacent traces
     '''
-    thickness_m = get_trace_thickness(exterior)
-
-    p = config.getfloat("CopperResistivity")
+    constraints = constraints or default_constraints()
 
-    trace_width_mm = (p * length_mm) / (thickness_m * resistance)
+    trace_width_mm = constraints.resistivity_ratio(exterior) * length_mm / resistance
 
-    return trace_width_mm + config.getfloat("GapBetweenTraces")
+    return trace_width_mm + constraints.gap_between_traces
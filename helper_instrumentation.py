@@ -0,0 +1,259 @@
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+'''
+Opt-in instrumentation of the optimizers: calls, wall time, objective
+evaluations and iterations per stage, exported as a Chrome trace that
+chrome://tracing and ui.perfetto.dev can open.
+
+Instrumentation is off unless enable() is called or the MAGNETORQUER_TRACE
+environment variable is set. While off, instrumented functions only pay
+for one flag check per call.
+'''
+
+enabled = bool(os.environ.get("MAGNETORQUER_TRACE"))
+
+# Trace events beyond this are dropped, but still counted in the stage totals
+MAX_EVENTS = 1_000_000
+
+_events = []
+_totals = {}
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+def enable(on: bool = True):
+    '''
+    Turns instrumentation on or off. Recorded data is kept.
+    '''
+    global enabled
+    enabled = on
+
+
+def reset():
+    '''
+    Forgets every recorded event and stage total
+    '''
+    _events.clear()
+    _totals.clear()
+
+
+class stage:
+    '''
+    Context manager that records the wall time of a stage, along with the
+    evaluations and iterations counted while it's the innermost stage.
+    '''
+
+    def __init__(self, name: str, **args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.evaluations = 0
+        self.iterations = 0
+        self.start = time.perf_counter()
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _local.stack.pop()
+
+        totals = _totals.setdefault(self.name, [0, 0.0, 0, 0])
+        totals[0] += 1
+        totals[1] += end - self.start
+        totals[2] += self.evaluations
+        totals[3] += self.iterations
+
+        if len(_events) < MAX_EVENTS:
+            _events.append({
+                "name": self.name,
+                "cat": self.name.split(".")[0],
+                "ph": "X",
+                "ts": (self.start - _origin) * 1e6,
+                "dur": (end - self.start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {**self.args, "evaluations": self.evaluations,
+                         "iterations": self.iterations},
+            })
+        return False
+
+
+def count(evaluations: int = 0, iterations: int = 0):
+    '''
+    Adds objective evaluations and solver iterations to the innermost stage.
+    Does nothing while instrumentation is off or outside of any stage.
+    '''
+    if not enabled:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].evaluations += int(evaluations)
+        stack[-1].iterations += int(iterations)
+
+
+def instrument(name: str = None):
+    '''
+    Decorator that records every call of a function as a stage.
+
+    Parameters:
+        name (str): Stage name, "module.function" by default
+    '''
+    def decorator(func):
+        stage_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def stats() -> dict:
+    '''
+    Returns: Dictionary of stage name to its calls, seconds, evaluations and iterations
+    '''
+    return {
+        name: dict(zip(("calls", "seconds", "evaluations", "iterations"), totals))
+        for name, totals in _totals.items()
+    }
+
+
+def trace() -> dict:
+    '''
+    Returns: The recorded events in the Chrome trace event format,
+             with a counter event per stage holding its totals
+    '''
+    end = (time.perf_counter() - _origin) * 1e6
+    counters = [
+        {"name": name, "ph": "C", "ts": end, "pid": os.getpid(), "tid": 0,
+         "args": {"evaluations": totals[2], "iterations": totals[3]}}
+        for name, totals in _totals.items()
+    ]
+    return {"traceEvents": _events + counters, "displayTimeUnit": "ms"}
+
+
+def save_trace(path):
+    '''
+    Saves the trace as JSON
+
+    Parameters:
+        path (str or Path): Where to save the trace
+    '''
+    with open(path, "w") as f:
+        json.dump(trace(), f)
+
+
+def summary() -> str:
+    '''
+    Returns: A one-line summary of the totals, with the slowest stages first
+    '''
+    totals = sorted(_totals.items(), key=lambda item: -item[1][1])
+    evaluations = sum(t[2] for _, t in totals)
+    iterations = sum(t[3] for _, t in totals)
+    stages = ", ".join(
+        f"{name} {t[1] * 1e3:.2f} ms/{t[0]:d} calls" for name, t in totals[:4])
+    return f"{evaluations:d} evaluations, {iterations:d} iterations; {stages}"
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        # Tests record into the module's state, and put it back afterwards
+        self.saved = (enabled, list(_events), {k: list(v) for k, v in _totals.items()})
+        reset()
+        enable()
+
+    def tearDown(self):
+        was_enabled, events, totals = self.saved
+        enable(was_enabled)
+        reset()
+        _events.extend(events)
+        _totals.update(totals)
+
+    def test_stage(self):
+        with stage("outer", layers=4) as outer:
+            time.sleep(0.002)
+        with stage("outer"):
+            pass
+        totals = stats()["outer"]
+        self.assertEqual(totals["calls"], 2)
+        self.assertGreaterEqual(totals["seconds"], 0.002)
+        self.assertEqual(len(_events), 2)
+        self.assertEqual(_events[0]["args"], {"layers": 4, "evaluations": 0, "iterations": 0})
+        self.assertGreaterEqual(_events[0]["dur"], 2000)
+        self.assertEqual(outer.name, "outer")
+
+        # Exceptions still close the stage, and aren't swallowed
+        with self.assertRaises(ValueError):
+            with stage("failing"):
+                raise ValueError
+        self.assertEqual(stats()["failing"]["calls"], 1)
+        self.assertEqual(_local.stack, [])
+
+    def test_count(self):
+        with stage("outer"):
+            count(5, 1)
+            with stage("inner"):
+                count(3)
+                count(iterations=2)
+            count(1.0, 1)
+        self.assertEqual((stats()["outer"]["evaluations"], stats()["outer"]["iterations"]), (6, 2))
+        self.assertEqual((stats()["inner"]["evaluations"], stats()["inner"]["iterations"]), (3, 2))
+
+        # Outside of any stage, or while off, counts go nowhere
+        count(100, 100)
+        enable(False)
+        with stage("off"):
+            count(7, 7)
+        self.assertEqual(stats()["off"]["evaluations"], 0)
+        self.assertEqual(stats()["outer"]["evaluations"], 6)
+
+    def test_save_trace(self):
+        @instrument()
+        def leaf():
+            count(2, 1)
+
+        @instrument("root")
+        def root():
+            leaf()
+            leaf()
+
+        root()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.json")
+            save_trace(path)
+            with open(path) as f:
+                saved = json.load(f)
+
+        self.assertEqual(saved["displayTimeUnit"], "ms")
+        spans = [e for e in saved["traceEvents"] if e["ph"] == "X"]
+        counters = [e for e in saved["traceEvents"] if e["ph"] == "C"]
+        name = f"{__name__}.{leaf.__qualname__}"
+        self.assertEqual([e["name"] for e in spans], [name, name, "root"])
+        self.assertEqual({e["name"]: e["args"] for e in counters},
+                         {name: {"evaluations": 4, "iterations": 2},
+                          "root": {"evaluations": 0, "iterations": 0}})
+        for event in spans:
+            self.assertEqual(set(event), {"name", "cat", "ph", "ts", "dur", "pid", "tid", "args"})
+            self.assertEqual(event["pid"], os.getpid())
+
+        # Both leaves lie within the root, one after the other
+        first, second, outer = spans
+        self.assertLessEqual(outer["ts"], first["ts"])
+        self.assertLessEqual(first["ts"] + first["dur"], second["ts"])
+        self.assertLessEqual(second["ts"] + second["dur"], outer["ts"] + outer["dur"])
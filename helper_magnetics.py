@@ -0,0 +1,656 @@
+import math
+import os
+import unittest
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from helper_conversions import Constraints, default_constraints, get_layer_thicknesses
+from helper_instrumentation import instrument, count
+
+'''
+Magnetic field and moment of the traces the KiCad writers emit, from the
+Biot-Savart law for straight segments of current.
+
+Segments are (segments, 2, 3) arrays of start and end points (in mm),
+ordered along the current. They're in a right-handed frame centered on
+the spiral: x to the right and y up as seen from the front of the board,
+and z out of the front. The copper layers are evenly spaced through the
+board thickness, front layer on top.
+
+The layers are connected in series by vias, alternately at the center and
+at the outside. Current runs along the written segments on even layers,
+and back along them on odd layers, whose spirals are mirrored. That way it
+turns the same way on every layer. Vias aren't included.
+
+Inductance is the sum of the partial inductances of every pair of segments
+(Neumann's formula), with Grover's closed form for parallel segments and
+each trace's own cross-section for its self-inductance.
+'''
+
+# mu_0 / (4 pi) in T*m/A
+MU_0_OVER_4PI = 1e-7
+
+# Field of 1 A over distances in mm (1/mm), in tesla
+TESLA_PER_AMP_MM = MU_0_OVER_4PI * 1e3
+
+# Default board thickness (in mm)
+BOARD_THICKNESS = 1.6
+
+# mu_0 / (4 pi) times distances in mm, in henries
+HENRY_PER_MM = MU_0_OVER_4PI * 1e-3
+
+# Geometric mean distance of a rectangle from itself, over its width plus thickness (Grover)
+RECTANGLE_GMD = 0.2235
+
+# Gauss-Legendre points on [0, 1] for segments that are neither parallel nor perpendicular
+_NODES, _WEIGHTS = (x / 2 for x in np.polynomial.legendre.leggauss(8))
+_NODES += 0.5
+
+
+def layer_heights(constraints: Constraints = None, board_thickness: float = BOARD_THICKNESS):
+    '''
+    Returns: z (in mm) of every copper layer, front to back
+    '''
+    constraints = constraints or default_constraints()
+    return np.linspace(board_thickness / 2, -board_thickness / 2, constraints.number_of_layers)
+
+
+def board_segments(xy, layer, center, constraints: Constraints = None,
+                   board_thickness: float = BOARD_THICKNESS):
+    '''
+    Converts segments in KiCad's coordinates to the frame of this module,
+    ordered along the current.
+
+    Parameters:
+        xy (array): (segments, 4) array of x1, y1, x2, y2 in KiCad's coordinates (in mm)
+        layer (array): The layer of every segment
+        center (tuple): KiCad coordinates of the spiral's center (in mm)
+        constraints (Constraints): config.ini by default
+        board_thickness (float): Distance (in mm) from the front to the back layer
+
+    Returns:
+        - (segments, 2, 3) array of start and end points (in mm)
+    '''
+    xy = np.asarray(xy, dtype=float)
+    layer = np.asarray(layer)
+    z = layer_heights(constraints, board_thickness)[layer]
+
+    # KiCad's y points down
+    start = np.stack([xy[:, 0] - center[0], center[1] - xy[:, 1], z], axis=-1)
+    end = np.stack([xy[:, 2] - center[0], center[1] - xy[:, 3], z], axis=-1)
+
+    odd = layer % 2 == 1
+    segments = np.stack([start, end], axis=1)
+    segments[odd] = segments[odd][:, ::-1]
+    return segments
+
+
+def square_segments(layers, constraints: Constraints = None,
+                    board_thickness: float = BOARD_THICKNESS):
+    '''
+    Returns: The segments of the square magnetorquer that
+             output_KiCad_square_spiral.write_layers() writes
+
+    Parameters:
+        layers: A (spacing in mm, number of coils) pair per layer, front to back
+    '''
+    import output_KiCad_square_spiral
+
+    constraints = constraints or default_constraints()
+    xy, layer = output_KiCad_square_spiral.get_segments(layers, constraints)
+    center = (constraints.outer_radius + 20,) * 2
+    return board_segments(xy, layer, center, constraints, board_thickness)
+
+
+def shape_segments(shape, constraints: Constraints = None,
+                   board_thickness: float = BOARD_THICKNESS):
+    '''
+    Returns: The segments of the magnetorquer that SpiralShape.get_KiCad_text()
+             writes for every layer
+    '''
+    constraints = constraints or default_constraints()
+    even, odd = shape.segments()[:, :4], shape.flip().segments()[:, :4]
+    xy, layer = [], []
+    for i in range(constraints.number_of_layers):
+        xy.append(odd if i % 2 else even)
+        layer.append(np.full(len(xy[-1]), i))
+    center = (constraints.outer_radius,) * 2
+    return board_segments(np.concatenate(xy), np.concatenate(layer), center,
+                          constraints, board_thickness)
+
+
+def magnetic_moment(segments, current: float = 1.0):
+    '''
+    Magnetic moment of the segments, m = I/2 * sum of r x dl, about the center.
+    For straight segments the integral is exact.
+
+    Parameters:
+        segments (array): (segments, 2, 3) array of start and end points (in mm)
+        current (float): Current (in A)
+
+    Returns:
+        - Moment vector (in A*m^2)
+    '''
+    start, end = segments[:, 0], segments[:, 1]
+    return 0.5 * current * np.cross(start, end - start).sum(axis=0) * 1e-6
+
+
+@instrument()
+def field_at_points(points, segments, current: float = 1.0, chunk_size: int = 1 << 16):
+    '''
+    Magnetic field at any points, summing the exact field of every finite
+    straight segment. The work is split into blocks of about chunk_size
+    (point, segment) pairs to bound memory.
+    Points on the line of a segment get no field from that segment.
+
+    Parameters:
+        points (array): (points, 3) array of positions (in mm)
+        segments (array): (segments, 2, 3) array of start and end points (in mm)
+        current (float): Current (in A)
+        chunk_size (int): Number of (point, segment) pairs per block
+
+    Returns:
+        - (points, 3) array of the field (in T)
+    '''
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    field = np.zeros_like(points)
+    if len(segments) == 0:
+        return field
+
+    segment_chunk = min(len(segments), chunk_size)
+    point_chunk = max(1, chunk_size // segment_chunk)
+    for s in range(0, len(segments), segment_chunk):
+        a, b = segments[s:s + segment_chunk, 0], segments[s:s + segment_chunk, 1]
+        for p in range(0, len(points), point_chunk):
+            # Field of a segment from a to b, with r1 = a - p and r2 = b - p:
+            # (r1 x r2) (|r1| + |r2|) / (|r1| |r2| (|r1| |r2| + r1 . r2))
+            r1 = a - points[p:p + point_chunk, np.newaxis]
+            r2 = b - points[p:p + point_chunk, np.newaxis]
+            n1 = np.sqrt(np.einsum("psk,psk->ps", r1, r1))
+            n2 = np.sqrt(np.einsum("psk,psk->ps", r2, r2))
+            denominator = n1 * n2 * (n1 * n2 + np.einsum("psk,psk->ps", r1, r2))
+            on_line = denominator <= 1e-12 * (n1 * n2) ** 2
+            factor = np.where(on_line, 0, (n1 + n2) / np.where(on_line, 1, denominator))
+            field[p:p + point_chunk] += np.einsum("psk,ps->pk", np.cross(r1, r2), factor)
+
+    count(evaluations=len(points) * len(segments))
+    return field * TESLA_PER_AMP_MM * current
+
+
+def _aligned_field(u, v, z, start, end, line_v, line_z, chunk_size):
+    '''
+    Field of segments along the u axis of a grid, each on the line of constant
+    v and z, as sums of G * dz and -G * dv where
+    G = (a1 / |r2| - a0 / |r1|) / rho^2, a = segment end u - point u
+    and rho is the distance from the line. Segments along x give (B_y, B_z).
+
+    Along a grid row of constant v and z, rho doesn't depend on u,
+    and a doesn't depend on the row, so both are computed once.
+
+    Returns:
+        - (2, z, v, u) array of the sums (in 1/mm)
+    '''
+    rows_z = np.repeat(z, len(v))
+    rows_v = np.tile(v, len(z))
+    sums = np.zeros((2, len(rows_z), len(u)))
+
+    segment_chunk = max(1, min(len(start), chunk_size // len(u)))
+    row_chunk = max(1, chunk_size // (len(u) * segment_chunk))
+    for s in range(0, len(start), segment_chunk):
+        chunk = slice(s, s + segment_chunk)
+        a0 = start[chunk] - u[:, np.newaxis]
+        a1 = end[chunk] - u[:, np.newaxis]
+        a0_squared, a1_squared = a0**2, a1**2
+        # Sums of G * line_z, G * line_v and G, by matrix products
+        weights = np.stack([line_z[chunk], line_v[chunk], np.ones_like(line_z[chunk])], axis=-1)
+
+        for r in range(0, len(rows_z), row_chunk):
+            rz, rv = rows_z[r:r + row_chunk], rows_v[r:r + row_chunk]
+            rho_squared = (line_v[chunk] - rv[:, np.newaxis])**2 + (line_z[chunk] - rz[:, np.newaxis])**2
+            on_line = rho_squared < 1e-18
+            rho_squared[on_line] = 1
+            inverse = np.where(on_line, 0, 1 / rho_squared)[:, np.newaxis]
+            rho_squared = rho_squared[:, np.newaxis]
+
+            g = np.add(a1_squared, rho_squared)
+            np.sqrt(g, out=g)
+            np.divide(a1, g, out=g)
+            g0 = np.add(a0_squared, rho_squared)
+            np.sqrt(g0, out=g0)
+            np.divide(a0, g0, out=g0)
+            g -= g0
+            g *= inverse
+
+            by_row = g @ weights
+            sums[0, r:r + row_chunk] += by_row[..., 0] - rz[:, np.newaxis] * by_row[..., 2]
+            sums[1, r:r + row_chunk] -= by_row[..., 1] - rv[:, np.newaxis] * by_row[..., 2]
+
+    return sums.reshape(2, len(z), len(v), len(u))
+
+
+def _axis_groups(segments):
+    # Masks of the segments along x, along y, and any others that aren't points
+    d = segments[:, 1] - segments[:, 0]
+    along_x = (d[:, 1] == 0) & (d[:, 2] == 0) & (d[:, 0] != 0)
+    along_y = (d[:, 0] == 0) & (d[:, 2] == 0) & (d[:, 1] != 0)
+    other = ~along_x & ~along_y & np.any(d != 0, axis=1)
+    return along_x, along_y, other
+
+
+def _grid_slab(x, y, z, segments, chunk_size):
+    # Field of 1 A (in 1/mm) on the grid planes z, at module level so it can be pickled
+    along_x, along_y, other = _axis_groups(segments)
+
+    field = np.zeros((len(z), len(y), len(x), 3))
+
+    if np.any(along_x):
+        s = segments[along_x]
+        by, bz = _aligned_field(x, y, z, s[:, 0, 0], s[:, 1, 0], s[:, 0, 1], s[:, 0, 2], chunk_size)
+        field[..., 1] += by
+        field[..., 2] += bz
+
+    if np.any(along_y):
+        # Mirrored roles of x and y flip the handedness
+        s = segments[along_y]
+        bx, bz = _aligned_field(y, x, z, s[:, 0, 1], s[:, 1, 1], s[:, 0, 0], s[:, 0, 2], chunk_size)
+        field[..., 0] -= bx.transpose(0, 2, 1)
+        field[..., 2] -= bz.transpose(0, 2, 1)
+
+    if np.any(other):
+        points = np.stack(np.meshgrid(x, y, z, indexing="xy"), axis=-1).transpose(2, 0, 1, 3)
+        field += field_at_points(points, segments[other], 1 / TESLA_PER_AMP_MM,
+                                 chunk_size).reshape(field.shape)
+
+    return field
+
+
+@instrument()
+def field_on_grid(x, y, z, segments, current: float = 1.0, workers: int = 1,
+                  chunk_size: int = 1 << 16):
+    '''
+    Magnetic field on a regular grid of points.
+
+    Segments along x or y (all of a square spiral's) use the grid's
+    structure and take a few array operations per (point, segment) pair;
+    any others use field_at_points(). The work is split into blocks of
+    about chunk_size pairs, and the grid's z planes are split across
+    worker processes.
+
+    Parameters:
+        x, y, z (array): Coordinates (in mm) of the grid lines
+        segments (array): (segments, 2, 3) array of start and end points (in mm)
+        current (float): Current (in A)
+        workers (int): Number of processes, -1 for every CPU core
+        chunk_size (int): Number of (point, segment) pairs per block
+
+    Returns:
+        - (z, y, x, 3) array of the field (in T)
+    '''
+    x, y, z = (np.atleast_1d(np.asarray(c, dtype=float)) for c in (x, y, z))
+    segments = np.asarray(segments, dtype=float)
+
+    if workers == 1 or len(z) == 1:
+        field = _grid_slab(x, y, z, segments, chunk_size)
+    else:
+        workers = os.cpu_count() if workers == -1 else workers
+        slabs = np.array_split(z, min(workers, len(z)))
+        with ProcessPoolExecutor(workers) as executor:
+            field = np.concatenate(list(executor.map(
+                _grid_slab, *zip(*[(x, y, slab, segments, chunk_size) for slab in slabs]))))
+
+    count(evaluations=x.size * y.size * z.size * len(segments))
+    return field * TESLA_PER_AMP_MM * current
+
+
+def trace_gmd(width, thickness):
+    '''
+    Returns: Geometric mean distance (in mm) of a trace's rectangular
+             cross-section from itself, given its width and thickness (in mm)
+    '''
+    return RECTANGLE_GMD * (np.asarray(width, dtype=float) + np.asarray(thickness, dtype=float))
+
+
+def _grover(t, d):
+    # Double integral of 1 / sqrt(t^2 + d^2) over t, t asinh(t/d) - sqrt(t^2 + d^2)
+    q = np.sqrt(t * t + d * d)
+    t = np.abs(t)
+    return t * np.log((t + q) / d) - q
+
+
+def _block_inductance(a, gmd_a, b, gmd_b, far_field):
+    '''
+    Sum of the partial inductances of every segment of a with every segment
+    of b (in mm, times mu_0 / 4 pi), by one of three formulas per pair:
+
+    - Farther than far_field lengths apart, the Neumann integrand at the
+      midpoints, dl_a . dl_b / R
+    - Parallel, Grover's closed form, with the distance between the lines
+      at least the geometric mean of their GMDs, so a segment's inductance
+      with itself is its self-inductance
+    - Otherwise, Gauss-Legendre quadrature along a of the exact integral along b
+
+    Perpendicular pairs have none.
+    '''
+    da, db = a[:, 1] - a[:, 0], b[:, 1] - b[:, 0]
+    la, lb = np.linalg.norm(da, axis=1), np.linalg.norm(db, axis=1)
+    dot = da @ db.T
+    lengths = la[:, np.newaxis] * lb
+
+    ca, cb = (a[:, 0] + a[:, 1]) / 2, (b[:, 0] + b[:, 1]) / 2
+    r_squared = np.einsum("ik,ik->i", ca, ca)[:, np.newaxis] + np.einsum("jk,jk->j", cb, cb) - 2 * ca @ cb.T
+    longest = np.maximum(la[:, np.newaxis], lb)
+
+    coupled = np.abs(dot) > 1e-9 * lengths
+    far = coupled & (r_squared > (far_field * longest)**2)
+    total = np.sum(dot[far] / np.sqrt(r_squared[far]))
+
+    near = coupled & ~far
+    parallel = near & (np.abs(dot) >= (1 - 1e-12) * lengths)
+
+    i, j = np.nonzero(parallel)
+    if len(i):
+        # Coordinates along a's line, from a's start
+        u = da[i] / la[i, np.newaxis]
+        w0, w1 = b[j, 0] - a[i, 0], b[j, 1] - a[i, 0]
+        s, e = np.einsum("pk,pk->p", w0, u), np.einsum("pk,pk->p", w1, u)
+        d = np.linalg.norm(w0 - s[:, np.newaxis] * u, axis=1)
+        d = np.maximum(d, np.sqrt(gmd_a[i] * gmd_b[j]))
+        total += np.sum(_grover(la[i] - s, d) - _grover(-s, d) - _grover(la[i] - e, d) + _grover(-e, d))
+
+    i, j = np.nonzero(near & ~parallel)
+    if len(i):
+        points = a[i, 0, np.newaxis] + _NODES[:, np.newaxis] * da[i, np.newaxis]
+        r1 = np.linalg.norm(points - b[j, 0, np.newaxis], axis=-1)
+        r2 = np.linalg.norm(points - b[j, 1, np.newaxis], axis=-1)
+        l = lb[j, np.newaxis]
+        integral = np.log((r1 + r2 + l) / np.maximum(r1 + r2 - l, 1e-12 * l)) @ _WEIGHTS
+        total += np.sum(dot[i, j] / lb[j] * integral)
+
+    return total
+
+
+def _aligned_inductance(a, gmd_a, b, gmd_b, far_field):
+    '''
+    _block_inductance() of segments that are all along x, with every pair
+    parallel, without finding the pairs' formulas one by one.
+    '''
+    a0, a1 = a[:, 0, 0, np.newaxis], a[:, 1, 0, np.newaxis]
+    b0, b1 = b[:, 0, 0], b[:, 1, 0]
+    d = np.hypot(a[:, 0, 1, np.newaxis] - b[:, 0, 1], a[:, 0, 2, np.newaxis] - b[:, 0, 2])
+    d = np.maximum(d, np.sqrt(gmd_a[:, np.newaxis] * gmd_b))
+
+    total = 0
+    r_squared = ((a0 + a1) / 2 - (b0 + b1) / 2)**2 + d**2
+    far = r_squared > (far_field * np.maximum(np.abs(a1 - a0), np.abs(b1 - b0)))**2
+    if np.any(far):
+        total += np.sum(((a1 - a0) * (b1 - b0))[far] / np.sqrt(r_squared[far]))
+        near = ~far
+        a0, a1, b0, b1, d = (np.broadcast_to(x, far.shape)[near] for x in (a0, a1, b0, b1, d))
+
+    return total + np.sum(_grover(a1 - b0, d) - _grover(a0 - b0, d)
+                          - _grover(a1 - b1, d) + _grover(a0 - b1, d))
+
+
+def _sum_blocks(function, a, gmd_a, b, gmd_b, far_field, chunk_size, symmetric):
+    # Sum over blocks of about chunk_size pairs; if b is a, only blocks on and above the diagonal
+    step = max(1, math.isqrt(chunk_size))
+    total = 0
+    for s in range(0, len(a), step):
+        for t in range(s if symmetric else 0, len(b), step):
+            block = function(a[s:s + step], gmd_a[s:s + step], b[t:t + step], gmd_b[t:t + step], far_field)
+            total += 2 * block if symmetric and t != s else block
+    return total
+
+
+def _inductance(a, gmd_a, b, gmd_b, far_field, chunk_size, symmetric):
+    # Pairs along x, pairs along y and pairs with any other segment, in H
+    gmd_a = np.broadcast_to(np.asarray(gmd_a, dtype=float), len(a))
+    gmd_b = np.broadcast_to(np.asarray(gmd_b, dtype=float), len(b))
+    x_a, y_a, other_a = _axis_groups(a)
+    x_b, y_b, other_b = _axis_groups(b)
+    swap = [1, 0, 2]
+
+    total = _sum_blocks(_aligned_inductance, a[x_a], gmd_a[x_a], b[x_b], gmd_b[x_b],
+                        far_field, chunk_size, symmetric)
+    total += _sum_blocks(_aligned_inductance, a[y_a][..., swap], gmd_a[y_a], b[y_b][..., swap],
+                         gmd_b[y_b], far_field, chunk_size, symmetric)
+    if symmetric:
+        total += 2 * _sum_blocks(_block_inductance, a[other_a], gmd_a[other_a], b[~other_b],
+                                 gmd_b[~other_b], far_field, chunk_size, False)
+        total += _sum_blocks(_block_inductance, a[other_a], gmd_a[other_a], b[other_b],
+                             gmd_b[other_b], far_field, chunk_size, True)
+    else:
+        total += _sum_blocks(_block_inductance, a[other_a], gmd_a[other_a], b, gmd_b,
+                             far_field, chunk_size, False)
+        total += _sum_blocks(_block_inductance, a[~other_a], gmd_a[~other_a], b[other_b],
+                             gmd_b[other_b], far_field, chunk_size, False)
+
+    count(evaluations=len(a) * len(b))
+    return float(total * HENRY_PER_MM)
+
+
+@instrument()
+def mutual_inductance(segments_a, segments_b, gmd_a, gmd_b, far_field: float = None,
+                      chunk_size: int = 1 << 16) -> float:
+    '''
+    Mutual inductance of two paths of segments, each carrying the current
+    in the order of its segments.
+
+    Parameters:
+        segments_a, segments_b (array): (segments, 2, 3) arrays of start and end points (in mm)
+        gmd_a, gmd_b: Geometric mean distance (in mm) of each path's cross-section, one or per segment
+        far_field (float): Distance, in lengths of the longer segment, beyond which
+                           pairs use their midpoints (the default precision's by default)
+        chunk_size (int): Number of segment pairs per block
+
+    Returns:
+        - Mutual inductance (in H)
+    '''
+    far_field = far_field or default_constraints().tolerances.far_field
+    return _inductance(np.asarray(segments_a, dtype=float), gmd_a,
+                       np.asarray(segments_b, dtype=float), gmd_b, far_field, chunk_size, False)
+
+
+@instrument()
+def inductance(segments, gmd, far_field: float = None, chunk_size: int = 1 << 16) -> float:
+    '''
+    Self-inductance of one path of segments, as mutual_inductance() of the
+    path with itself. Each pair of blocks is calculated once.
+
+    Parameters:
+        segments (array): (segments, 2, 3) array of start and end points (in mm)
+        gmd: Geometric mean distance (in mm) of the cross-section, one or per segment
+        far_field, chunk_size: As for mutual_inductance()
+
+    Returns:
+        - Inductance (in H)
+    '''
+    far_field = far_field or default_constraints().tolerances.far_field
+    segments = np.asarray(segments, dtype=float)
+    return _inductance(segments, gmd, segments, gmd, far_field, chunk_size, True)
+
+
+def _layered_inductance(layers, keys, heights, far_field, chunk_size):
+    '''
+    Inductance of layers in series, from the inductance of each layer with
+    itself and with every other layer.
+
+    Odd layers are the even layers' spirals mirrored with the current reversed,
+    and mirroring both layers of a pair or swapping them keeps their
+    inductance. So pairs of layers with the same keys, parities and
+    distance apart have the same inductance, which is only calculated once.
+
+    Parameters:
+        layers: (segments, gmd) of every layer, front to back
+        keys: Hashable description of every layer's spiral and cross-section
+        heights: z (in mm) of every layer
+    '''
+    blocks = {}
+    total = 0
+    for i, (a, gmd_a) in enumerate(layers):
+        for j, (b, gmd_b) in enumerate(layers[i:], i):
+            if len(a) == 0 or len(b) == 0:
+                continue
+            key = (*sorted([keys[i], keys[j]]), i % 2 != j % 2, round(abs(heights[i] - heights[j]), 9))
+            if key not in blocks:
+                blocks[key] = _inductance(a, gmd_a, b, gmd_b, far_field, chunk_size, i == j)
+            total += blocks[key] if i == j else 2 * blocks[key]
+    return total
+
+
+def layer_trace_thicknesses(constraints: Constraints = None):
+    '''
+    Returns: Copper thickness (in mm) of every layer, front to back
+    '''
+    constraints = constraints or default_constraints()
+    return np.array(get_layer_thicknesses(constraints)) * constraints.trace_thickness_per_oz
+
+
+@instrument()
+def square_inductance(layers, constraints: Constraints = None,
+                      board_thickness: float = BOARD_THICKNESS,
+                      far_field: float = None, chunk_size: int = 1 << 16) -> float:
+    '''
+    Inductance of the square magnetorquer that
+    output_KiCad_square_spiral.write_layers() writes, with its layers in series.
+
+    Parameters:
+        layers: A (spacing in mm, number of coils) pair per layer, front to back
+        constraints (Constraints): config.ini by default
+        board_thickness (float): Distance (in mm) from the front to the back layer
+        far_field (float): As for mutual_inductance(), the constraints' precision's by default
+        chunk_size (int): Number of segment pairs per block
+
+    Returns:
+        - Inductance (in H)
+    '''
+    import output_KiCad_square_spiral
+
+    constraints = constraints or default_constraints()
+    far_field = far_field or constraints.tolerances.far_field
+    xy, layer = output_KiCad_square_spiral.get_segments(layers, constraints)
+    center = (constraints.outer_radius + 20,) * 2
+    segments = board_segments(xy, layer, center, constraints, board_thickness)
+    thicknesses = layer_trace_thicknesses(constraints)
+
+    per_layer, keys = [], []
+    for i, (spacing, coils) in enumerate(layers):
+        gmd = float(trace_gmd(spacing - constraints.gap_between_traces, thicknesses[i]))
+        per_layer.append((segments[layer == i], gmd))
+        keys.append((float(spacing), int(coils), gmd))
+    return _layered_inductance(per_layer, keys, layer_heights(constraints, board_thickness),
+                               far_field, chunk_size)
+
+
+@instrument()
+def shape_inductance(shape, constraints: Constraints = None,
+                     board_thickness: float = BOARD_THICKNESS,
+                     far_field: float = None, chunk_size: int = 1 << 16) -> float:
+    '''
+    Inductance of the magnetorquer that SpiralShape.get_KiCad_text() writes
+    for every layer, with its layers in series.
+
+    Parameters:
+        shape (SpiralShape): The spiral of every layer
+        constraints, board_thickness, far_field, chunk_size: As for square_inductance()
+
+    Returns:
+        - Inductance (in H)
+    '''
+    constraints = constraints or default_constraints()
+    far_field = far_field or constraints.tolerances.far_field
+    center = (constraints.outer_radius,) * 2
+    even, odd = shape.segments(), shape.flip().segments()
+    thicknesses = layer_trace_thicknesses(constraints)
+
+    per_layer, keys = [], []
+    for i in range(constraints.number_of_layers):
+        xy = odd if i % 2 else even
+        segments = board_segments(xy[:, :4], np.full(len(xy), i), center, constraints, board_thickness)
+        per_layer.append((segments, trace_gmd(xy[:, 4], thicknesses[i])))
+        keys.append(float(thicknesses[i]))
+    return _layered_inductance(per_layer, keys, layer_heights(constraints, board_thickness),
+                               far_field, chunk_size)
+
+
+class TestMagnetics(unittest.TestCase):
+
+    # Square loop of side 2 in the z = 0 plane, counterclockwise
+    loop = np.array([
+        [[-1, -1, 0], [1, -1, 0]], [[1, -1, 0], [1, 1, 0]],
+        [[1, 1, 0], [-1, 1, 0]], [[-1, 1, 0], [-1, -1, 0]],
+    ], dtype=float)
+
+    def test_square_loop(self):
+        # Center field 2 sqrt(2) mu_0 I / (pi L), with L = 2 mm
+        expected = 2 * math.sqrt(2) * 4e-7 * math.pi / (math.pi * 2e-3)
+        np.testing.assert_allclose(field_at_points([[0, 0, 0]], self.loop)[0], [0, 0, expected])
+        np.testing.assert_allclose(magnetic_moment(self.loop), [0, 0, 4e-6])
+
+    def test_grid_matches_points(self):
+        rng = np.random.default_rng(0)
+        skewed = rng.uniform(-2, 2, (5, 2, 3))
+        segments = np.concatenate([self.loop, self.loop[::-1, ::-1] * 0.5 + [0, 0, 0.3], skewed])
+        x, y, z = np.linspace(-3, 3, 7), np.linspace(-2.5, 2.5, 6), np.array([-0.7, 0.45])
+
+        grid = field_on_grid(x, y, z, segments, current=2, chunk_size=50)
+        points = np.stack(np.meshgrid(x, y, z, indexing="xy"), axis=-1).transpose(2, 0, 1, 3)
+        expected = field_at_points(points, segments, current=2).reshape(grid.shape)
+        np.testing.assert_allclose(grid, expected, rtol=1e-9, atol=1e-15)
+
+    def test_board_moment_is_area_sum(self):
+        # Every layer turns the same way, so the moment per amp is about the area-sum
+        c = default_constraints()
+        layers = [(0.5, 30), (0.4, 40), (0.4, 40), (0.5, 30)]
+        segments = square_segments(layers, c)
+        area_sum = 0
+        for spacing, coils in layers:
+            r = c.outer_radius - spacing * np.arange(coils)
+            area_sum += np.sum(4 * r**2) * 1e-6
+
+        # The front spiral turns clockwise, so the moment points into the board
+        moment = magnetic_moment(segments)
+        self.assertAlmostEqual(-moment[2] / area_sum, 1, places=2)
+        self.assertLess(np.hypot(*moment[:2]), -1e-3 * moment[2])
+
+    def test_square_loop_inductance(self):
+        # Grover: 2 mu_0 a / pi (ln(a / r) - 0.524) for side a and wire radius r,
+        # whose cross-section has a GMD of r e^(-1/4)
+        loop, radius = self.loop * 5, 0.1
+        expected = 8e-7 * 1e-2 * (math.log(10 / radius) - 0.524)
+        self.assertAlmostEqual(inductance(loop, radius * math.exp(-0.25)) / expected, 1, places=2)
+        self.assertAlmostEqual(mutual_inductance(loop, loop, 0.1, 0.1), inductance(loop, 0.1), places=20)
+
+    def test_oblique_mutual_inductance(self):
+        # Neumann's double integral by the midpoint rule
+        a = np.array([[[0, 0, 0], [2, 0.3, 0.1]]])
+        b = np.array([[[0.5, 1, 0.8], [-0.4, 2.2, 1.5]]])
+        t = (np.arange(1000) + 0.5) / 1000
+        pa = a[0, 0] + t[:, np.newaxis] * (a[0, 1] - a[0, 0])
+        pb = b[0, 0] + t[:, np.newaxis] * (b[0, 1] - b[0, 0])
+        r = np.linalg.norm(pa[:, np.newaxis] - pb, axis=-1)
+        expected = np.dot(a[0, 1] - a[0, 0], b[0, 1] - b[0, 0]) * np.mean(1 / r) * HENRY_PER_MM
+        self.assertAlmostEqual(mutual_inductance(a, b, 0.01, 0.01, far_field=math.inf) / expected, 1, places=6)
+
+    def test_layers_match_every_pair(self):
+        import output_KiCad_square_spiral
+        from spiral_dynamic_square import get_shape
+
+        c = default_constraints().replace(number_of_layers=6)
+        layers = [(0.5, 30), (0.4, 40), (0.4, 40), (0.4, 40), (0.4, 40), (0.5, 30)]
+        _, layer = output_KiCad_square_spiral.get_segments(layers, c)
+        widths = np.array([spacing for spacing, _ in layers])[layer] - c.gap_between_traces
+        gmd = trace_gmd(widths, layer_trace_thicknesses(c)[layer])
+        expected = inductance(square_segments(layers, c), gmd, far_field=math.inf)
+        self.assertAlmostEqual(square_inductance(layers, c, far_field=math.inf) / expected, 1, places=12)
+        self.assertAlmostEqual(square_inductance(layers, c.replace(precision="draft")) / expected, 1, places=3)
+
+        r = 30 - np.arange(12.0)
+        shape = get_shape(np.stack([r + 1, r, r - 1, 0.4 + 0.02 * r], axis=-1), 30)
+        xy = shape.segments()
+        gmd = trace_gmd(np.tile(xy[:, 4], 6), np.repeat(layer_trace_thicknesses(c), len(xy)))
+        expected = inductance(shape_segments(shape, c), gmd, far_field=math.inf)
+        self.assertAlmostEqual(shape_inductance(shape, c, far_field=math.inf) / expected, 1, places=12)
+
+
+if __name__ == "__main__":
+    unittest.main()
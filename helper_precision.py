@@ -0,0 +1,75 @@
+import math
+from dataclasses import dataclass
+
+'''
+Named sets of solver tolerances, so every solver trades accuracy for speed
+together. Constraints carry the name of their preset (the Precision value of
+config.ini, "standard" by default) and every solver reads its tolerance from
+constraints.tolerances.
+
+    draft     Exploratory sweeps: tolerances loose enough to show trends
+    standard  The defaults the solvers have always used
+    signoff   Final designs: as tight as double precision allows
+
+Looser tolerances only save time where they cut iterations. draft makes
+square designs (main.optimize_design) about 2-4x faster and draws SVGs with
+fewer curves, but a single circular spiral solve costs about the same as
+standard: its length search converges in a few evaluations either way.
+'''
+
+
+@dataclass(frozen=True)
+class Precision:
+    '''
+    Tolerances of every solver for one precision preset.
+
+    Attributes:
+        name (str): Name of the preset
+        theta_rtol (float): Newton's method on circular spiral angle, relative
+        max_length_rtol (float): Newton's method on the circular spiral's maximum length, relative
+        length_xatol (float): Bounded searches of trace length (in mm)
+        multiplier_xtol (float): Root finding of trace width multipliers (in log(multiplier))
+        design_rtol (float): Grid search of the resistance split and trace lengths, relative
+        profile_tol (float): Differential evolution of width profiles, relative
+        svg_step (float): Radians of circular spiral per SVG curve
+        far_field (float): Distance, in segment lengths, beyond which pairs
+                           of segments approximate their inductance
+    '''
+    name: str
+    theta_rtol: float
+    max_length_rtol: float
+    length_xatol: float
+    multiplier_xtol: float
+    design_rtol: float
+    profile_tol: float
+    svg_step: float
+    far_field: float
+
+
+PRESETS = {
+    preset.name: preset for preset in (
+        Precision("draft", theta_rtol=1e-6, max_length_rtol=1e-8, length_xatol=1e-2,
+                  multiplier_xtol=1e-6, design_rtol=1e-4, profile_tol=0.05,
+                  svg_step=math.pi/2, far_field=5),
+        Precision("standard", theta_rtol=1e-12, max_length_rtol=1e-15, length_xatol=1e-5,
+                  multiplier_xtol=2e-12, design_rtol=1e-9, profile_tol=0.01,
+                  svg_step=math.pi/4, far_field=20),
+        Precision("signoff", theta_rtol=1e-14, max_length_rtol=1e-15, length_xatol=1e-8,
+                  multiplier_xtol=1e-14, design_rtol=1e-12, profile_tol=1e-3,
+                  svg_step=math.pi/8, far_field=math.inf),
+    )
+}
+
+
+def get_precision(name: str) -> Precision:
+    '''
+    Returns: The preset of the given name
+
+    Raises:
+        ValueError: There's no preset of that name
+    '''
+    try:
+        return PRESETS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown precision {name!r}, expected one of {', '.join(PRESETS)}") from None
@@ -0,0 +1,348 @@
+import argparse
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import unittest
+import unittest.mock
+import zipfile
+import numpy as np
+from pathlib import Path
+from helper_conversions import (
+    Constraints, default_constraints, exterior_equivalent_ohms, spacing_from_length)
+from helper_cache import SPIRAL_FIELDS
+import spiral_simple_square
+import spiral_simple_circle
+
+'''
+Precomputed tables of the optimal spiral against resistance, for
+looking up spirals much faster than optimizing them.
+
+A spiral's geometry only depends on resistance * thickness, so one table of
+exterior layer spirals serves every layer. Tables store the optimal trace
+length as a fraction of the maximum trace length on a log-spaced resistance
+grid. A lookup interpolates that fraction and calculates the spiral of the
+resulting length exactly, so the spiral is always self-consistent and only
+its area-sum can fall short of the optimum. How far it falls short is
+estimated at three points inside every grid interval when the table is built;
+lookups in intervals whose estimate is more than the allowed error, or outside
+the table, are optimized exactly instead. The estimate is not a bound:
+between those points a lookup can miss by a few times the estimate,
+where the number of coils changes.
+
+Tables are saved as uncompressed .npz files and memory-mapped when loaded.
+They're saved in the directory in the MAGNETORQUER_SURROGATES environment
+variable, or "surrogates" next to this script.
+
+Example:
+    python helper_surrogate.py --size 4096
+'''
+
+MODULES = {"square": spiral_simple_square, "circle": spiral_simple_circle}
+
+
+def table_directory() -> Path:
+    return Path(os.environ.get("MAGNETORQUER_SURROGATES",
+                               Path(__file__).with_name("surrogates")))
+
+
+def table_path(shape: str, constraints: Constraints = None) -> Path:
+    '''
+    Returns: Where the table of the spiral shape ("square" or "circle") is saved
+             for these constraints
+    '''
+    constraints = constraints or default_constraints()
+    digest = hashlib.sha1(repr(constraints.key(SPIRAL_FIELDS)).encode()).hexdigest()[:16]
+    return table_directory() / f"{shape}_{digest}.npz"
+
+
+def load_npz(path) -> dict:
+    '''
+    Memory-maps every array of an uncompressed .npz file, like np.load(mmap_mode='r')
+    does for .npy files.
+
+    Returns: Dictionary of array name to read-only memory-mapped array
+    '''
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path} is compressed, so it can't be memory-mapped")
+
+            # Skip the local file header to the .npy data
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            arrays[info.filename.removesuffix(".npy")] = np.memmap(
+                path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                order="F" if fortran_order else "C")
+    return arrays
+
+
+class Surrogate:
+    '''
+    Table of the optimal exterior layer spiral of one shape against resistance.
+
+    Attributes:
+        log_ohms (array): Natural log of the resistances in the table
+        fraction (array): Optimal trace length as a fraction of the maximum trace length
+        area_sum (array): Optimal area-sum (in m^2)
+        error (array): Estimated relative area-sum lost by interpolating inside each interval
+                       (the most lost at its three measured points)
+    '''
+
+    def __init__(self, shape: str, arrays: dict, constraints: Constraints = None):
+        self.shape = shape
+        self.module = MODULES[shape]
+        self.constraints = constraints or default_constraints()
+        self.log_ohms = arrays["log_ohms"]
+        self.fraction = arrays["fraction"]
+        self.area_sum = arrays["area_sum"]
+        self.error = arrays["error"]
+        self.hits = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def build(cls, shape: str, constraints: Constraints = None,
+              min_ohms: float = 0.01, max_ohms: float = 1000, size: int = 2048):
+        '''
+        Optimizes the spirals on a log-spaced resistance grid,
+        and at three points inside every interval to measure the error.
+
+        Parameters:
+            shape (str): "square" or "circle"
+            constraints (Constraints): config.ini by default
+            min_ohms, max_ohms (float): Range of exterior layer resistances (in ohms)
+            size (int): Number of resistances in the table
+        '''
+        constraints = constraints or default_constraints()
+        module = MODULES[shape]
+
+        # Grid points, then a quarter, half and three quarters into every interval
+        log_ohms = np.linspace(math.log(min_ohms), math.log(max_ohms), size)
+        probes = log_ohms[:-1, np.newaxis] + np.diff(log_ohms)[:, np.newaxis] * [0.25, 0.5, 0.75]
+        ohms = np.exp(np.concatenate([log_ohms, probes.ravel()]))
+
+        if hasattr(module, "spiral_of_resistance_vectorized"):
+            optimal = module.spiral_of_resistance_vectorized(ohms, True, constraints)
+            area_sum, length = optimal[0], optimal[4]
+        else:
+            optimal = [module.spiral_of_resistance.uncached(x, True, constraints) for x in ohms]
+            area_sum = np.array([spiral[0] for spiral in optimal])
+            length = np.array([spiral[4] for spiral in optimal])
+        fraction = length / module.max_trace_length(ohms, True, constraints)
+
+        table = cls(shape, {
+            "log_ohms": log_ohms,
+            "fraction": fraction[:size],
+            "area_sum": area_sum[:size],
+            "error": np.zeros(size - 1),
+        }, constraints)
+
+        # Largest area-sum lost inside every interval
+        interpolated = table.interpolate(ohms[size:])[0]
+        lost = np.abs(1 - interpolated / area_sum[size:])
+        table.error = np.max(lost.reshape(size - 1, 3), axis=1)
+        return table
+
+    @classmethod
+    def load(cls, path, shape: str = None, constraints: Constraints = None):
+        shape = shape or Path(path).name.split("_")[0]
+        return cls(shape, load_npz(path), constraints)
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, log_ohms=self.log_ohms, fraction=self.fraction,
+                 area_sum=self.area_sum, error=self.error)
+
+    def interpolate(self, ohms):
+        '''
+        Calculates spirals from interpolated trace lengths, without checking the error.
+
+        Returns (arrays shaped like ohms):
+            area_sum, inner_radius, num_of_coils, spacing, length
+        '''
+        c = self.constraints
+        ohms = np.asarray(ohms, dtype=float)
+        fraction = np.interp(np.log(ohms), self.log_ohms, self.fraction)
+        length = fraction * self.module.max_trace_length(ohms, True, c)
+        spacing = spacing_from_length(length, ohms, True, c)
+        return (*self.module.spiral_vectorized(length, spacing, c.outer_radius), spacing, length)
+
+    def spiral_of_resistance(self, ohms: float, exterior: bool, rtol: float = 1e-6):
+        '''
+        Looks up the optimal spiral of a resistance, like spiral_of_resistance().
+
+        Parameters:
+            ohms (float): the desired resistance (in ohms) of the spiral
+            exterior (bool): whether the spiral is on an exterior layer
+            rtol (float): Largest estimated relative area-sum loss of a lookup.
+                          Lookups can lose a few times more between the
+                          points the estimate is measured at
+
+        Returns:
+            area_sum, inner_radius, num_of_coils, spacing, length
+        '''
+        c = self.constraints
+        thickness = c.outer_layer_thickness if exterior else c.inner_layer_thickness
+        equivalent = exterior_equivalent_ohms(ohms, thickness, c)
+
+        i = np.searchsorted(self.log_ohms, math.log(equivalent)) - 1
+        if not 0 <= i < len(self.error) or self.error[i] > rtol:
+            self.fallbacks += 1
+            return self.module.spiral_of_resistance(equivalent, True, c)
+
+        self.hits += 1
+        x = (math.log(equivalent) - self.log_ohms[i]) / (self.log_ohms[i + 1] - self.log_ohms[i])
+        fraction = float(self.fraction[i] + x * (self.fraction[i + 1] - self.fraction[i]))
+        length = fraction * float(self.module.max_trace_length(equivalent, True, c))
+        spacing = spacing_from_length(length, equivalent, True, c)
+        return (*self.module.spiral(length, spacing, c.outer_radius), spacing, length)
+
+
+_tables = {}
+
+
+def get_surrogate(shape: str = "square", constraints: Constraints = None,
+                  build: bool = True) -> Surrogate:
+    '''
+    Loads the table of a spiral shape for the constraints,
+    building and saving it first if there isn't one.
+
+    Parameters:
+        shape (str): "square" or "circle"
+        constraints (Constraints): config.ini by default
+        build (bool): Whether to build a missing table, instead of returning None
+    '''
+    constraints = constraints or default_constraints()
+    path = table_path(shape, constraints)
+    if path not in _tables:
+        if not path.exists():
+            if not build:
+                return None
+            Surrogate.build(shape, constraints).save(path)
+        _tables[path] = Surrogate.load(path, shape, constraints)
+    return _tables[path]
+
+
+def spiral_of_resistance(ohms: float, exterior: bool, constraints: Constraints = None,
+                         shape: str = "square", rtol: float = 1e-6):
+    '''
+    spiral_of_resistance() of the spiral shape, looked up in its table
+    when the table's error estimate allows it.
+    '''
+    return get_surrogate(shape, constraints).spiral_of_resistance(ohms, exterior, rtol)
+
+
+class TestSurrogate(unittest.TestCase):
+
+    def setUp(self):
+        self.constraints = default_constraints()
+        self.table = Surrogate.build("square", self.constraints, 0.1, 100, 512)
+
+    def exact(self, ohms):
+        return spiral_simple_square.spiral_of_resistance_vectorized(ohms, True, self.constraints)
+
+    def test_error_estimate(self):
+        table = self.table
+        log_ohms = np.asarray(table.log_ohms)
+
+        # The error is the most area-sum lost at the measured points
+        probes = np.exp(log_ohms[:-1, np.newaxis] + np.diff(log_ohms)[:, np.newaxis] * [0.25, 0.5, 0.75])
+        lost = 1 - table.interpolate(probes)[0] / self.exact(probes)[0]
+        np.testing.assert_allclose(np.max(lost, axis=1), table.error, rtol=1e-9, atol=1e-15)
+
+        # Anywhere else in an interval, a lookup never beats the optimum,
+        # and misses by at most a few times the error
+        ohms = np.exp(np.random.default_rng(0).uniform(log_ohms[0], log_ohms[-1], 200))
+        exact = self.exact(ohms)
+        errors = table.error[np.searchsorted(log_ohms, np.log(ohms)) - 1]
+        for i, x in enumerate(ohms):
+            spiral = table.spiral_of_resistance(x, True, rtol=1e-6)
+            lost = 1 - spiral[0] / exact[0][i]
+            self.assertGreaterEqual(lost, -1e-12)
+            if errors[i] <= 1e-6:
+                self.assertLessEqual(lost, max(4 * errors[i], 1e-12))
+        self.assertEqual(table.hits, np.sum(errors <= 1e-6))
+        self.assertEqual(table.hits + table.fallbacks, len(ohms))
+
+    def test_fallback(self):
+        c = self.constraints
+        table = self.table
+        for ohms, exterior in ((0.05, True), (500, True), (300, False)):
+            with self.subTest(ohms=ohms, exterior=exterior):
+                fallbacks = table.fallbacks
+                thickness = c.outer_layer_thickness if exterior else c.inner_layer_thickness
+                expected = spiral_simple_square.spiral_of_resistance(
+                    exterior_equivalent_ohms(ohms, thickness, c), True, c)
+                self.assertEqual(table.spiral_of_resistance(ohms, exterior), expected)
+                self.assertEqual(table.fallbacks, fallbacks + 1)
+
+        # Inside the table, an interval whose error is too large
+        i = int(np.argmax(table.error))
+        ohms = math.exp(0.5 * (table.log_ohms[i] + table.log_ohms[i + 1]))
+        self.assertEqual(table.spiral_of_resistance(ohms, True, rtol=table.error[i] / 2),
+                         spiral_simple_square.spiral_of_resistance(ohms, True, c))
+        self.assertEqual(table.hits, 0)
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "square_test.npz"
+            self.table.save(path)
+
+            loaded = Surrogate.load(path, constraints=self.constraints)
+            self.assertEqual(loaded.shape, "square")
+            for name in ("log_ohms", "fraction", "area_sum", "error"):
+                array = getattr(loaded, name)
+                self.assertIsInstance(array, np.memmap)
+                self.assertFalse(array.flags.writeable)
+                np.testing.assert_array_equal(array, getattr(self.table, name))
+            self.assertEqual(loaded.spiral_of_resistance(3, True), self.table.spiral_of_resistance(3, True))
+            del loaded, array
+
+            compressed = Path(directory) / "square_compressed.npz"
+            np.savez_compressed(compressed, log_ohms=self.table.log_ohms)
+            with self.assertRaises(ValueError):
+                load_npz(compressed)
+
+    def test_get_surrogate(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch.dict(os.environ, {"MAGNETORQUER_SURROGATES": directory}), \
+                unittest.mock.patch.dict(_tables, clear=True):
+            c = self.constraints.replace(OuterRadius=30)
+            self.assertIsNone(get_surrogate("square", c, build=False))
+
+            with unittest.mock.patch.object(Surrogate, "build", return_value=self.table) as build:
+                table = get_surrogate("square", c)
+                self.assertIs(get_surrogate("square", c), table)
+            build.assert_called_once_with("square", c)
+            self.assertTrue(table_path("square", c).exists())
+            self.assertIsInstance(table.fraction, np.memmap)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Builds the tables for config.ini")
+    parser.add_argument("--shape", choices=list(MODULES), nargs="+", default=list(MODULES))
+    parser.add_argument("--min-ohms", type=float, default=0.01)
+    parser.add_argument("--max-ohms", type=float, default=1000)
+    parser.add_argument("--size", type=int, default=2048)
+    args = parser.parse_args()
+
+    constraints = Constraints.from_config()
+    for shape in args.shape:
+        table = Surrogate.build(shape, constraints, args.min_ohms, args.max_ohms, args.size)
+        path = table_path(shape, constraints)
+        table.save(path)
+        within = np.mean(table.error <= 1e-6)
+        print(f"Saved {path} ({100 * within:.1f}% of intervals within 1e-6, "
+              f"largest error {np.max(table.error):.2e})")
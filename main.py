@@ -1,56 +1,482 @@
 from helper_conversions import *
-from spiral_simple_square import spiral_of_resistance
-from scipy import optimize
+from spiral_simple_square import (
+    spiral, spiral_vectorized, spiral_of_resistance, max_trace_length,
+    spiral_of_resistance_vectorized, area_sum_per_ohm)
+import numpy as np
 import output_KiCad_square_spiral
+from helper_cache import memoize
+from helper_precision import PRESETS
+import helper_instrumentation
+from helper_instrumentation import instrument, count
+import argparse
+import io
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
 
 '''
 Main program that outputs an optimized square magnetorquer given
 constraints from config.ini
 '''
 
-# Read configuration
-config = ConfigParser()
-config.read(Path(__file__).with_name('config.ini'))
-config = config['Configuration']
+# Properties of each layer class's spiral in get_optimal_design(), in order
+SPIRAL_PROPERTIES = ("area_sum", "inner_radius", "coils", "spacing", "length")
 
 
-def total_area_sum_from_ext_ohms(ext_ohms: float) -> float:
+def total_area_sum_from_ext_ohms(ext_ohms: float, constraints: Constraints = None) -> float:
     '''
     Given the ohms per exterior layer, calculates the area-sum
     of the magnetorquer.
 
     Parameters:
         ext_ohms (float): the resistance (in ohms) per exterior layer
+        constraints (Constraints): config.ini by default
     Returns:
         - The total area_sum given this constraint
 
     '''
+    constraints = constraints or default_constraints()
 
+    int_ohms = int_ohms_from_ext_ohms(ext_ohms, constraints)
+    int_layers = constraints.number_of_layers - 2
 
-    int_ohms = int_ohms_from_ext_ohms(ext_ohms)
-    int_layers = config.getint("NumberOfLayers") - 2
-
-    area_sum = 2 * spiral_of_resistance(ext_ohms, True)[0]
-    area_sum += int_layers * spiral_of_resistance(int_ohms, False)[0]
+    area_sum = 2 * spiral_of_resistance(ext_ohms, True, constraints)[0]
+    area_sum += int_layers * spiral_of_resistance(int_ohms, False, constraints)[0]
     return area_sum
 
 
-def get_optimal_front_resistance() -> float:
+@memoize()
+@instrument()
+def optimize_design(constraints: Constraints = None, grid_size: int = 24, rtol: float = None) -> tuple:
+    '''
+    Jointly finds the split of resistance between exterior and interior
+    layers and the trace length of each spiral that maximize area-sum.
+
+    Trace lengths are searched as fractions of each resistance's maximum
+    trace length. Every round evaluates a grid of exterior resistances
+    against a grid of length fractions for both layer types as single
+    array operations, then zooms every interval in on the best point.
+    The best fractions barely move as the resistance interval shrinks,
+    so each round starts from the previous round's answer.
+
+    Area-sum jumps with the number of coils, so the joint zoom can settle
+    on a neighboring local maximum, up to 3e-7 (relative) below the best
+    split. It's finished by zooming in on the resistance split alone, around
+    the joint zoom's answer, with each resistance's optimal length solved
+    exactly by spiral_of_resistance_vectorized().
+    With 2 layers, both are exterior with half the resistance each, and
+    only the exterior trace length is solved.
+
+    Parameters:
+        constraints (Constraints): config.ini by default
+        grid_size (int): Number of points per interval per round
+        rtol (float): Stop once every interval is this small (relative),
+                      by default from the constraints' precision
+
+    Returns:
+        ext_ohms (float): The optimal resistance per exterior layer spiral
+        exterior (tuple): spiral_of_resistance()-like result for the exterior spirals
+        interior (tuple): spiral_of_resistance()-like result for the interior spirals,
+                          None without interior layers
+        evaluations (int): Number of spiral evaluations used
+
+    Raises:
+        ValueError: There are fewer than 2 layers
+    '''
+    constraints = constraints or default_constraints()
+    rtol = rtol or constraints.tolerances.design_rtol
+    total_ohms = constraints.resistance
+    int_layers = constraints.number_of_layers - 2
+    if int_layers < 0:
+        raise ValueError("NumberOfLayers must be at least 2")
+
+    def grid(lo, hi):
+        # Cell midpoints, so the open ends of the intervals are never hit
+        return lo + (hi - lo) * (np.arange(grid_size) + 0.5) / grid_size
+
+    def area_sums(ohms, fractions, exterior):
+        # Area-sums for every (resistance, length fraction) pair
+        length = np.outer(max_trace_length(ohms, exterior, constraints), fractions)
+        spacing = spacing_from_length(length, ohms[:, np.newaxis], exterior, constraints)
+        area_sum = spiral_vectorized(length, spacing, constraints.outer_radius)[0]
+        return np.where(np.isnan(area_sum), -np.inf, area_sum)
+
+    def zoom(values, lo, hi, bounds):
+        # Narrow the interval to the grid cells around the given values
+        width = 2 * (hi - lo) / grid_size
+        return max(np.min(values) - width, bounds[0]), min(np.max(values) + width, bounds[1])
+
+    # Without interior layers, the resistance split and interior length are fixed
+    ohms_bounds = (0, total_ohms / 2) if int_layers else (total_ohms / 2, total_ohms / 2)
+    ohms_lo, ohms_hi = ohms_bounds
+    ext_lo, ext_hi = 0, 1
+    int_lo, int_hi = (0, 1) if int_layers else (0, 0)
+    evaluations = 0
+
+    while True:
+        ext_ohms = grid(ohms_lo, ohms_hi)
+        ext_fractions = grid(ext_lo, ext_hi)
+        int_fractions = grid(int_lo, int_hi)
+
+        ext_area = area_sums(ext_ohms, ext_fractions, True)
+        if int_layers:
+            int_ohms = int_ohms_from_ext_ohms(ext_ohms, constraints)
+            int_area = area_sums(int_ohms, int_fractions, False)
+        else:
+            int_area = np.zeros((grid_size, 0))
+        evaluations += ext_area.size + int_area.size
+        count(ext_area.size + int_area.size, 1)
+
+        # Best length per resistance, then best resistance
+        ext_best = np.argmax(ext_area, axis=1)
+        int_best = np.argmax(int_area, axis=1) if int_layers else np.zeros(grid_size, int)
+        rows = np.arange(grid_size)
+        total = 2 * ext_area[rows, ext_best]
+        if int_layers:
+            total += int_layers * int_area[rows, int_best]
+        best = np.argmax(total)
+
+        done = (
+            ohms_hi - ohms_lo <= rtol * ext_ohms[best] and
+            ext_hi - ext_lo <= rtol * ext_fractions[ext_best[best]] and
+            int_hi - int_lo <= rtol * int_fractions[int_best[best]]
+        )
+        if done:
+            break
+
+        # Keep the resistances next to the best one, and the length
+        # fractions that are best for any of those resistances
+        near = slice(max(best - 2, 0), best + 3)
+        ohms_lo, ohms_hi = zoom(ext_ohms[best], ohms_lo, ohms_hi, ohms_bounds)
+        ext_lo, ext_hi = zoom(ext_fractions[ext_best[near]], ext_lo, ext_hi, (0, 1))
+        int_lo, int_hi = zoom(int_fractions[int_best[near]], int_lo, int_hi, (0, 1))
+
+    # The grid of lengths only gets close to each resistance's best length,
+    # so finish by zooming in on the split with every length solved exactly
+    ext_ohms = ext_ohms[best]
+    if int_layers:
+        width = (ohms_bounds[1] - ohms_bounds[0]) / grid_size
+        ohms_lo, ohms_hi = max(ext_ohms - width, 0), min(ext_ohms + width, total_ohms / 2)
+        while True:
+            candidates = grid(ohms_lo, ohms_hi)
+            total = (2 * spiral_of_resistance_vectorized(candidates, True, constraints)[0] + int_layers *
+                     spiral_of_resistance_vectorized(int_ohms_from_ext_ohms(candidates, constraints),
+                                                     False, constraints)[0])
+            evaluations += 2 * grid_size
+            count(2 * grid_size, 1)
+            ext_ohms = candidates[np.nanargmax(total)]
+            if ohms_hi - ohms_lo <= rtol * ext_ohms:
+                break
+            ohms_lo, ohms_hi = zoom(ext_ohms, ohms_lo, ohms_hi, (0, total_ohms / 2))
+
+    exterior = spiral_of_resistance(ext_ohms, True, constraints)
+    interior = None
+    if int_layers:
+        interior = spiral_of_resistance(int_ohms_from_ext_ohms(ext_ohms, constraints), False, constraints)
+
+    return ext_ohms, exterior, interior, evaluations
+
+
+@memoize()
+@instrument()
+def allocate_layer_resistances(thicknesses_oz: list = None, constraints: Constraints = None,
+                               table_size: int = 256, grid_size: int = 16) -> list:
+    '''
+    Distributes the total resistance across layers of any copper weights
+    so that total area-sum is maximized.
+
+    At the optimum every layer gains the same area-sum per extra ohm.
+    A layer's spiral only depends on resistance * thickness, so one table
+    of marginal area-sum per ohm (for exterior layers) serves every layer.
+    For a given marginal gain, each distinct thickness reads its resistance
+    off the table, and the gain is solved so that the resistances add up.
+    Area-sum isn't concave where spirals gain a coil, so that's only close
+    (up to 1e-5 relative): resistance is then moved between every pair of
+    thicknesses on a grid that zooms in on the best transfer, until no
+    move gains more than the precision's design_rtol.
+    The cost depends on the number of distinct thicknesses, not layers.
+
+    Parameters:
+        thicknesses_oz (list): Thickness of every layer in oz, front to back.
+                               Defaults to get_layer_thicknesses()
+        constraints (Constraints): config.ini by default
+        table_size (int): Number of resistances in the marginal gain table
+        grid_size (int): Number of transfers per side in each round of the zoom
+
+    Returns:
+        - Resistance (in ohms) of every layer's spiral, front to back
+    '''
+    from scipy import optimize
+
+    constraints = constraints or default_constraints()
+    if thicknesses_oz is None:
+        thicknesses_oz = get_layer_thicknesses(constraints)
+
+    total_ohms = constraints.resistance
+    thicknesses, counts = np.unique(thicknesses_oz, return_counts=True)
+    scale = exterior_equivalent_ohms(1, thicknesses, constraints)
+
+    # Marginal area-sum per exterior-equivalent ohm, made non-increasing.
+    # Resistances too low for any spiral to fit have no gain
+    table = np.geomspace(1e-4, 1, table_size) * total_ohms * scale.max()
+    gain = area_sum_per_ohm(table, True, constraints)
+    finite = np.isfinite(gain) & (gain > 0)
+    if not finite.any():
+        raise ValueError(f"No spiral fits in {total_ohms} ohms")
+    table = table[finite]
+    gain = np.minimum.accumulate(gain[finite])
+
+    def ohms_for_gain(gain_per_ohm):
+        # d(area)/d(ohms) = scale * gain(ohms * scale) for each thickness
+        equivalent = np.interp(-gain_per_ohm / scale, -gain, table)
+        return equivalent / scale
+
+    def excess_ohms(log_gain):
+        return np.sum(counts * ohms_for_gain(np.exp(log_gain))) - total_ohms
+
+    log_gains = np.log(gain[[0, -1]][:, np.newaxis] * scale)
+    log_gain, result = optimize.brentq(excess_ohms, log_gains.max(), log_gains.min(),
+                                       full_output=True)
+    count(result.function_calls, result.iterations)
+
+    # Remove what's left of the mismatch proportionally
+    ohms = ohms_for_gain(np.exp(log_gain))
+    ohms *= total_ohms / np.sum(counts * ohms)
+
+    # Polish with transfers of resistance between pairs of thicknesses
+    def total_area_sums(ohms_i, i, ohms_j, j):
+        equivalent = np.concatenate([exterior_equivalent_ohms(ohms_i, thicknesses[i], constraints),
+                                     exterior_equivalent_ohms(ohms_j, thicknesses[j], constraints)])
+        area_sum = spiral_of_resistance_vectorized(equivalent, True, constraints)[0]
+        count(evaluations=area_sum.size)
+        area_sum = np.where(np.isnan(area_sum), -np.inf, area_sum)
+        return counts[i] * area_sum[:len(ohms_i)] + counts[j] * area_sum[len(ohms_i):]
+
+    rtol = constraints.tolerances.design_rtol
+    moved = True
+    while moved:
+        moved = False
+        for i, j in itertools.combinations(range(len(thicknesses)), 2):
+            # Ohms moved to each layer of thickness i, from the layers of thickness j
+            ratio = counts[i] / counts[j]
+            width = 0.1 * min(ohms[i], ohms[j] / ratio)
+            while width > rtol * ohms[i]:
+                step = np.linspace(-width, width, 2 * grid_size + 1)
+                total = total_area_sums(ohms[i] + step, i, ohms[j] - step * ratio, j)
+                best = np.argmax(total)
+                if total[best] > total[grid_size] * (1 + rtol):
+                    ohms[i] += step[best]
+                    ohms[j] -= step[best] * ratio
+                    moved = True
+                width = 2 * width / grid_size
+        # Moves between one pair can't open up better moves without another
+        moved = moved and len(thicknesses) > 2
+
+    by_thickness = dict(zip(thicknesses, ohms))
+    return [float(by_thickness[t]) for t in thicknesses_oz]
+
+
+@instrument()
+def optimize_layers(thicknesses_oz: list = None, constraints: Constraints = None) -> list:
+    '''
+    Calculates the optimal spiral of every layer of a stackup
+    with any copper weights.
+
+    Parameters:
+        thicknesses_oz (list): Thickness of every layer in oz, front to back.
+                               Defaults to get_layer_thicknesses()
+        constraints (Constraints): config.ini by default
+
+    Returns:
+        - A (resistance, spiral_of_resistance()-like result) pair per layer
+    '''
+    constraints = constraints or default_constraints()
+    if thicknesses_oz is None:
+        thicknesses_oz = get_layer_thicknesses(constraints)
+
+    layer_ohms = allocate_layer_resistances(thicknesses_oz, constraints)
+    equivalent = exterior_equivalent_ohms(
+        np.array(layer_ohms), np.array(thicknesses_oz), constraints)
+    spirals = spiral_of_resistance_vectorized(equivalent, True, constraints)
+
+    return [
+        (ohms, tuple(float(x[i]) for x in spirals))
+        for i, ohms in enumerate(layer_ohms)
+    ]
+
+
+@instrument()
+def get_optimal_front_resistance(constraints: Constraints = None) -> float:
     '''
     Find the balance of exterior and interior spiral resistance that
     maximizes area-sum.
 
+    Parameters:
+        constraints (Constraints): config.ini by default
+
     Returns:
         - The optimal resistance per exterior layer spiral
     '''
+    return optimize_design(constraints)[0]
+
+
+def get_optimal_design(constraints: Constraints = None) -> dict:
+    '''
+    Calculates the optimal magnetorquer given the constraints.
 
-    front_resistance = optimize.minimize_scalar(
-        lambda r: -total_area_sum_from_ext_ohms(r),
-        bounds=(0, config.getfloat("Resistance")/2),
-        method='bounded'
-    ).x
+    Parameters:
+        constraints (Constraints): config.ini by default
+
+    Returns:
+        - Dictionary of the total area-sum, the number of spiral evaluations,
+          the precision preset, and the resistance and spiral properties of
+          each layer class, prefixed by "ext_" for exterior and "int_" for interior layers
+          (without "int_" properties for 2 layers).
+          Stackups with LayerThicknesses have lists of every layer's properties,
+          front to back, prefixed by "layer_" instead, and no evaluation count
+    '''
+    constraints = constraints or default_constraints()
 
-    return front_resistance
+    if constraints.layer_thicknesses is not None:
+        layers = optimize_layers(constraints=constraints)
+        design = {
+            "total_area_sum": sum(spiral[0] for _, spiral in layers),
+            "precision": constraints.precision,
+            "layer_ohms": [float(ohms) for ohms, _ in layers],
+        }
+        for i, name in enumerate(SPIRAL_PROPERTIES):
+            design["layer_" + name] = [float(spiral[i]) for _, spiral in layers]
+        return design
+
+    ext_ohms, exterior, interior, evaluations = optimize_design(constraints)
+    int_layers = constraints.number_of_layers - 2
+
+    design = {
+        "total_area_sum": 2 * exterior[0] + (int_layers * interior[0] if int_layers else 0),
+        "evaluations": evaluations,
+        "precision": constraints.precision,
+    }
+    classes = [("ext_", ext_ohms, exterior)]
+    if int_layers:
+        classes.append(("int_", int_ohms_from_ext_ohms(ext_ohms, constraints), interior))
+    for prefix, ohms, spiral in classes:
+        design[prefix + "ohms"] = float(ohms)
+        design.update({prefix + name: float(x) for name, x in zip(SPIRAL_PROPERTIES, spiral)})
+
+    return design
+
+
+def get_kicad_layers(constraints: Constraints = None) -> list:
+    '''
+    Calculates the optimal magnetorquer given the constraints, for KiCad output.
+
+    Parameters:
+        constraints (Constraints): config.ini by default
+
+    Returns:
+        - The (spacing in mm, number of coils) pair of every layer's spiral, front to back
+    '''
+    constraints = constraints or default_constraints()
+
+    if constraints.layer_thicknesses is not None:
+        return [(spiral[3], spiral[2]) for _, spiral in optimize_layers(constraints=constraints)]
+
+    _, exterior, interior, _ = optimize_design(constraints)
+    interior = interior or exterior
+    return output_KiCad_square_spiral.get_magnetorquer_layers(
+        exterior[3], exterior[2], interior[3], interior[2], constraints)
+
+
+def get_inductance(constraints: Constraints = None, kicad_layers: list = None) -> dict:
+    '''
+    Calculates the inductance of the optimal magnetorquer, with its layers in series.
+
+    Parameters:
+        constraints (Constraints): config.ini by default
+        kicad_layers (list): The get_kicad_layers() result, if already calculated
+
+    Returns:
+        - Dictionary of the inductance (in H), and the L/R time constant
+          (in s) at the constraints' resistance
+    '''
+    import helper_magnetics
+
+    constraints = constraints or default_constraints()
+    kicad_layers = kicad_layers or get_kicad_layers(constraints)
+    inductance = helper_magnetics.square_inductance(kicad_layers, constraints)
+    return {"inductance": inductance, "time_constant": inductance / constraints.resistance}
+
+
+def run_batch(lines, output=None, kicad_dir=None, base: Constraints = None) -> int:
+    '''
+    Calculates the optimal design of every constraint set in JSON lines,
+    writing one JSON line per design as soon as it's calculated.
+
+    Every line is an object of the constraints that differ from the base
+    (by config.ini or field name), and may have an "id" to pass on to its
+    result, e.g. {"id": "small", "Resistance": 20, "OuterRadius": 25}
+
+    Parameters:
+        lines: Iterable of JSON lines, such as an open file
+        output: File-like object for the results (stdout by default)
+        kicad_dir (str or Path): Also save each design's KiCad text in this directory,
+                                 as <id>.txt, or design_<line>.txt without an id.
+                                 Characters other than letters, digits, ".", "-" and "_"
+                                 in ids become "_", and names already used get "_<line>"
+        base (Constraints): Values of the constraints that lines leave out
+                            (config.ini by default)
+
+    Returns:
+        - The number of lines that failed. Their results have an "error" instead
+    '''
+    output = output or sys.stdout
+    base = base or default_constraints()
+    if kicad_dir is not None:
+        Path(kicad_dir).mkdir(parents=True, exist_ok=True)
+
+    failed = 0
+    names = set()
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        result = {"line": number}
+        try:
+            changes = json.loads(line)
+            if not isinstance(changes, dict):
+                raise ValueError("Each line must be a JSON object of constraints")
+            if "id" in changes:
+                result["id"] = changes.pop("id")
+
+            constraints = base.replace(**changes)
+            result.update(get_optimal_design(constraints))
+
+            if kicad_dir is not None:
+                name = re.sub(r"[^\w.-]", "_", str(result["id"])) if "id" in result else f"design_{number:d}"
+                # Different ids can have the same name, even just by case on some file systems
+                if name.casefold() in names:
+                    name = f"{name}_{number:d}"
+                if name.casefold() in names:
+                    raise ValueError(f"{name}.txt is already used by another design")
+                names.add(name.casefold())
+                path = Path(kicad_dir) / f"{name}.txt"
+                with open(path, "w", buffering=1 << 20) as f:
+                    output_KiCad_square_spiral.write_layers(
+                        get_kicad_layers(constraints), f, constraints)
+                result["kicad"] = str(path)
+        except Exception as e:
+            failed += 1
+            result["error"] = f"{type(e).__name__}: {e}"
+
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+    return failed
 
 
 def print_about_spiral(spiral, resistance):
@@ -67,25 +493,201 @@ def print_about_spiral(spiral, resistance):
     ''')
 
 
-if __name__ == "__main__":
+def cli(argv: list = None):
+    '''
+    Command line entry point: prints the optimal magnetorquer given config.ini
+    and outputs it for KiCad.
+
+    Parameters:
+        argv (list): Command line arguments (sys.argv by default)
+    '''
+    parser = argparse.ArgumentParser(
+        description="Outputs an optimized square magnetorquer given constraints from config.ini")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Instrument the optimizers, print a summary and save "
+                             "a Chrome/Perfetto trace to PATH")
+    parser.add_argument("--board", metavar="PATH",
+                        help="Inject the spiral into this *.kicad_pcb file, replacing a "
+                             "previously injected one, instead of saving KiCad_spiral.txt")
+    parser.add_argument("--output", metavar="PATH",
+                        help="Save the KiCad text to PATH instead of KiCad_spiral.txt")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Calculate a design per line of constraints in a JSONL file "
+                             "(- for stdin) and print a JSON line per design")
+    parser.add_argument("--kicad-dir", metavar="DIR",
+                        help="With --batch, also save the KiCad text of every design in DIR")
+    parser.add_argument("--precision", choices=list(PRESETS),
+                        help="Solver tolerances, instead of the Precision of config.ini")
+    args = parser.parse_args(argv)
+    if args.trace:
+        helper_instrumentation.enable()
+
+    constraints = Constraints.from_config()
+    if args.precision:
+        constraints = constraints.replace(precision=args.precision)
+
+    if args.batch:
+        if args.batch == "-":
+            failed = run_batch(sys.stdin, sys.stdout, args.kicad_dir, constraints)
+        else:
+            with open(args.batch) as lines:
+                failed = run_batch(lines, sys.stdout, args.kicad_dir, constraints)
+        sys.exit(1 if failed else 0)
+
+    if constraints.layer_thicknesses is not None:
+        # Stackup with per-layer copper weights
+        layers = optimize_layers(constraints=constraints)
+
+        total_area_sum = sum(spiral[0] for _, spiral in layers)
+        print(f"Optimal properties calculated given config.ini ({constraints.precision} precision):")
+        print(f"Total area-sum: {total_area_sum:.4f} m^2\n")
+        for i, (ohms, spiral) in enumerate(layers):
+            print(f"Properties of the spiral on layer {i:d}:")
+            print_about_spiral(spiral, ohms)
+
+        kicad_layers = [(spiral[3], spiral[2]) for _, spiral in layers]
+
+    else:
+
+        # Collect data about the optimal spirals
+        ext_ohms, exterior, interior, evaluations = optimize_design(constraints)
+        interior_layers = constraints.number_of_layers - 2
+
+        # Print information about optimal magnetorquer
+        total_area_sum = 2 * exterior[0] + (interior_layers * interior[0] if interior_layers else 0)
+        print(f"Optimal properties calculated given config.ini "
+              f"({constraints.precision} precision, {evaluations:d} spiral evaluations):")
+        print(f"Total area-sum: {total_area_sum:.4f} m^2\n")
+        print("Properties per each of the 2 external spirals:")
+        print_about_spiral(exterior, ext_ohms)
+        if interior_layers:
+            print(f"Properties per each of the {interior_layers:d} internal spirals:")
+            print_about_spiral(interior, int_ohms_from_ext_ohms(ext_ohms, constraints))
+
+        kicad_layers = get_kicad_layers(constraints)
+
+    electrical = get_inductance(constraints, kicad_layers)
+    print(f"Inductance: {electrical['inductance'] * 1e6:.4f} uH, "
+          f"L/R time constant: {electrical['time_constant'] * 1e6:.4f} us\n")
+
+    # Output the optimal spiral to the board or KiCad_spiral.txt
+    if args.board:
+        output_KiCad_square_spiral.inject_layers(kicad_layers, args.board, constraints)
+        print(f"Injected optimal spiral into {args.board}")
+    else:
+        output_KiCad_square_spiral.save_layers(kicad_layers, constraints, args.output)
+
+    if helper_instrumentation.enabled:
+        print(f"Instrumentation: {helper_instrumentation.summary()}")
+        if args.trace:
+            helper_instrumentation.save_trace(args.trace)
 
-    # Collect data about the optimal spirals
-    ext_ohms = get_optimal_front_resistance()
-    int_ohms = int_ohms_from_ext_ohms(ext_ohms)
-    exterior = spiral_of_resistance(ext_ohms, True)
-    interior = spiral_of_resistance(int_ohms, False)
-
-    # Print information about optimal magnetorquer
-    total_area_sum = total_area_sum_from_ext_ohms(ext_ohms)
-    print("Optimal properties calculated given config.ini:")
-    print(f"Total area-sum: {total_area_sum:.4f} m^2\n")
-    print("Properties per each of the 2 external spirals:")
-    print_about_spiral(exterior, ext_ohms)
-    interior_layers = config.getint("NumberOfLayers") - 2
-    print(f"Properties per each of the {interior_layers:d} internal spirals:")
-    print_about_spiral(interior, int_ohms)
-
-
-    # Output the optimal spiral to KiCad_spiral.txt
-    output_KiCad_square_spiral.save_magnetorquer(
-        exterior[3], exterior[2], interior[3], interior[2])
+
+class TestMain(unittest.TestCase):
+
+    def test_two_layers(self):
+        # Both layers are exterior with half the resistance, so there's no interior spiral
+        c = default_constraints().replace(number_of_layers=2, resistance=60)
+        design = get_optimal_design(c)
+        self.assertEqual(design["ext_ohms"], 30)
+        self.assertNotIn("int_ohms", design)
+        self.assertAlmostEqual(design["total_area_sum"],
+                               2 * spiral_of_resistance(30, True, c)[0], places=9)
+        json.dumps(design, allow_nan=False)
+        self.assertEqual(len(get_kicad_layers(c)), 2)
+
+        with self.assertRaises(ValueError):
+            optimize_design(c.replace(number_of_layers=1))
+
+    def test_run_batch(self):
+        c = default_constraints()
+        lines = [
+            '{"id": "a/b", "Resistance": 20}\n',
+            '\n',
+            '{"id": "a:b", "resistance": 30}\n',
+            '{"OuterRadius": 30}\n',
+            '{"id": "A_B", "NumberOfLayers": 2}\n',
+            '{"id": "bad", "NoSuchConstraint": 1}\n',
+            '[1, 2]\n',
+            '{not json\n',
+            '{"id": 7}\n',
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            output = io.StringIO()
+            self.assertEqual(run_batch(lines, output, directory, c), 3)
+            results = [json.loads(line) for line in output.getvalue().splitlines()]
+
+            self.assertEqual([r["line"] for r in results], [1, 3, 4, 5, 6, 7, 8, 9])
+            self.assertEqual([r.get("id") for r in results], ["a/b", "a:b", None, "A_B", "bad", None, None, 7])
+            self.assertEqual(["error" in r for r in results], [False, False, False, False, True, True, True, False])
+            self.assertIn("NoSuchConstraint", results[4]["error"])
+
+            names = ["a_b.txt", "a_b_3.txt", "design_4.txt", "A_B_5.txt", "7.txt"]
+            designs = [c.replace(Resistance=20), c.replace(Resistance=30), c.replace(OuterRadius=30),
+                       c.replace(NumberOfLayers=2), c]
+            self.assertEqual(sorted(os.listdir(directory)), sorted(names))
+            for result, name, constraints in zip([r for r in results if "error" not in r], names, designs):
+                self.assertEqual(result["kicad"], os.path.join(directory, name))
+                self.assertEqual(result["total_area_sum"], get_optimal_design(constraints)["total_area_sum"])
+                text = io.StringIO()
+                output_KiCad_square_spiral.write_layers(get_kicad_layers(constraints), text, constraints)
+                with open(result["kicad"]) as f:
+                    self.assertEqual(f.read(), text.getvalue())
+
+    def test_matches_nested_search(self):
+        # The original bounded search of the split around spiral_of_resistance()
+        from scipy import optimize
+
+        for layers in (3, 4, 6, 8):
+            for resistance in (10, 30, 100, 300):
+                c = default_constraints().replace(number_of_layers=layers, resistance=resistance)
+                nested = optimize.minimize_scalar(
+                    lambda r: -total_area_sum_from_ext_ohms(r, c),
+                    bounds=(0, resistance / 2), method="bounded")
+                ext_ohms, exterior, interior, _ = optimize_design.uncached(c)
+                total = 2 * exterior[0] + (layers - 2) * interior[0]
+                self.assertGreaterEqual(total, -nested.fun * (1 - 1e-13), (layers, resistance))
+                self.assertAlmostEqual(total, total_area_sum_from_ext_ohms(ext_ohms, c), places=15)
+
+    def test_allocate_layer_resistances(self):
+        def area_sums(ohms, thickness, c):
+            equivalent = exterior_equivalent_ohms(ohms, thickness, c)
+            area_sum = spiral_of_resistance_vectorized(equivalent, True, c)[0]
+            return np.where(np.isnan(area_sum), -np.inf, area_sum)
+
+        for layers in range(3, 7):
+            for resistance in (20, 50, 100):
+                c = default_constraints().replace(number_of_layers=layers, resistance=resistance)
+                thicknesses = get_layer_thicknesses(c)
+                ohms = allocate_layer_resistances.uncached(thicknesses, c)
+                self.assertAlmostEqual(sum(ohms), resistance, places=9)
+                total = sum(area_sums(o, t, c) for o, t in zip(ohms, thicknesses))
+
+                # Brute force over the exterior layers' share, zooming in
+                lo, hi = 0, resistance / 2
+                for _ in range(5):
+                    ext_ohms = np.linspace(lo, hi, 401)[1:-1]
+                    int_ohms = (resistance - 2 * ext_ohms) / (layers - 2)
+                    totals = (2 * area_sums(ext_ohms, c.outer_layer_thickness, c)
+                              + (layers - 2) * area_sums(int_ohms, c.inner_layer_thickness, c))
+                    best = np.argmax(totals)
+                    width = 4 * (hi - lo) / 400
+                    lo, hi = max(ext_ohms[best] - width, 0), min(ext_ohms[best] + width, resistance / 2)
+                self.assertGreaterEqual(total, totals[best] * (1 - 1e-9), (layers, resistance))
+
+        # The same board as a stackup, at a resistance whose smallest spirals have 1 coil
+        c = default_constraints().replace(number_of_layers=6, resistance=50)
+        stackup = get_optimal_design(c.replace(layer_thicknesses=(1, 0.5, 0.5, 0.5, 0.5, 1)))
+        self.assertAlmostEqual(stackup["total_area_sum"] / get_optimal_design(c)["total_area_sum"], 1,
+                               delta=1e-7)
+
+    def test_default_design_without_scipy(self):
+        # The closed forms, and so the default design, don't need scipy.
+        # A fresh interpreter shows what a cold start imports
+        code = ("import sys, main; main.get_optimal_design(); "
+                "sys.exit('scipy' in sys.modules)")
+        subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent, check=True)
+
+
+if __name__ == "__main__":
+    cli()
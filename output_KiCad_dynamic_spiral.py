@@ -1,7 +1,6 @@
-import math
+import unittest
 import numpy as np
 from pathlib import Path
-from configparser import ConfigParser
 
 
 '''
@@ -9,51 +8,115 @@ EXPERIMENTAL
 Functions that can output a KiCad file of a variable trace width square spiral
 '''
 
-# Read configuration
-config = ConfigParser()
-config.read(Path(__file__).with_name('config.ini'))
-config = config['Configuration']
+from helper_conversions import Constraints, default_constraints
 
 
-class Point:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+# Vertex of a variable trace width spiral
+VERTEX = np.dtype([("x", np.float64), ("y", np.float64), ("width", np.float64)])
+
+# The same memory as VERTEX with x and y swapped, to mirror a spiral without copying it
+FLIPPED_VERTEX = np.dtype({
+    "names": ["x", "y", "width"],
+    "formats": [np.float64] * 3,
+    "offsets": [8, 0, 16],
+    "itemsize": VERTEX.itemsize,
+})
 
 
 class SpiralShape:
-    def __init__(self):
-        self.coils = []
-        self.widths = []
+    '''
+    Vertices of a variable trace width spiral, coil after coil, in one
+    structured array of (x, y, width). The vertices of a coil share its
+    width, and consecutive vertices of a coil are joined by segments.
 
-    def add_coil(self, width, *args):
-        self.coils.append([*args])
-        self.widths.append(width)
-    
-    def flip(self):
-        for coil in self.coils:
-            for point in coil:
-                point = point[1], point[0]
+    flip() and shift() return views of the same vertices.
+    '''
 
+    def __init__(self, vertices=None, coil_starts=None, offset=(0, 0)):
+        self.vertices = np.zeros(0, VERTEX) if vertices is None else vertices
+        self.coil_starts = np.zeros(0, int) if coil_starts is None else np.asarray(coil_starts)
+        self.offset = offset
 
-    def get_KiCad_text(self, layer):
-        out = ""
+    @classmethod
+    def from_corners(cls, corners, widths):
+        '''
+        Builds a spiral whose coils all have the same number of corners.
+
+        Parameters:
+            corners (array): (coils, corners per coil, 2) array of x and y (in mm)
+            widths (array): The trace width (in mm) of every coil
+        '''
+        corners = np.asarray(corners, dtype=float)
+        num_of_coils, points = corners.shape[:2]
 
-        if layer % 2 == 1:
-            self.flip()
-            
+        vertices = np.empty(num_of_coils * points, VERTEX)
+        vertices["x"] = corners[..., 0].ravel()
+        vertices["y"] = corners[..., 1].ravel()
+        vertices["width"] = np.repeat(widths, points)
 
-        for coil_i in range(len(self.coils)):
-            coil = self.coils[coil_i]
-            width = self.widths[coil_i]
+        return cls(vertices, np.arange(num_of_coils) * points)
 
-            out += get_segment(width, get_layer_name(layer), *coil[0], *coil[1])
+    def __len__(self):
+        return len(self.coil_starts)
 
-            for point_i in range(2, len(coil)):
-                out += get_segment(width, get_layer_name(layer),
-                                    *coil[point_i-1], *coil[point_i])
-        
-        out += get_segment(1, get_layer_name(layer), *self.coils[-1][-1], config.getfloat("OuterRadius"), config.getfloat("OuterRadius"))
+    @property
+    def widths(self):
+        return self.vertices["width"][self.coil_starts]
+
+    def add_coil(self, width, *args):
+        coil = np.empty(len(args), VERTEX)
+        coil["x"], coil["y"] = np.array(args, dtype=float).T
+        coil["width"] = width
+
+        self.coil_starts = np.append(self.coil_starts, len(self.vertices))
+        self.vertices = np.concatenate([self.vertices, coil.astype(self.vertices.dtype)])
+
+    def flip(self):
+        '''
+        Returns: The spiral mirrored across the line y = x, sharing these vertices
+        '''
+        flipped = FLIPPED_VERTEX if self.vertices.dtype == VERTEX else VERTEX
+        return SpiralShape(self.vertices.view(flipped), self.coil_starts, self.offset[::-1])
+
+    def shift(self, dx, dy):
+        '''
+        Returns: The spiral moved by (dx, dy), sharing these vertices
+        '''
+        x, y = self.offset
+        return SpiralShape(self.vertices, self.coil_starts, (x + dx, y + dy))
+
+    def segments(self):
+        '''
+        Returns: (segments, 5) array of x1, y1, x2, y2 and width (in mm)
+                 of the segments joining consecutive vertices of each coil
+        '''
+        v = self.vertices
+        joined = np.ones(max(len(v) - 1, 0), dtype=bool)
+        joined[self.coil_starts[1:] - 1] = False
+
+        first, second = v[:-1][joined], v[1:][joined]
+        x, y = self.offset
+        return np.stack([
+            first["x"] + x, first["y"] + y,
+            second["x"] + x, second["y"] + y,
+            first["width"],
+        ], axis=-1)
+
+    def get_KiCad_text(self, layer, constraints: Constraints = None):
+        constraints = constraints or default_constraints()
+        layer_name = get_layer_name(layer, constraints)
+
+        shape = self.flip() if layer % 2 == 1 else self
+
+        segments = shape.segments()
+        line = f"(segment (start %.4f %.4f) (end %.4f %.4f) (width %.4f) (layer {layer_name}) (net 0))\n"
+        out = (line * len(segments)) % tuple(segments.ravel().tolist())
+
+        if len(shape.vertices):
+            last = shape.vertices[-1]
+            x, y = shape.offset
+            out += get_segment(1, layer_name, last["x"] + x, last["y"] + y,
+                               constraints.outer_radius, constraints.outer_radius)
 
         return out
 
@@ -70,34 +133,83 @@ def get_segment(width, layer, x1, y1, x2, y2):
 
 
 
-def get_layer_name(layer):
+def get_layer_name(layer, constraints: Constraints = None):
+    constraints = constraints or default_constraints()
     if layer == 0:
         return 'F.Cu'
-    elif layer == config.getint("NumberOfLayers")-1:
+    elif layer == constraints.number_of_layers-1:
         return 'B.Cu'
     else:
         return f"In{layer}.Cu"
 
 
 
-def save_spiral(exterior_shape, interior_shape):
-    num = config.getint("NumberOfLayers")
+def save_spiral(exterior_shape, interior_shape, constraints: Constraints = None):
+    constraints = constraints or default_constraints()
+    num = constraints.number_of_layers
 
 
-    out = exterior_shape.get_KiCad_text(0)
-
+    out = [exterior_shape.get_KiCad_text(0, constraints)]
     for i in range(num-2):
-        out += interior_shape.get_KiCad_text(i+1)
-    
-    out += exterior_shape.get_KiCad_text(num-1)
+        out.append(interior_shape.get_KiCad_text(i+1, constraints))
+    out.append(exterior_shape.get_KiCad_text(num-1, constraints))
 
     p = Path(__file__).with_name('KiCad_spiral.txt')
     f = open(p, "w")
-    f.write(out)
+    f.writelines(out)
     f.close()
 
     print("Saved optimal spiral in KiCad_spiral.txt")
     print("Paste its entire content just before the final closing parantheses of your *.kicad_pcb file")
     print("Save the file, and open KiCad. Your spiral should appear in the PCB editor.")
     print("Be sure to add through-vias connecting the different spiral layers.")
-    
+
+
+class TestSpiralShape(unittest.TestCase):
+
+    coils = [
+        (0.5, [(-30.5, -30), (30, -30), (30, 30), (-30, 30), (-30, -29.3)]),
+        (0.3, [(-29.3, -29), (29, -29), (29, 29), (-29, 29), (-29, -28.4)]),
+        (0.2, [(-28.4, -28), (28, -28), (28, 28), (-28, 28)]),
+    ]
+
+    def shape(self):
+        shape = SpiralShape()
+        for width, points in self.coils:
+            shape.add_coil(width, *points)
+        return shape
+
+    def baseline(self, layer, constraints):
+        # The original writer, with lists of points swapped on odd layers
+        layer_name = get_layer_name(layer, constraints)
+        out = ""
+        for width, points in self.coils:
+            if layer % 2 == 1:
+                points = [(y, x) for x, y in points]
+            for start, end in zip(points, points[1:]):
+                out += get_segment(width, layer_name, *start, *end)
+        out += get_segment(1, layer_name, *points[-1],
+                           constraints.outer_radius, constraints.outer_radius)
+        return out
+
+    def test_flip(self):
+        shape = self.shape()
+        vertices = shape.vertices.copy()
+        flipped = shape.flip()
+
+        np.testing.assert_array_equal(flipped.vertices["x"], vertices["y"])
+        np.testing.assert_array_equal(flipped.vertices["y"], vertices["x"])
+        np.testing.assert_array_equal(flipped.widths, [0.5, 0.3, 0.2])
+        self.assertTrue(np.shares_memory(flipped.vertices, shape.vertices))
+        np.testing.assert_array_equal(flipped.flip().vertices, vertices)
+
+        # Flipping is a view, so the original is untouched
+        np.testing.assert_array_equal(shape.vertices, vertices)
+        self.assertEqual(shape.vertices.dtype, VERTEX)
+
+    def test_get_KiCad_text(self):
+        c = default_constraints().replace(number_of_layers=4)
+        shape = self.shape()
+        for layer in (0, 1, 2, 1, 3):
+            self.assertEqual(shape.get_KiCad_text(layer, c), self.baseline(layer, c))
+        self.assertNotEqual(self.baseline(0, c), self.baseline(1, c).replace("In1.Cu", "F.Cu"))
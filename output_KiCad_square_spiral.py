@@ -1,45 +1,138 @@
+import functools
+import io
+import mmap
+import re
+import sys
+import tempfile
+import unittest
+import numpy as np
 from pathlib import Path
-from configparser import ConfigParser
 
 
 '''
 Functions that output a KiCad file of a constant trace width square magnetorquer
 '''
 
-# Read configuration
-config = ConfigParser()
-config.read(Path(__file__).with_name('config.ini'))
-config = config['Configuration']
+from helper_conversions import Constraints, default_constraints
 
 
-def get_spiral(spacing, num_of_coils, trace_width, layer) -> str:
+def get_layer_name(layer, constraints: Constraints = None) -> str:
+    '''
+    Returns: KiCad's name of the given copper layer (0 is the front)
+    '''
+    constraints = constraints or default_constraints()
 
-    reverse = (layer % 2 == 1)
+    if layer == 0:
+        return 'F.Cu'
+    elif layer == constraints.number_of_layers-1:
+        return 'B.Cu'
+    else:
+        return f"In{layer}.Cu"
+
+
+# Stands in for the layer name in formatted layer geometry
+LAYER = "\0"
+
+
+def get_segments(layers, constraints: Constraints = None, first_layer: int = 0) -> tuple:
+    '''
+    Calculates every segment of a spiral with its own spacing and coil count
+    on every layer, in KiCad's coordinates.
+
+    Each coil has corners a to e, joined by 4 segments. The corners of all
+    coils of all layers are calculated together, and odd layers are then
+    mirrored across the diagonal by swapping x and y.
+
+    Parameters:
+        layers: A (spacing in mm, number of coils) pair per layer, front to back
+        constraints: config.ini by default
+        first_layer (int): Index of the first of the layers on the board,
+                           which sets which layers are odd
+
+    Returns:
+        segments (array): (segments, 4) array of x1, y1, x2, y2 (in mm), layer by layer
+        layer (array): The layer of every segment
+    '''
+    constraints = constraints or default_constraints()
+    outer_radius = constraints.outer_radius
+
+    num_of_coils = np.array([int(n) for _, n in layers], dtype=int)
+    spacing = np.repeat(np.array([s for s, _ in layers], dtype=float), num_of_coils)
+    layer = np.repeat(np.arange(len(layers)) + first_layer, 4 * num_of_coils)
+
+    # Index of every coil within its layer
+    first = np.repeat(np.cumsum(num_of_coils) - num_of_coils, num_of_coils)
+    radius = outer_radius - (np.arange(len(spacing)) - first) * spacing
+
+    segments = np.stack([
+        -spacing-radius, -radius, radius, -radius,     # a to b
+        radius, -radius, radius, radius,               # b to c
+        radius, radius, -radius, radius,               # c to d
+        -radius, radius, -radius, spacing-radius,      # d to e
+    ], axis=-1).reshape(-1, 4) + (outer_radius + 20)
+
+    odd = layer % 2 == 1
+    segments[odd] = segments[odd][:, [1, 0, 3, 2]]
+
+    return segments, layer
+
+
+def format_segments(segments, trace_width) -> str:
+    '''
+    Formats segments all at once, with LAYER in place of the layer name.
+
+    Parameters:
+        segments (array): (segments, 4) array of x1, y1, x2, y2 (in mm)
+        trace_width (float): Trace width (in mm)
+
+    Returns:
+        - The segments, one per line
+    '''
+    line = f"(segment (start %.4f %.4f) (end %.4f %.4f) (width {trace_width:.4f}) (layer {LAYER}) (net 0))\n"
+    return (line * len(segments)) % tuple(segments.ravel().tolist())
 
-    outer_radius = config.getfloat("OuterRadius")
 
-    out = ""
-    for i in range(num_of_coils):
-        radius = outer_radius - i * spacing
+@functools.lru_cache(maxsize=64)
+def format_layer(spacing, num_of_coils, trace_width, reverse,
+                 constraints: Constraints = None) -> str:
+    '''
+    Formats the segments of one layer's spiral, with LAYER in place of
+    the layer name, so that layers with the same geometry and orientation
+    are only formatted once.
+
+    Parameters:
+        spacing (float): Distance (in mm) between centers of adjacent traces
+        num_of_coils (int): Number of coils
+        trace_width (float): Trace width (in mm)
+        reverse (bool): Whether x and y are swapped, as on odd layers
+        constraints: config.ini by default
+
+    Returns:
+        - The segments, one per line
+    '''
+    segments, _ = get_segments([(spacing, num_of_coils)], constraints,
+                               first_layer=int(reverse))
+    return format_segments(segments, trace_width)
+
+
+def get_spiral(spacing, num_of_coils, trace_width, layer,
+               constraints: Constraints = None) -> str:
 
-        a = (-spacing-radius, -radius)
-        b = (radius, -radius)
-        c = (radius, radius)
-        d = (-radius, radius)
-        e = (-radius, spacing-radius)
+    constraints = constraints or default_constraints()
 
-        out += get_segment(*a, *b, trace_width, layer, reverse)
-        out += get_segment(*b, *c, trace_width, layer, reverse)
-        out += get_segment(*c, *d, trace_width, layer, reverse)
-        out += get_segment(*d, *e, trace_width, layer, reverse)
+    reverse = (layer % 2 == 1)
 
-    return out
+    text = format_layer(spacing, num_of_coils, trace_width, reverse, constraints)
+    return text.replace(LAYER, get_layer_name(layer, constraints))
 
 
-def get_segment(x1, y1, x2, y2, width, layer, reverse) -> str:
+def get_segment(x1, y1, x2, y2, width, layer, reverse,
+                constraints: Constraints = None) -> str:
     net = 0
 
-    offset = config.getfloat("OuterRadius") + 20
+    constraints = constraints or default_constraints()
+
+    offset = constraints.outer_radius + 20
 
     x1 += offset
     y1 += offset
@@ -50,18 +143,30 @@ def get_segment(x1, y1, x2, y2, width, layer, reverse) -> str:
         x1, y1 = y1, x1
         x2, y2 = y2, x2
 
-    if layer == 0:
-        layer = 'F.Cu'
-    elif layer == config.getint("NumberOfLayers")-1:
-        layer = 'B.Cu'
-    else:
-        layer = f"In{layer}.Cu"
+    layer = get_layer_name(layer, constraints)
 
     return f"(segment (start {x1:.4f} {y1:.4f}) (end {x2:.4f} {y2:.4f}) (width {width:.4f}) (layer {layer}) (net {net}))\n"
 
 
+def get_magnetorquer_layers(exterior_spacing, exterior_num_of_coils,
+                            interior_spacing, interior_num_of_coils,
+                            constraints: Constraints = None) -> list:
+    '''
+    Returns: The (spacing, number of coils) pair of every layer, front to back,
+             of a magnetorquer with the given exterior and interior spirals
+    '''
+    constraints = constraints or default_constraints()
+    num_of_layers = constraints.number_of_layers
+
+    exterior = (exterior_spacing, exterior_num_of_coils)
+    interior = (interior_spacing, interior_num_of_coils)
+
+    return [exterior] + [interior] * (num_of_layers - 2) + [exterior]
+
+
 def save_magnetorquer(exterior_spacing, exterior_num_of_coils,
-                      interior_spacing, interior_num_of_coils):
+                      interior_spacing, interior_num_of_coils,
+                      constraints: Constraints = None, file=None):
     '''
     Saves the given spiral to "KiCad_spiral.txt".
 
@@ -70,30 +175,317 @@ def save_magnetorquer(exterior_spacing, exterior_num_of_coils,
         exterior_num_of_coils: Number of coils per exterior layer
         interior_spacing: Spacing between centers of adjacent traces (in mm) on interior layers
         interior_num_of_coils: Number of coils per interior layer
+        constraints: config.ini by default
+        file: See save_layers()
+    '''
+    layers = get_magnetorquer_layers(exterior_spacing, exterior_num_of_coils,
+                                     interior_spacing, interior_num_of_coils, constraints)
+    save_layers(layers, constraints, file)
+
+
+def tag_segments(text: str, layer: int) -> str:
+    '''
+    Gives every formatted segment of a layer a timestamp (KiCad's UUID)
+    starting with TAG, followed by the layer and the segment's index in it.
+    KiCad keeps these when it saves the board, so injected segments can
+    still be found after the markers around them are gone.
+    '''
+    return "".join(
+        f"{line[:-1]} (tstamp {TAG}{layer:04x}{i:08x}))\n"
+        for i, line in enumerate(text.splitlines()))
+
+
+def write_layers(layers, file, constraints: Constraints = None, tagged: bool = False) -> int:
+    '''
+    Streams the segments of a spiral with its own spacing and coil count
+    on every layer to a file-like object, one layer at a time.
+
+    Parameters:
+        layers: A (spacing in mm, number of coils) pair per layer, front to back
+        file: Any object with a write(str) method
+        constraints: config.ini by default
+        tagged (bool): Whether to give every segment a TAG timestamp, see tag_segments()
+
+    Returns:
+        - The number of segments written
+    '''
+    constraints = constraints or default_constraints()
+    segments, _ = get_segments(layers, constraints)
+
+    # Layers with the same geometry and orientation are formatted once
+    formatted = {}
+    start = 0
+    for i, (spacing, num_of_coils) in enumerate(layers):
+        width = spacing - constraints.gap_between_traces
+        end = start + 4 * int(num_of_coils)
+        key = (spacing, int(num_of_coils), width, i % 2)
+        if key not in formatted:
+            formatted[key] = format_segments(segments[start:end], width)
+        text = formatted[key].replace(LAYER, get_layer_name(i, constraints))
+        file.write(tag_segments(text, i) if tagged else text)
+        start = end
+
+    return len(segments)
+
+
+def save_layers(layers, constraints: Constraints = None, file=None):
+    '''
+    Saves a spiral with its own spacing and coil count on every layer
+    to "KiCad_spiral.txt".
+
+    Parameters:
+        layers: A (spacing in mm, number of coils) pair per layer, front to back
+        constraints: config.ini by default
+        file: Path or file-like object to save to instead, "-" for stdout.
+              Instructions are only printed for paths and stdout
+    '''
+    if file is None:
+        file = Path(__file__).with_name('KiCad_spiral.txt')
+    if file == "-":
+        file = sys.stdout
+
+    if hasattr(file, "write"):
+        write_layers(layers, file, constraints)
+        if file is not sys.stdout:
+            return
+        # Keep the instructions out of the segments
+        name, info = "stdout", sys.stderr
+    else:
+        with open(file, "w", buffering=1 << 20) as f:
+            write_layers(layers, f, constraints)
+        name, info = Path(file).name, sys.stdout
+
+    print(f"Saved optimal spiral in {name}", file=info)
+    print("Paste its entire content just before the final closing parantheses of your *.kicad_pcb file", file=info)
+    print("Save the file, and open KiCad. Your spiral should appear in the PCB editor.", file=info)
+    print("Be sure to add through-vias connecting the different spiral layers.", file=info)
+
+
+# Lines around an injected spiral, so it can be found and replaced quickly.
+# KiCad drops them when it saves the board.
+BEGIN_MARKER = b"# magnetorquer begin\n"
+END_MARKER = b"# magnetorquer end\n"
+
+# Start of the timestamp of every injected segment ("magnetorque" in hex)
+TAG = "6d61676e-746f-7271-7565-"
+
+PARENTHESES = re.compile(rb"[()]")
+
+
+def find_injection(board: mmap.mmap) -> tuple:
+    '''
+    Finds where to inject a spiral into a board file: just before its final
+    closing parenthesis, or in place of a previously injected spiral
+    that's still between its markers. Only the end of the file and
+    the previous spiral are scanned.
+
+    Parameters:
+        board (mmap): The contents of a *.kicad_pcb file
+
+    Returns:
+        start (int): Offset of the first byte to replace
+        end (int): Offset of the final closing parenthesis
+    '''
+    end = board.rfind(b")")
+    if end < 0 or board[end + 1:].strip():
+        raise ValueError("The board doesn't end with a closing parenthesis")
+
+    # Last character before the final parenthesis, skipping whitespace
+    last = end - 1
+    while last >= 0 and board[last:last + 1].isspace():
+        last -= 1
+
+    marker = END_MARKER.rstrip()
+    if board[last - len(marker) + 1:last + 1] == marker:
+        start = board.rfind(BEGIN_MARKER, 0, last)
+        if start >= 0:
+            return start, end
+
+    return last + 1, end
+
+
+def find_tagged_segments(board: mmap.mmap, stop: int) -> list:
+    '''
+    Finds the segments of a previous injection by their TAG timestamps,
+    wherever KiCad moved them when it saved the board.
+
+    Parameters:
+        board (mmap): The contents of a *.kicad_pcb file
+        stop (int): Offset to search up to
+
+    Returns:
+        - (start, end) offsets of every tagged segment, with the
+          indentation and line break around it, in order
+    '''
+    spans = []
+    tag = TAG.encode()
+    position = board.find(tag, 0, stop)
+    while position >= 0:
+        start = board.rfind(b"(segment", 0, position)
+        if start < 0:
+            raise ValueError("A magnetorquer timestamp is outside of any segment")
+
+        # Just past the segment's closing parenthesis
+        depth = 0
+        for parenthesis in PARENTHESES.finditer(board, start, stop):
+            depth += 1 if parenthesis.group() == b"(" else -1
+            if depth == 0:
+                end = parenthesis.end()
+                break
+        else:
+            raise ValueError("A magnetorquer segment isn't closed")
+
+        # Take the whole lines if the segment is alone on them
+        while start > 0 and board[start - 1:start] in (b" ", b"\t"):
+            start -= 1
+        if (start == 0 or board[start - 1:start] == b"\n") and board[end:end + 1] == b"\n":
+            end += 1
+
+        spans.append((start, end))
+        position = board.find(tag, end, stop)
+    return spans
+
+
+def inject_layers(layers, board, constraints: Constraints = None) -> int:
     '''
+    Writes a spiral with its own spacing and coil count on every layer
+    straight into a *.kicad_pcb file, replacing the spiral injected
+    by a previous call.
+
+    The spiral is written between marker comments, with a TAG timestamp on
+    every segment. While the markers are there, the file is only rewritten
+    from where the spiral starts, so the time taken doesn't depend on the
+    size of the board. Once KiCad has saved the board, the markers are
+    gone, and the old segments are found by their timestamps instead.
+
+    Parameters:
+        layers: A (spacing in mm, number of coils) pair per layer, front to back
+        board (str or Path): The *.kicad_pcb file
+        constraints: config.ini by default
+
+    Returns:
+        - The number of segments written
+    '''
+    with open(board, "r+b") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            start, end = find_injection(contents)
+            spans = []
+            if contents[start:start + len(BEGIN_MARKER)] != BEGIN_MARKER:
+                spans = find_tagged_segments(contents, start)
+
+            # Rewrite from the first old segment, keeping what's between the old segments
+            bounds = [offset for span in spans for offset in span] + [start]
+            kept = b"".join(contents[a:b] for a, b in zip(bounds[1::2], bounds[2::2]))
+            start = bounds[0]
+            before = kept[-1:] if kept else contents[start - 1:start]
+            newline = before in (b"", b"\n")
+            tail = contents[end:]
+
+        f.seek(start)
+        f.write(kept)
+        text = io.TextIOWrapper(f, encoding="utf-8", newline="\n")
+        text.write(("" if newline else "\n") + BEGIN_MARKER.decode())
+        segments = write_layers(layers, text, constraints, tagged=True)
+        text.write(END_MARKER.decode())
+        text.flush()
+        text.detach()
+
+        f.write(tail)
+        f.truncate()
+
+    return segments
+
+
+class TestKiCadSquare(unittest.TestCase):
+
+    def baseline(self, layers, constraints):
+        # The original writer, one get_segment() call per segment
+        out = ""
+        for layer, (spacing, num_of_coils) in enumerate(layers):
+            width = spacing - constraints.gap_between_traces
+            for i in range(num_of_coils):
+                radius = constraints.outer_radius - i * spacing
+                a = (-spacing-radius, -radius)
+                b = (radius, -radius)
+                c = (radius, radius)
+                d = (-radius, radius)
+                e = (-radius, spacing-radius)
+                for start, end in ((a, b), (b, c), (c, d), (d, e)):
+                    out += get_segment(*start, *end, width, layer, layer % 2 == 1, constraints)
+        return out
+
+    def test_matches_baseline(self):
+        for number_of_layers in (2, 4, 7):
+            c = default_constraints().replace(number_of_layers=number_of_layers, OuterRadius=37.5)
+            layers = get_magnetorquer_layers(0.3697436810646262, 77, 0.596482756074957, 46, c)
+            text = io.StringIO()
+            self.assertEqual(write_layers(layers, text, c), 4 * sum(n for _, n in layers))
+            self.assertEqual(text.getvalue(), self.baseline(layers, c))
+
+    def test_get_spiral(self):
+        # One layer at a time, in the orientation of its layer
+        c = default_constraints().replace(number_of_layers=5)
+        layers = get_magnetorquer_layers(0.5, 10, 0.4, 12, c)
+        text = io.StringIO()
+        write_layers(layers, text, c)
+        spirals = [get_spiral(spacing, n, spacing - c.gap_between_traces, i, c)
+                   for i, (spacing, n) in enumerate(layers)]
+        self.assertEqual("".join(spirals), text.getvalue())
+        self.assertNotEqual(spirals[1], spirals[2].replace("In2.Cu", "In1.Cu"))
+
+        # Spirals follow the given outer radius
+        small = c.replace(OuterRadius=20)
+        segments, _ = get_segments([(0.5, 10)], small)
+        self.assertEqual(get_spiral(0.5, 10, 0.3, 0, small),
+                         format_segments(segments, 0.3).replace(LAYER, "F.Cu"))
 
-    exterior_width = exterior_spacing - config.getfloat("GapBetweenTraces")
-    interior_width = interior_spacing - config.getfloat("GapBetweenTraces")
+    board = (
+        "(kicad_pcb (version 20221018) (generator pcbnew)\n"
+        "  (net 0 \"\")\n"
+        "  (segment (start 1 2) (end 3 4) (width 0.25) (layer \"F.Cu\") (net 0) (tstamp 1b3c9a40-0000-4000-8000-000000000001))\n"
+        ")\n"
+    )
 
-    num_of_layers = config.getint('NumberOfLayers')
+    def inject(self, path, layers, c):
+        count = inject_layers(layers, path, c)
+        with open(path) as f:
+            text = f.read()
+        self.assertEqual(count, 4 * sum(n for _, n in layers))
+        self.assertEqual(text.count(TAG), count)
+        self.assertEqual(text.count("(segment"), count + 1)
+        self.assertIn("1b3c9a40-0000-4000-8000-000000000001", text)
+        self.assertTrue(text.startswith(self.board[:self.board.index("  (segment")]))
+        self.assertTrue(text.endswith(")\n"))
+        return text
 
-    out = ""
+    def test_inject(self):
+        c = default_constraints().replace(number_of_layers=4)
+        first = [(0.5, 10), (0.4, 12), (0.4, 12), (0.5, 10)]
+        second = [(0.6, 8), (0.5, 9), (0.5, 9), (0.6, 8)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory, "board.kicad_pcb")
+            path.write_text(self.board)
 
-    out += get_spiral(exterior_spacing,
-                      exterior_num_of_coils, exterior_width, 0)
-    for i in range(num_of_layers-2):
-        out += get_spiral(interior_spacing,
-                          interior_num_of_coils, interior_width, i+1)
+            text = self.inject(path, first, c)
+            segments = io.StringIO()
+            write_layers(first, segments, c, tagged=True)
+            self.assertEqual(text, self.board[:-2] + BEGIN_MARKER.decode() + segments.getvalue()
+                             + END_MARKER.decode() + ")\n")
+            self.assertIn("(layer In1.Cu) (net 0) (tstamp 6d61676e-746f-7271-7565-000100000002))\n", text)
 
-    out += get_spiral(exterior_spacing, exterior_num_of_coils,
-                      exterior_width, num_of_layers-1)
+            # Injecting again replaces the spiral between the markers
+            self.inject(path, second, c)
 
-    p = Path(__file__).with_name('KiCad_spiral.txt')
-    f = open(p, "w")
-    f.write(out)
-    f.close()
+            # KiCad drops the comments when it saves, writes timestamps as uuids,
+            # may split segments over lines and adds items after them
+            text = path.read_text()
+            text = text.replace(BEGIN_MARKER.decode(), "").replace(END_MARKER.decode(), "")
+            text = text.replace("(tstamp ", "(uuid ")
+            first_segment = text.index("(segment (start", text.index(TAG) - 200)
+            text = text[:first_segment] + text[first_segment:].replace(") (", ")\n    (", 6)
+            text = text[:-2] + "  (zone (net 0) (layer \"F.Cu\"))\n)\n"
+            path.write_text(text)
 
-    print("Saved optimal spiral in KiCad_spiral.txt")
-    print("Paste its entire content just before the final closing parantheses of your *.kicad_pcb file")
-    print("Save the file, and open KiCad. Your spiral should appear in the PCB editor.")
-    print("Be sure to add through-vias connecting the different spiral layers.")
+            text = self.inject(path, first, c)
+            self.assertIn("(zone (net 0)", text)
+            self.assertLess(text.index("(zone"), text.index(BEGIN_MARKER.decode()))
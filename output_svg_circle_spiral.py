@@ -41,13 +41,14 @@ def curve(handle, endpoint):
     return "Q {:.4f} {:.4f}, {:.4f} {:.4f}\n".format(handle.x, handle.y, endpoint.x, endpoint.y)
 
 
-#Draw an svg spiral and save it to the current directory
-def save_curve_svg(outer_radius, spacing, num_of_coils, stroke_width):
+#Draw an svg spiral and save it to the given path (spiral.svg in the current directory by default),
+#with one curve per step radians of the spiral
+def save_curve_svg(outer_radius, spacing, num_of_coils, stroke_width, path=None, step=math.pi/4):
     a = outer_radius
     b = spacing / (2 * math.pi)
     theta = num_of_coils * 2*math.pi
 
-    p = Path(__file__).with_name('spiral.svg')
+    p = path or Path(__file__).with_name('spiral.svg')
     f = open(p, "w")
     f.write('''<svg
         width = "{0:.4f}cm"
@@ -63,7 +64,7 @@ def save_curve_svg(outer_radius, spacing, num_of_coils, stroke_width):
     p1 = get_cartesian_coords(a, b, 0)
     f.write("M {:.4f} {:.4f}\n".format(p1.x, p1.y))
 
-    for theta in np.arange(math.pi/4, theta, math.pi/4):
+    for theta in np.arange(step, theta, step):
         m2 = get_cartesian_slope(a, b, theta)
         p2 = get_cartesian_coords(a, b, theta)
         i = find_intersection(m1, p1, m2, p2)
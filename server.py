@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from helper_conversions import Constraints
+
+'''
+Persistent design server, so scripts that need many magnetorquers don't
+pay for starting Python, importing scipy and parsing config.ini every time.
+
+Example:
+    python server.py --socket /tmp/magnetorquer.sock
+    python server.py --port 8765
+
+Clients send one JSON request per line and get one JSON response per line.
+A request lists the constraints that differ from config.ini (by config.ini
+or field name), and whether to return the KiCad text too:
+
+    {"id": 1, "constraints": {"Resistance": 50, "NumberOfLayers": 6}, "kicad": true}
+
+The response echoes the id, with get_optimal_design() under "result"
+(and the KiCad text under "kicad"), or a message under "error":
+
+    {"id": 1, "result": {"total_area_sum": ...}, "kicad": "(segment ..."}
+
+{"id": 2, "stats": true} returns the server's counters instead.
+Requests on one connection are answered as they finish, not in order.
+
+Designs are calculated on a pool of worker processes. Identical requests
+that arrive while one is being calculated wait for that calculation,
+and finished designs are kept in an LRU cache.
+'''
+
+
+def design(constraints: Constraints, kicad: bool) -> dict:
+    '''
+    Calculates one response in a worker process.
+
+    Returns:
+        - Dictionary with get_optimal_design() under "result",
+          and the KiCad text under "kicad" if asked for
+    '''
+    # Only workers need the solvers, so clients using query() start quickly
+    import main
+    import output_KiCad_square_spiral
+
+    response = {"result": main.get_optimal_design(constraints)}
+    if kicad:
+        text = io.StringIO()
+        output_KiCad_square_spiral.write_layers(
+            main.get_kicad_layers(constraints), text, constraints)
+        response["kicad"] = text.getvalue()
+    return response
+
+
+class DesignServer:
+    '''
+    Answers design requests on a worker pool, coalescing identical
+    in-flight requests and caching finished ones.
+    '''
+
+    def __init__(self, workers: int = None, cache_size: int = 1024, base: Constraints = None):
+        self.base = base or Constraints.from_config()
+        self.executor = ProcessPoolExecutor(workers)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.stats = {"requests": 0, "cache_hits": 0, "coalesced": 0, "calculated": 0, "errors": 0}
+
+    def parse(self, request: dict) -> tuple:
+        '''
+        Returns: The request's constraints, and whether it asks for KiCad text
+
+        Raises:
+            ValueError: The request has an unknown or invalid constraint
+        '''
+        changes = dict(request.get("constraints", {}))
+        try:
+            constraints = self.base.replace(**changes)
+        except TypeError as e:
+            raise ValueError(f"Unknown constraint in {sorted(changes)}") from e
+        return constraints, bool(request.get("kicad", False))
+
+    async def get(self, constraints: Constraints, kicad: bool) -> dict:
+        '''
+        Returns: The response to a design request, from the cache,
+                 a calculation already in flight, or a new calculation
+        '''
+        key = (constraints.key(), kicad)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats["cache_hits"] += 1
+            return self.cache[key]
+
+        if key in self.in_flight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, design, constraints, kicad)
+        self.in_flight[key] = future
+        try:
+            response = await asyncio.shield(future)
+        finally:
+            del self.in_flight[key]
+        self.stats["calculated"] += 1
+
+        self.cache[key] = response
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return response
+
+    async def answer(self, line: bytes) -> dict:
+        '''
+        Returns: The response to one line of a client
+        '''
+        self.stats["requests"] += 1
+        request = {}
+        try:
+            parsed = json.loads(line)
+            if not isinstance(parsed, dict):
+                raise ValueError("A request must be a JSON object")
+            request = parsed
+            if request.get("stats"):
+                return {"id": request.get("id"), "stats": dict(self.stats)}
+            response = await self.get(*self.parse(request))
+            return {"id": request.get("id"), **response}
+        except Exception as e:
+            self.stats["errors"] += 1
+            return {"id": request.get("id"), "error": f"{type(e).__name__}: {e}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''
+        Serves one client connection until it closes.
+        '''
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def reply(line):
+            response = await self.answer(line)
+            async with lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    task = asyncio.create_task(reply(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path: str = None, host: str = "127.0.0.1", port: int = None):
+        '''
+        Serves clients on a Unix socket at path, or on TCP at host:port,
+        until cancelled or the process gets SIGINT or SIGTERM.
+        '''
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.handle, path, limit=1 << 24)
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=1 << 24)
+
+        # Stop cleanly on SIGTERM as well as Ctrl+C
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        for number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(number, task.cancel)
+
+        address = path or "{}:{}".format(*server.sockets[0].getsockname()[:2])
+        print(f"Serving magnetorquer designs on {address}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+def query(requests: list, path: str = None, host: str = "127.0.0.1", port: int = None) -> list:
+    '''
+    Sends requests to a running server and waits for all of their responses.
+
+    Parameters:
+        requests (list): Request dictionaries, numbered by their position if they have no id
+        path (str): Unix socket of the server
+        host, port: TCP address of the server, if there's no path
+
+    Returns:
+        - Response dictionaries, in the order of the requests
+    '''
+    async def send():
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path, limit=1 << 24)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=1 << 24)
+
+        numbered = [{"id": i, **request} for i, request in enumerate(requests)]
+        writer.writelines(json.dumps(request).encode() + b"\n" for request in numbered)
+        await writer.drain()
+
+        responses = {}
+        while len(responses) < len(numbered):
+            response = json.loads(await reader.readline())
+            responses[json.dumps(response.get("id"))] = response
+        writer.close()
+        await writer.wait_closed()
+        return [responses[json.dumps(request["id"])] for request in numbered]
+
+    return asyncio.run(send())
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.server = DesignServer(workers=1, cache_size=2)
+        self.server.executor.shutdown()
+        self.server.executor = ThreadPoolExecutor(4)
+        self.calls = []
+        self.release = threading.Event()
+
+        def design(constraints, kicad):
+            self.calls.append((constraints.resistance, kicad))
+            self.release.wait(10)
+            return {"result": {"resistance": constraints.resistance}}
+
+        patch = unittest.mock.patch(f"{__name__}.design", design)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.server.executor.shutdown)
+
+    async def test_bad_requests(self):
+        self.release.set()
+        lines = [b"[1, 2]", b'"design"', b"3", b"null", b"{not json",
+                 b'{"id": 7, "constraints": {"NoSuchConstraint": 1}}',
+                 b'{"id": 8, "constraints": [1]}']
+        for line in lines:
+            response = await self.server.answer(line)
+            self.assertEqual(set(response), {"id", "error"})
+        self.assertEqual(response["id"], 8)
+        self.assertIn("JSON object", (await self.server.answer(b"[]"))["error"])
+        self.assertIn("NoSuchConstraint", (await self.server.answer(lines[5]))["error"])
+        self.assertEqual(self.server.stats["errors"], len(lines) + 2)
+        self.assertEqual(self.calls, [])
+
+        # The server still answers afterwards
+        response = await self.server.answer(b'{"id": 9, "constraints": {"Resistance": 10}}')
+        self.assertEqual(response, {"id": 9, "result": {"resistance": 10}})
+
+    async def test_coalescing(self):
+        lines = [json.dumps({"id": i, "constraints": {"Resistance": 10}}).encode() for i in range(3)]
+        lines.append(b'{"id": 3, "constraints": {"Resistance": 10}, "kicad": true}')
+        tasks = [asyncio.create_task(self.server.answer(line)) for line in lines]
+        while len(self.calls) < 2:
+            await asyncio.sleep(0.01)
+        self.assertEqual(len(self.server.in_flight), 2)
+        self.release.set()
+
+        responses = await asyncio.gather(*tasks)
+        self.assertEqual([r["id"] for r in responses], [0, 1, 2, 3])
+        self.assertEqual(sorted(self.calls), [(10, False), (10, True)])
+        self.assertEqual(self.server.in_flight, {})
+        self.assertEqual(self.server.stats["coalesced"], 2)
+        self.assertEqual(self.server.stats["calculated"], 2)
+
+    async def test_cache(self):
+        self.release.set()
+        first = await self.server.answer(b'{"id": 1, "constraints": {"Resistance": 10}}')
+        # The same constraints by field name
+        second = await self.server.answer(b'{"id": 2, "constraints": {"resistance": 10}}')
+        self.assertEqual(second, {**first, "id": 2})
+        self.assertEqual((self.server.stats["cache_hits"], len(self.calls)), (1, 1))
+
+        # The least recently used design is evicted
+        await self.server.answer(b'{"constraints": {"Resistance": 20}}')
+        await self.server.answer(b'{"constraints": {"Resistance": 10}}')
+        await self.server.answer(b'{"constraints": {"Resistance": 30}}')
+        await self.server.answer(b'{"constraints": {"Resistance": 10}}')
+        await self.server.answer(b'{"constraints": {"Resistance": 20}}')
+        self.assertEqual(self.calls, [(10, False), (20, False), (30, False), (20, False)])
+        self.assertEqual(len(self.server.cache), 2)
+
+        stats = await self.server.answer(b'{"id": "s", "stats": true}')
+        self.assertEqual(stats["stats"], {"requests": 8, "cache_hits": 3, "coalesced": 0,
+                                          "calculated": 4, "errors": 0})
+
+
+class TestServerProcesses(unittest.TestCase):
+
+    def test_query(self):
+        # A real design on a worker process, through a Unix socket
+        import main
+
+        async def serve_and_query(path):
+            serving = asyncio.create_task(DesignServer(workers=1).serve(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            responses = await asyncio.to_thread(
+                query, [{"constraints": {"Resistance": 20}, "kicad": True}, {"stats": True}], path)
+            serving.cancel()
+            await serving
+            return responses
+
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch("sys.stderr", io.StringIO()):
+            design, stats = asyncio.run(serve_and_query(os.path.join(directory, "server.sock")))
+
+        expected = main.get_optimal_design(Constraints.from_config().replace(Resistance=20))
+        self.assertEqual(design["id"], 0)
+        self.assertEqual(design["result"], json.loads(json.dumps(expected)))
+        self.assertTrue(design["kicad"].startswith("(segment"))
+        # Answered while the design is still being calculated
+        self.assertEqual(stats["id"], 1)
+        self.assertEqual((stats["stats"]["requests"], stats["stats"]["errors"]), (2, 0))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serves optimal magnetorquer designs")
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--socket", metavar="PATH", help="Listen on this Unix socket")
+    address.add_argument("--port", type=int, help="Listen on this localhost TCP port")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on with --port")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (all CPU cores by default)")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="Number of finished designs to keep")
+    args = parser.parse_args()
+
+    server = DesignServer(args.workers, args.cache_size)
+    asyncio.run(server.serve(args.socket, args.host, args.port))
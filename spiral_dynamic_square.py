@@ -1,21 +1,18 @@
+import functools
 import math
-from scipy import optimize
-from pathlib import Path
-from configparser import ConfigParser
+import os
+import unittest
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from helper_conversions import *
-from output_KiCad_dynamic_spiral import SpiralShape
+from helper_cache import memoize, SPIRAL_FIELDS
+from helper_instrumentation import instrument, count
 
 '''
 EXPERIMENTAL
 Functions that define a variable trace width square spiral
 '''
 
-# Read configuration
-config = ConfigParser()
-config.read(Path(__file__).with_name('config.ini'))
-config = config['Configuration']
-
-
 # Different functions that relate radius to spacing
 
 def radius_proportional(multiplier, radius):
@@ -25,10 +22,12 @@ def radius_proportional(multiplier, radius):
     return width
 
 
-def spacing_proportional_to_radius(multiplier, radius):
+def spacing_proportional_to_radius(multiplier, radius, constraints: Constraints = None):
 
     # Returns radius (mm), ohms_per_mm
-    width = multiplier / radius**1 - config.getfloat("GapBetweenTraces")
+    # Bind other constraints with functools.partial(..., constraints=c)
+    constraints = constraints or default_constraints()
+    width = multiplier / radius**1 - constraints.gap_between_traces
     return width
 
 
@@ -38,6 +37,10 @@ def constant(multiplier, radius):
 
 def real_radius_proportional(multiplier, radius):
 
+    if isinstance(radius, np.ndarray):
+        return np.where(radius**2 <= 2 * multiplier, radius,
+                        radius - np.sqrt(np.maximum(radius**2 - 2*multiplier, 0)))
+
     if radius**2 <= 2 * multiplier:
         width = radius
     else:
@@ -45,19 +48,99 @@ def real_radius_proportional(multiplier, radius):
 
     return width
 
+class PiecewiseLinearWidth:
+    '''
+    Width law whose width is the multiplier times a piecewise linear
+    profile of radius, through the given relative widths at evenly spaced
+    radii from INNER_RADIUS to the outer radius. Unlike the functions
+    above, it can be pickled with its parameters and sent to other processes.
+    '''
+
+    def __init__(self, relative_widths, outer_radius):
+        self.relative_widths = tuple(float(w) for w in relative_widths)
+        self.outer_radius = float(outer_radius)
+        self.radii = tuple(np.linspace(INNER_RADIUS, outer_radius, len(self.relative_widths)))
+        self._step = self.radii[1] - self.radii[0]
+
+    def __repr__(self):
+        return f"PiecewiseLinearWidth({list(self.relative_widths)!r}, {self.outer_radius!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, PiecewiseLinearWidth) and repr(self) == repr(other)
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def __call__(self, multiplier, radius):
+
+        if isinstance(radius, np.ndarray):
+            return multiplier * np.interp(radius, self.radii, self.relative_widths)
+
+        # Clamped to the first and last knots, like np.interp
+        widths = self.relative_widths
+        position = (radius - INNER_RADIUS) / self._step
+        if position <= 0:
+            return multiplier * widths[0]
+        i = int(position)
+        if i >= len(widths) - 1:
+            return multiplier * widths[-1]
+        fraction = position - i
+        return multiplier * (widths[i] + fraction * (widths[i + 1] - widths[i]))
+
+
+def get_shape(radii, outer_radius):
+    '''
+    Builds the shape of a spiral from the radii of its coils.
+
+    Parameters:
+        radii (array): (coils, 4) array of the previous, current and next
+                       coil's radius, and the current trace width (in mm)
+        outer_radius (float): The outer radius (in mm) of the spiral
+
+    Returns:
+        - SpiralShape with corners a to e of every coil
+    '''
+    from output_KiCad_dynamic_spiral import SpiralShape
+
+    prev_r, current_r, next_r, width = radii.T
+    low = outer_radius - current_r
+    high = outer_radius + current_r
+
+    corners = np.stack([
+        (outer_radius - prev_r, low),   # a
+        (high, low),                    # b
+        (high, high),                   # c
+        (low, high),                    # d
+        (low, outer_radius - next_r),   # e
+    ])
+
+    # (corner, x or y, coil) to (coil, corner, x or y)
+    return SpiralShape.from_corners(corners.transpose(2, 0, 1), width)
+
+
 # Actual program
 
 
-def spiral(trace_width_multiplier, trace_width_func, exterior, return_shape=False):
+# Radius (in mm) at which every spiral stops
+INNER_RADIUS = 5
+
+
+def spiral(trace_width_multiplier, trace_width_func, exterior, return_shape=False,
+           constraints: Constraints = None):
 
     # Note: Starts on the outside, and spirals inwards
 
-    inner_radius = 5
-    outer_radius = config.getfloat("OuterRadius")
-    gap = config.getfloat("GapBetweenTraces")
+    constraints = constraints or default_constraints()
+
+    inner_radius = INNER_RADIUS
+    outer_radius = constraints.outer_radius
+    gap = constraints.gap_between_traces
+    # get_ohms_per_mm() without the per-coil lookups
+    resistivity_ratio = constraints.resistivity_ratio(exterior)
+    nan = float("nan")
 
     if return_shape:
-        shape = SpiralShape()
+        radii = []
 
     area_sum = 0
     ohms = 0
@@ -76,17 +159,12 @@ def spiral(trace_width_multiplier, trace_width_func, exterior, return_shape=Fals
 
         length = 6*current_r + prev_r + next_r
         area_sum += 0.5 * length * current_r
-        ohms += get_ohms_per_mm(current_width, exterior) * length
+        ohms += (resistivity_ratio / current_width if current_width > 0 else nan) * length
         coils += 1
 
         # Drawing
         if return_shape:
-            a = (outer_radius - prev_r, outer_radius - current_r)
-            b = (outer_radius + current_r, outer_radius - current_r)
-            c = (outer_radius + current_r, outer_radius + current_r)
-            d = (outer_radius - current_r, outer_radius + current_r)
-            e = (outer_radius - current_r, outer_radius - next_r)
-            shape.add_coil(current_width, a, b, c, d, e)
+            radii += (prev_r, current_r, next_r, current_width)
 
         prev_r = current_r
         current_r = next_r
@@ -95,15 +173,437 @@ def spiral(trace_width_multiplier, trace_width_func, exterior, return_shape=Fals
     area_sum_m = area_sum * 1e-6
 
     if return_shape:
-        return shape
+        return get_shape(np.array(radii).reshape(-1, 4), outer_radius)
     else:
         return area_sum_m, ohms, coils
 
 
-def spiral_of_resistance(ohms, exterior, trace_width_func=real_radius_proportional, return_shape=False):
-
-    def func(trace_width_multiplier):
-        return spiral(trace_width_multiplier, trace_width_func, exterior)[1] - ohms
-
-    trace_width_multiplier = optimize.brentq(func, 1e-6, 1e6)
-    return spiral(trace_width_multiplier, trace_width_func, exterior, return_shape=return_shape)
+def spiral_vectorized(trace_width_multiplier, trace_width_func, exterior,
+                      constraints: Constraints = None):
+    '''
+    Version of spiral() that walks the spirals of an array of multipliers
+    in lockstep, one coil per step, dropping spirals as they end.
+    trace_width_func must accept arrays.
+
+    Returns (arrays shaped like trace_width_multiplier):
+        area_sum, ohms, coils
+    '''
+    constraints = constraints or default_constraints()
+    outer_radius = constraints.outer_radius
+    gap = constraints.gap_between_traces
+    resistivity_ratio = constraints.resistivity_ratio(exterior)
+
+    multiplier = np.asarray(trace_width_multiplier, dtype=float)
+    shape = multiplier.shape
+    size = multiplier.size
+
+    area_sum = np.zeros(size)
+    ohms = np.zeros(size)
+    coils = np.zeros(size, dtype=int)
+
+    # Rows of the spirals that haven't ended: index, multiplier, previous
+    # and current radius, current width, area-sum and ohms so far
+    state = np.zeros((7, size))
+    state[0] = np.arange(size)
+    state[1] = multiplier.ravel()
+    state[2:4] = outer_radius
+    state[4] = trace_width_func(state[1], state[3])
+    index, m, prev_r, current_r, current_width, walk_area_sum, walk_ohms = state
+    walk_coils = 0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        while True:
+            # Store the spirals that ended
+            ended = ~(current_r + 0.5 * current_width > INNER_RADIUS)
+            if ended.any():
+                i = index[ended].astype(int)
+                area_sum[i] = walk_area_sum[ended]
+                ohms[i] = walk_ohms[ended]
+                coils[i] = walk_coils
+                state = state[:, ~ended]
+                if not state.shape[1]:
+                    break
+                index, m, prev_r, current_r, current_width, walk_area_sum, walk_ohms = state
+
+            next_r = current_r - 0.5 * current_width - gap
+            next_width = trace_width_func(m, next_r)
+            next_r -= 0.5 * next_width
+
+            length = 6*current_r + prev_r + next_r
+            walk_area_sum += 0.5 * length * current_r
+            walk_ohms += np.where(current_width > 0, resistivity_ratio / current_width, np.nan) * length
+            walk_coils += 1
+
+            prev_r[:] = current_r
+            current_r[:] = next_r
+            current_width[:] = next_width
+
+    return (area_sum * 1e-6).reshape(shape), ohms.reshape(shape), coils.reshape(shape)
+
+
+def multiplier_of_width(trace_width_func, width, radius):
+    '''
+    Returns: The multiplier that gives the trace width at the radius,
+             or None if no multiplier between 1e-12 and 1e12 does
+    '''
+    from scipy import optimize
+
+    def excess_width(log_multiplier):
+        return trace_width_func(math.exp(log_multiplier), radius) - width
+
+    bounds = math.log(1e-12), math.log(1e12)
+    if excess_width(bounds[0]) * excess_width(bounds[1]) > 0:
+        return None
+    return math.exp(optimize.brentq(excess_width, *bounds, xtol=1e-3))
+
+
+def multiplier_bounds(ohms, exterior, trace_width_func=real_radius_proportional,
+                      constraints: Constraints = None):
+    '''
+    Brackets the multiplier of the spiral with the given resistance using the
+    width of its outermost coil. The first coil is more than 7 * outer radius
+    long, so it alone has more than the resistance when it's narrower than
+    7 * outer radius * ohms per square / resistance. The widest the first
+    coil can be is the whole distance to the inner radius.
+
+    Returns:
+        - (lower, upper) multipliers, or (1e-6, 1e6) if the width law can't give those widths
+    '''
+    constraints = constraints or default_constraints()
+    outer_radius = constraints.outer_radius
+    ratio = constraints.resistivity_ratio(exterior)
+
+    narrowest = 7 * outer_radius * ratio / ohms
+    widest = outer_radius - INNER_RADIUS
+    if narrowest < widest:
+        lower = multiplier_of_width(trace_width_func, narrowest, outer_radius)
+        upper = multiplier_of_width(trace_width_func, widest, outer_radius)
+        if lower is not None and upper is not None:
+            return lower, upper
+    return 1e-6, 1e6
+
+
+def _log_excess(walk_ohms, ohms):
+    # log(walk_ohms / ohms). Traces of no width (NaN) count as infinitely
+    # resistive, and spirals that overshoot the center (negative) as short circuits
+    walk_ohms = np.asarray(walk_ohms, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        excess = np.where(walk_ohms > 0, np.log(walk_ohms / ohms), -np.inf)
+    return np.where(np.isnan(walk_ohms), np.inf, excess)[()]
+
+
+@memoize(SPIRAL_FIELDS)
+@instrument()
+def solve(ohms, exterior, trace_width_func=real_radius_proportional,
+          constraints: Constraints = None):
+    '''
+    Finds the trace width multiplier of the spiral with the given resistance.
+
+    Resistance is close to inversely proportional to the multiplier, so
+    log(resistance) is close to linear in log(multiplier). Starting in the
+    middle of multiplier_bounds(), steps that assume exactly that bracket
+    the answer next to it, and Brent's method finishes in log-log space.
+    Every walk is kept, so the endpoints and the answer are walked once.
+
+    Returns:
+        multiplier (float): The trace width multiplier
+        spiral (tuple): spiral() of that multiplier
+    '''
+    from scipy import optimize
+
+    constraints = constraints or default_constraints()
+    walks = {}
+
+    def excess(log_multiplier):
+        if log_multiplier not in walks:
+            walks[log_multiplier] = spiral(math.exp(log_multiplier), trace_width_func, exterior,
+                                           constraints=constraints)
+        return _log_excess(walks[log_multiplier][1], ohms)
+
+    lo, hi = (math.log(m) for m in multiplier_bounds(ohms, exterior, trace_width_func, constraints))
+    bracketed_lo = bracketed_hi = False
+    t = 0.5 * (lo + hi)
+    while not (bracketed_lo and bracketed_hi):
+        f = excess(t)
+        if f >= 0:
+            lo, bracketed_lo = t, True
+        else:
+            hi, bracketed_hi = t, True
+        # Overshoot a little so the next step lands on the other side
+        t = min(max(t + 1.1 * f, lo), hi)
+        if t in walks:
+            # Stuck on a bound: let brentq check it
+            break
+
+    log_multiplier, result = optimize.brentq(excess, lo, hi, full_output=True,
+                                             xtol=constraints.tolerances.multiplier_xtol)
+    excess(log_multiplier)
+    count(len(walks), result.iterations)
+
+    return math.exp(log_multiplier), walks[log_multiplier]
+
+
+def trace_width_multiplier(ohms, exterior, trace_width_func=real_radius_proportional,
+                           constraints: Constraints = None):
+
+    return solve(ohms, exterior, trace_width_func, constraints)[0]
+
+
+def spiral_of_resistance(ohms, exterior, trace_width_func=real_radius_proportional, return_shape=False,
+                         constraints: Constraints = None):
+
+    multiplier, walk = solve(ohms, exterior, trace_width_func, constraints)
+    if not return_shape:
+        return walk
+    return spiral(multiplier, trace_width_func, exterior, return_shape=True,
+                  constraints=constraints)
+
+
+@instrument()
+def trace_width_multiplier_vectorized(ohms, exterior, trace_width_func=real_radius_proportional,
+                                      constraints: Constraints = None,
+                                      candidates: int = 64, xtol: float = None,
+                                      max_iterations: int = 100, scalar_below: int = 8):
+    '''
+    Version of trace_width_multiplier() that accepts an array of resistances.
+
+    One vectorized walk over a geometric grid of candidate multipliers
+    between multiplier_bounds() brackets every resistance. Every bracket is then narrowed at once by
+    the Illinois variant of false position in log-log space, walking all
+    the candidates in lockstep, until only a few are left to finish one
+    at a time with Brent's method.
+
+    Parameters:
+        ohms (float or array): the desired resistances of the spirals
+        exterior (bool): whether the spirals are on an exterior layer
+        trace_width_func: width law, which must accept arrays
+        constraints (Constraints): config.ini by default
+        candidates (int): Number of multipliers in the bracketing grid
+        xtol (float): Stop once every bracket is this small (in log(multiplier)),
+                      by default from the constraints' precision
+        max_iterations (int): Maximum number of narrowing walks
+        scalar_below (int): Finish one at a time once this few are left
+
+    Returns:
+        multiplier (array): Multipliers shaped like ohms (NaN where none has the resistance)
+        spiral (tuple): spiral_vectorized() of those multipliers
+    '''
+    constraints = constraints or default_constraints()
+    xtol = xtol or constraints.tolerances.multiplier_xtol
+    ohms = np.asarray(ohms, dtype=float)
+    target = ohms.ravel()
+
+    def walk(log_multiplier):
+        return spiral_vectorized(np.exp(log_multiplier), trace_width_func, exterior, constraints)
+
+    # Resistance falls as the multiplier grows,
+    # so each answer is just before the first candidate below its resistance
+    lower = multiplier_bounds(np.max(target), exterior, trace_width_func, constraints)[0]
+    upper = multiplier_bounds(np.min(target), exterior, trace_width_func, constraints)[1]
+    grid = np.linspace(math.log(lower), math.log(upper), candidates)
+    excess = _log_excess(walk(grid)[1][:, np.newaxis], target)
+    above = excess >= 0
+    bracketed = above[0] & ~above[-1]
+    upper = np.where(bracketed, np.argmin(above, axis=0), 1)
+
+    columns = np.arange(target.size)
+    lo, hi = grid[upper - 1], grid[upper]
+    f_lo, f_hi = excess[upper - 1, columns], excess[upper, columns]
+    side = np.zeros(target.size)
+    iteration = 0
+
+    evaluations = target.size * candidates
+    with np.errstate(invalid="ignore"):
+        while iteration < max_iterations:
+            # Only walk the resistances that haven't converged
+            active = np.flatnonzero(hi - lo > xtol)
+            if active.size <= scalar_below:
+                break
+            iteration += 1
+            evaluations += active.size
+
+            a_lo, a_hi, af_lo, af_hi = lo[active], hi[active], f_lo[active], f_hi[active]
+            x = (a_lo * af_hi - a_hi * af_lo) / (af_hi - af_lo)
+            # Bisect wherever false position leaves the bracket
+            x = np.where((x > a_lo) & (x < a_hi), x, 0.5 * (a_lo + a_hi))
+            f = _log_excess(walk(x)[1], target[active])
+
+            # Illinois: halve the value kept at an end that didn't move twice in a row
+            moves_lo = f >= 0
+            stale = side[active]
+            af_hi = np.where(moves_lo & (stale > 0), 0.5 * af_hi, af_hi)
+            af_lo = np.where(~moves_lo & (stale < 0), 0.5 * af_lo, af_lo)
+            lo[active] = np.where(moves_lo, x, a_lo)
+            f_lo[active] = np.where(moves_lo, f, af_lo)
+            hi[active] = np.where(moves_lo, a_hi, x)
+            f_hi[active] = np.where(moves_lo, af_hi, f)
+            side[active] = np.where(moves_lo, 1, -1)
+
+    # The last few are usually bisecting across a jump in the number of coils,
+    # which is faster to finish one spiral at a time
+    from scipy import optimize
+    for i in np.flatnonzero(bracketed & (hi - lo > xtol)):
+        def excess_of(log_multiplier):
+            walk_ohms = spiral(math.exp(log_multiplier), trace_width_func, exterior,
+                               constraints=constraints)[1]
+            return _log_excess(walk_ohms, target[i])
+        lo[i], result = optimize.brentq(excess_of, lo[i], hi[i], xtol=xtol, full_output=True)
+        f_lo[i], hi[i] = 0, lo[i]
+        evaluations += result.function_calls
+
+    count(evaluations, iteration)
+    log_multiplier = np.where(np.abs(f_lo) < np.abs(f_hi), lo, hi)
+    multiplier = np.where(bracketed, np.exp(log_multiplier), np.nan)
+    spirals = spiral_vectorized(multiplier, trace_width_func, exterior, constraints)
+    return multiplier.reshape(ohms.shape), tuple(x.reshape(ohms.shape) for x in spirals)
+
+
+def spiral_of_resistance_vectorized(ohms, exterior, trace_width_func=real_radius_proportional,
+                                    constraints: Constraints = None):
+    '''
+    Version of spiral_of_resistance() that accepts an array of resistances.
+
+    Returns (arrays shaped like ohms):
+        area_sum, ohms, coils
+    '''
+    return trace_width_multiplier_vectorized(ohms, exterior, trace_width_func, constraints)[1]
+
+
+def _negative_area_sum(log_widths, ohms, exterior, constraints):
+    # Objective of optimize_width_profile(), at module level so it can be pickled
+    profile = PiecewiseLinearWidth(np.exp(np.append(log_widths, 0)), constraints.outer_radius)
+    try:
+        area_sum = solve.uncached(ohms, exterior, profile, constraints)[1][0]
+    except ValueError:
+        # No multiplier gives the resistance
+        return 0.0
+    return -area_sum if area_sum > 0 else 0.0
+
+
+@instrument()
+def optimize_width_profile(ohms, exterior, knots: int = 8, constraints: Constraints = None,
+                           workers: int = 1, max_generations: int = 200, seed=None,
+                           width_range: float = 20, start=real_radius_proportional):
+    '''
+    Finds the piecewise linear width profile that maximizes area-sum
+    at the given resistance.
+
+    The relative width at every knot but the outermost (which is 1, since
+    the multiplier sets the scale) is searched by differential evolution
+    over log(width). Every candidate profile is solved for the resistance,
+    and each generation's candidates are evaluated as a batch across
+    worker processes.
+
+    Parameters:
+        ohms (float): the desired resistance (in ohms) of the spiral
+        exterior (bool): whether the spiral is on an exterior layer
+        knots (int): Number of radii the profile's widths are set at
+        constraints (Constraints): config.ini by default
+        workers (int): Number of processes, -1 for every CPU core
+        max_generations (int): Maximum number of differential evolution generations
+        seed: Random seed, for reproducible searches
+        width_range (float): Largest ratio between a knot's width and the outermost width
+        start: Width law whose profile at the resistance joins the first generation
+
+    Returns:
+        profile (PiecewiseLinearWidth): The best width profile
+        multiplier (float): The multiplier that gives the resistance with that profile
+        spiral (tuple): spiral() of the profile at that multiplier
+    '''
+    from scipy import optimize
+
+    constraints = constraints or default_constraints()
+    limit = math.log(width_range)
+    dimensions = knots - 1
+    population = 15 * dimensions
+
+    # The start law's widths at the knots, relative to the outermost
+    radii = PiecewiseLinearWidth(np.ones(knots), constraints.outer_radius).radii
+    start_multiplier = trace_width_multiplier(ohms, exterior, start, constraints)
+    start_widths = np.array([start(start_multiplier, r) for r in radii])
+    x0 = np.clip(np.log(start_widths[:-1] / start_widths[-1]), -limit, limit)
+
+    def search(evaluate=1):
+        return optimize.differential_evolution(
+            _negative_area_sum,
+            bounds=[(-limit, limit)] * dimensions,
+            args=(ohms, exterior, constraints),
+            maxiter=max_generations,
+            popsize=15,
+            workers=evaluate,
+            updating="immediate" if evaluate == 1 else "deferred",
+            tol=constraints.tolerances.profile_tol,
+            polish=False,  # The area-sum jumps with the number of coils
+            seed=seed,
+            x0=x0,
+        )
+
+    if workers == 1:
+        result = search()
+    else:
+        workers = os.cpu_count() if workers == -1 else workers
+        # One batch of each generation's candidates per process
+        chunk_size = -(-population // workers)
+        with ProcessPoolExecutor(workers) as executor:
+            result = search(functools.partial(executor.map, chunksize=chunk_size))
+    count(result.nfev, result.nit)
+
+    profile = PiecewiseLinearWidth(np.exp(np.append(result.x, 0)), constraints.outer_radius)
+    multiplier, walk = solve(ohms, exterior, profile, constraints)
+    return profile, multiplier, walk
+
+
+class TestDynamicSquare(unittest.TestCase):
+
+    laws = [real_radius_proportional, constant,
+            PiecewiseLinearWidth([3, 0.5, 2, 1], default_constraints().outer_radius)]
+
+    def test_spiral_vectorized(self):
+        multipliers = np.geomspace(0.05, 50, 23).reshape(1, 23)
+        for law in self.laws:
+            for exterior in (True, False):
+                area_sum, ohms, coils = spiral_vectorized(multipliers, law, exterior)
+                self.assertEqual(area_sum.shape, multipliers.shape)
+                for i, m in enumerate(multipliers[0]):
+                    expected = spiral(m, law, exterior)
+                    np.testing.assert_allclose([area_sum[0, i], ohms[0, i]], expected[:2],
+                                               rtol=1e-12)
+                    self.assertEqual(coils[0, i], expected[2])
+
+    def test_trace_width_multiplier_vectorized(self):
+        c = default_constraints()
+        resistances = np.array([[0.5, 1, 2.5], [5, 10, 40]])
+        for law in self.laws:
+            for exterior in (True, False):
+                multipliers, (area_sum, ohms, coils) = trace_width_multiplier_vectorized(
+                    resistances, exterior, law, c)
+                self.assertEqual(multipliers.shape, resistances.shape)
+                for i in np.ndindex(resistances.shape):
+                    multiplier, expected = solve.uncached(resistances[i], exterior, law, c)
+                    self.assertAlmostEqual(math.log(multipliers[i]), math.log(multiplier),
+                                           delta=c.tolerances.multiplier_xtol)
+                    np.testing.assert_allclose([area_sum[i], ohms[i]], expected[:2], rtol=1e-9)
+                    self.assertEqual(coils[i], expected[2])
+
+    def test_spacing_proportional_to_radius(self):
+        c = default_constraints().replace(GapBetweenTraces=0.3)
+        law = functools.partial(spacing_proportional_to_radius, constraints=c)
+        self.assertAlmostEqual(law(10, 4), 2.5 - 0.3)
+        self.assertAlmostEqual(spacing_proportional_to_radius(10, 4),
+                               2.5 - default_constraints().gap_between_traces)
+
+    def test_optimize_width_profile(self):
+        c = default_constraints()
+        for exterior in (True, False):
+            # Starting from constant width, the search can only improve on it
+            profile, multiplier, walk = optimize_width_profile(
+                10, exterior, knots=4, constraints=c, max_generations=5, seed=1,
+                width_range=20, start=constant)
+            self.assertAlmostEqual(walk[1], 10, delta=1e-6)
+            self.assertGreaterEqual(walk[0], solve(10, exterior, constant, c)[1][0])
+
+            lower, upper = multiplier_bounds(10, exterior, profile, c)
+            self.assertTrue(lower <= multiplier <= upper)
+            self.assertEqual(len(profile.relative_widths), 4)
+            for width in profile.relative_widths:
+                self.assertTrue(1 / 20 <= width <= 20)
@@ -1,10 +1,9 @@
 import math
-from scipy import integrate
-from scipy import optimize
-from pathlib import Path
-from configparser import ConfigParser
+import numpy as np
 import unittest
 from helper_conversions import *
+from helper_cache import memoize, SPIRAL_FIELDS
+from helper_instrumentation import instrument, count
 
 '''
 EXPERIMENTAL
@@ -12,19 +11,17 @@ Functions that define a constant trace width circular spiral
 '''
 
 
-# Read configuration
-config = ConfigParser()
-config.read(Path(__file__).with_name('config.ini'))
-config = config['Configuration']
-
 #### ROUND FUNCTIONS ####
 
 
-def length_of_round_spiral(a: float, b: float, theta: float) -> float:
+def length_of_round_spiral(a, b, theta):
     '''
     Returns the length of a circular archimedean spiral.
     Proof: https://planetcalc.com/3707/
 
+    Closed form of the arc-length integral of sqrt((a - b*t)^2 + b^2),
+    so it also accepts NumPy arrays.
+
     Parameters:
         a (float): The outer radius of the spiral
         b (float): The decrease in radius per 1 radian of rotation
@@ -33,14 +30,29 @@ def length_of_round_spiral(a: float, b: float, theta: float) -> float:
     Returns:
         Length (float): The length of the spiral
     '''
-    return integrate.quad(lambda t: math.sqrt((a - b*t)**2 + b**2), 0, theta)[0]
+    a, b, theta = np.broadcast_arrays(*map(np.asarray, (a, b, theta)))
+
+    def antiderivative(u, b):
+        # Integral of sqrt(u^2 + b^2) du
+        root = np.sqrt(u**2 + b**2)
+        return 0.5 * (u * root + b**2 * np.arcsinh(u / b))
 
+    with np.errstate(invalid='ignore', divide='ignore'):
+        length = (antiderivative(a, b) - antiderivative(a - b*theta, b)) / b
 
-def area_sum_of_round_spiral(a: float, b: float, theta: float) -> float:
+    # b of 0 is a circle
+    length = np.where(b == 0, a * theta, length)
+    return length[()]
+
+
+def area_sum_of_round_spiral(a, b, theta):
     '''
     Returns the sum of coil areas of a circular archimedean spiral.
     All else constant, area-sum is proportional to magnetorquer torque.
 
+    Closed form of the integral of 0.5*(a - b*t)^2,
+    so it also accepts NumPy arrays.
+
     Parameters:
         a (float): The outer radius of the spiral
         b (float): The decrease in radius per 1 radian of rotation
@@ -49,11 +61,88 @@ def area_sum_of_round_spiral(a: float, b: float, theta: float) -> float:
     Returns:
         Area-sum (float): The area-sum of the spiral
     '''
-    return integrate.quad(lambda t: 0.5*(a - b*t)**2, 0, theta)[0]
+    theta = np.asarray(theta)
+    area_sum = 0.5 * (a**2 * theta - a * b * theta**2 + b**2 * theta**3 / 3)
+    return area_sum[()]
+
+
+def theta_from_length(a, b, length, tol=1e-12, max_iterations=50):
+    '''
+    Inverse of length_of_round_spiral(): finds the number of radians
+    that gives a spiral of the desired length. Works on whole arrays.
+
+    The starting guess ignores the b^2 term of the integrand and lands
+    just above the root. The length is concave and increasing in theta,
+    so Newton's method steps below the root once and then climbs to it
+    monotonically, usually within 2-5 steps.
+
+    Parameters:
+        a (float or array): The outer radius of the spiral
+        b (float or array): The decrease in radius per 1 radian of rotation
+        length (float or array): The desired length of the spiral
+        tol (float): Relative tolerance on theta
+        max_iterations (int): Upper limit of Newton steps
+
+    Returns:
+        theta (float or array): Radians giving the desired length,
+                                NaN where the length doesn't fit
+    '''
+    a, b, length = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in (a, b, length)))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # theta that results in 0 inner radius
+        max_theta = np.where(b == 0, np.inf, a / b)
+
+        # Solution of a*theta - b*theta^2/2 = length, which overestimates theta
+        theta = 2 * length / (a + np.sqrt(np.maximum(a**2 - 2*b*length, 0)))
+        theta = np.minimum(theta, max_theta)
+
+        for _ in range(max_iterations):
+            error = length_of_round_spiral(a, b, theta) - length
+            slope = np.sqrt((a - b*theta)**2 + b**2)
+            step = error / slope
+            theta = np.clip(theta - step, 0, max_theta)
+            if not np.any(np.abs(step) > tol * np.maximum(theta, 1)):
+                break
+
+        fits = length <= length_of_round_spiral(a, b, max_theta)
+        # b of 0 is a circle
+        theta = np.where(b == 0, length / a, np.where(fits, theta, np.nan))
+
+    return theta[()]
+
+
+def _theta_from_length_scalar(a, b, length, tol=1e-12, max_iterations=50):
+    '''
+    Same as theta_from_length() for plain floats with b > 0,
+    without the per-call overhead of NumPy.
+    '''
+    def length_at(theta):
+        u = a - b*theta
+        return (
+            a*math.hypot(a, b) - u*math.hypot(u, b) +
+            b**2 * (math.asinh(a/b) - math.asinh(u/b))
+        ) / (2*b)
+
+    max_theta = a / b
+    if length > length_at(max_theta):
+        return math.nan
+
+    theta = 2 * length / (a + math.sqrt(max(a**2 - 2*b*length, 0)))
+    theta = min(theta, max_theta)
+
+    for _ in range(max_iterations):
+        step = (length_at(theta) - length) / math.hypot(a - b*theta, b)
+        theta = min(max(theta - step, 0), max_theta)
+        if abs(step) <= tol * max(theta, 1):
+            break
+
+    return theta
 
 
 def spiral(
-    length, spacing, outer_radius=config.getfloat('OuterRadius')
+    length, spacing, outer_radius=None, tol=1e-12
 ) -> tuple:
     '''
     Returns the sum of coil areas of a circular archimedean spiral.
@@ -62,90 +151,145 @@ def spiral(
     Parameters:
         length (float): The length of the spiral's line
         spacing (float): The decrease in radius per 1 turn of rotation
-        outer_radius (float): The outer radius of the spiral
+        outer_radius (float): The outer radius of the spiral (OuterRadius by default)
+        tol (float): Relative tolerance on the spiral's angle
 
     Returns:
         num_of_coils (float): The number of coils in the spiral
         inner_radius (float): The inner radius of the spiral
         area_sum (float): The total area-sum of the spiral
     '''
+    if outer_radius is None:
+        outer_radius = default_constraints().outer_radius
+
     a = outer_radius
-    b = spacing  / (2 * math.pi)
+    b = spacing / (2 * math.pi)
 
     if b == 0:  # If b is 0 we have a perfect circle
         theta = length / a  # Circle arc length formula
     else:
-        # a/b gives theta that results in 0 inner radius
-        max_theta = a / b
+        # Find theta that gives a spiral of the desired length
+        theta = _theta_from_length_scalar(a, b, length, tol)
 
         # If user gives a longer length, that won't fit, so return NaN
-        if length > length_of_round_spiral(a, b, max_theta):
+        if math.isnan(theta):
             return math.nan, math.nan, math.nan
 
-        # Use math to find theta that gives a spiral of the desired length
-        theta = optimize.brentq(
-            lambda t: length_of_round_spiral(a, b, t) - length, 0, max_theta)
-
     # Calculate and return other properties from theta
+    num_of_coils = theta / (2 * math.pi)
+    inner_radius = a - b*theta
+    area_sum = float(area_sum_of_round_spiral(a, b, theta)) * 1e-6
+
+    return area_sum, inner_radius, num_of_coils
+
+
+def spiral_vectorized(
+    length, spacing, outer_radius=None, tol=1e-12
+) -> tuple:
+    '''
+    Version of spiral() that accepts NumPy arrays.
+
+    Parameters:
+        length (float or array): The length of the spiral's line
+        spacing (float or array): The decrease in radius per 1 turn of rotation
+        outer_radius (float or array): The outer radius of the spiral (OuterRadius by default)
+        tol (float): Relative tolerance on the spiral's angle
+
+    Returns (arrays broadcast from the inputs, NaN where the spiral doesn't fit):
+        area_sum (array): The total area-sum of the spiral
+        inner_radius (array): The inner radius of the spiral
+        num_of_coils (array): The number of coils in the spiral
+    '''
+    if outer_radius is None:
+        outer_radius = default_constraints().outer_radius
+
+    a = np.asarray(outer_radius, dtype=float)
+    b = np.asarray(spacing, dtype=float) / (2 * math.pi)
+
+    theta = theta_from_length(a, b, length, tol)
+
     num_of_coils = theta / (2 * math.pi)
     inner_radius = a - b*theta
     area_sum = area_sum_of_round_spiral(a, b, theta) * 1e-6
 
     return area_sum, inner_radius, num_of_coils
 
-# Returns max trace length physically possible.
-# Takes outer radius and a function that defines spacing
-def max_trace_length(resistance, outer_layer):
+
+@instrument()
+def max_trace_length(resistance, outer_layer, constraints: Constraints = None,
+                     tol=None, max_iterations=50):
     '''
     Calculates the maximum length of wire that can fit on the spiral.
 
-    Uses binary search and finds highest length that doesn't receive NaN
-    from spirals.properties_of_square_spiral().
+    The spacing grows linearly with length, so the maximum length is where
+    a spiral that ends exactly at the center has the length that gives
+    its spacing. That is solved with Newton's method, starting from the
+    approximation that the full spiral is pi * r^2 / spacing long.
 
     Paramters:
-        resistance (float - ohms): The intended resistance of the spiral.
+        resistance (float or array - ohms): The intended resistance of the spiral.
         outer_layer (bool): States whether spiral is on outer layer of the PCB
                             since that influences trace thickness
+        constraints (Constraints): config.ini by default
+        tol (float): Relative tolerance on the length (by default from the constraints' precision)
 
     Returns:
-        max_length (float - mm): Maximum length of wire that can fit on the spiral.
+        max_length (float or array - mm): Maximum length of wire that can fit on the spiral.
 
     '''
-    lower = 0
-    upper = 1e6 # TODO: Algorithmatize this hard coded value
+    constraints = constraints or default_constraints()
+    tol = tol or constraints.tolerances.max_length_rtol
+    a = constraints.outer_radius
+    resistance = np.asarray(resistance, dtype=float)
 
-    while upper - lower > upper*0.001:
+    gap = spacing_from_length(0, resistance, outer_layer, constraints)
+    k = spacing_from_length(1, resistance, outer_layer, constraints) - gap
 
-        length_guess = (upper + lower)/2
-        s = spacing_from_length(length_guess, resistance, outer_layer)
+    length = (-gap + np.sqrt(gap**2 + 4*k*math.pi*a**2)) / (2*k)
 
-        if math.isnan(spiral(length_guess, s)[0]):
-            upper = length_guess
-        else:
-            lower = length_guess
+    for iteration in range(1, max_iterations + 1):
+        b = (k*length + gap) / (2 * math.pi)
+        root = np.sqrt(a**2 + b**2)
+        full_length = (a*root + b**2 * np.arcsinh(a/b)) / (2*b)
+        # Derivative of full_length with respect to b
+        slope = 0.5*np.arcsinh(a/b) - a*root / (2*b**2)
 
-    max_length = lower
+        step = (length - full_length) / (1 - slope * k / (2 * math.pi))
+        length = length - step
+        if not np.any(np.abs(step) > tol * length):
+            break
 
-    return max_length
+    count(iteration * length.size, iteration)
+    return length[()]
 
-def spiral_of_resistance(resistance, outer_layer):
+
+@memoize(SPIRAL_FIELDS)
+@instrument()
+def spiral_of_resistance(resistance, outer_layer, constraints: Constraints = None):
+    from scipy import optimize
+
+    constraints = constraints or default_constraints()
+    tolerances = constraints.tolerances
 
     # Dummy function to meet requirements of `optimize.minimize_scalar`
     def neg_area_sum_from_length(length):
-        s = spacing_from_length(length, resistance, outer_layer)
-        return -spiral(length, s)[0]
+        s = spacing_from_length(length, resistance, outer_layer, constraints)
+        return -spiral(length, s, constraints.outer_radius, tolerances.theta_rtol)[0]
 
-    max_length = max_trace_length(resistance, outer_layer)
+    max_length = max_trace_length(resistance, outer_layer, constraints)
     # Finds length that gives maximum area-sum
-    length = optimize.minimize_scalar(
+    result = optimize.minimize_scalar(
         neg_area_sum_from_length,
         bounds=(0, max_length),
-        method='bounded'
-    ).x
+        method='bounded',
+        options={'xatol': tolerances.length_xatol}
+    )
+    count(result.nfev, result.nit)
+    length = result.x
 
     # Calculate data from the optimal length
-    spacing = spacing_from_length(length, resistance, outer_layer)
-    optimal = spiral(length, spacing)
+    spacing = spacing_from_length(length, resistance, outer_layer, constraints)
+    optimal = spiral(length, spacing, constraints.outer_radius, tolerances.theta_rtol)
 
     # Return coil spacing, number of coils, and area-sum
     return *optimal, spacing, length
@@ -169,5 +313,50 @@ class TestRoundSpiral(unittest.TestCase):
         # self-calculated.
         self.assertAlmostEqual(result[2], 1.74325347739317)
 
+    # Closed forms against numerical integration
+
+    def test_closed_forms(self):
+        from scipy import integrate
+        a, b, theta = 10, 0.3, 25
+        length = integrate.quad(
+            lambda t: math.sqrt((a - b*t)**2 + b**2), 0, theta)[0]
+        area = integrate.quad(lambda t: 0.5*(a - b*t)**2, 0, theta)[0]
+        self.assertAlmostEqual(length_of_round_spiral(a, b, theta), length)
+        self.assertAlmostEqual(area_sum_of_round_spiral(a, b, theta), area)
+
+    def test_vectorized_inverse(self):
+        a = 40
+        b = np.array([0, 0.01, 0.05, 0.1, 0.5])
+        theta = np.array([3, 100, 700, 399, 79.9])
+        length = length_of_round_spiral(a, b, theta)
+        np.testing.assert_allclose(theta_from_length(a, b, length), theta)
+
+        # Too long to fit
+        self.assertTrue(math.isnan(spiral(1e6, 1, 10)[0]))
+
+    # Looser presets only cost a little area-sum
+
+    def test_precision_presets(self):
+        c = default_constraints()
+        signoff = spiral_of_resistance.uncached(20, True, c.replace(precision="signoff"))
+        for precision, rtol in [("draft", 1e-6), ("standard", 1e-12)]:
+            result = spiral_of_resistance.uncached(20, True, c.replace(precision=precision))
+            self.assertLessEqual(result[0], signoff[0] * (1 + 1e-12))
+            self.assertGreaterEqual(result[0], signoff[0] * (1 - rtol))
+
+        with self.assertRaises(ValueError):
+            c.replace(precision="exact")
+
+    # Anything longer than the maximum length must not fit
+
+    def test_max_trace_length(self):
+        for resistance in [0.5, 3, 20, 100, 1000]:
+            for outer_layer in [True, False]:
+                max_length = max_trace_length(resistance, outer_layer)
+                for factor, fits in [(1 - 1e-9, True), (1 + 1e-9, False)]:
+                    length = max_length * factor
+                    s = spacing_from_length(length, resistance, outer_layer)
+                    self.assertEqual(not math.isnan(spiral(length, s)[0]), fits)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
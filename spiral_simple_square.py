@@ -1,22 +1,18 @@
 import math
+import numpy as np
 from pathlib import Path
-from configparser import ConfigParser
 import unittest
 from helper_conversions import *
-from scipy import optimize
+from helper_cache import memoize, SPIRAL_FIELDS
+from helper_instrumentation import instrument, count
 
 '''
 Functions that define a constant trace width square spiral
 '''
 
-# Read configuration
-config = ConfigParser()
-config.read(Path(__file__).with_name('config.ini'))
-config = config['Configuration']
-
 
 def spiral(
-    length, spacing, outer_radius=config.getfloat('OuterRadius')
+    length, spacing, outer_radius=None
 ) -> tuple:
     '''
     Returns the sum of coil areas of a square archimedean spiral.
@@ -25,13 +21,16 @@ def spiral(
     Parameters:
         length (float): The length of the spiral's line
         spacing (float): The decrease in radius per 1 turn of rotation
-        outer_radius (float): The outer radius of the spiral
+        outer_radius (float): The outer radius of the spiral (OuterRadius by default)
 
     Returns:
         num_of_coils (float): The number of coils in the spiral
         inner_radius (float): The inner radius of the spiral
         area_sum (float): The total area-sum of the spiral
     '''
+    if outer_radius is None:
+        outer_radius = default_constraints().outer_radius
+
     r = outer_radius
     area_sum = -0.5 * spacing * r
     length += spacing
@@ -53,47 +52,128 @@ def spiral(
     return area_sum * 1e-6, inner_radius, num_of_coils
 
 
-def max_trace_length(resistance, outer_layer):
+def spiral_vectorized(
+    length, spacing, outer_radius=None
+) -> tuple:
+    '''
+    Closed-form version of spiral() that accepts NumPy arrays.
+    The coil count comes from solving the arithmetic series of coil
+    perimeters, and the area-sum from the series sums of coil radii,
+    so whole sweeps are evaluated as single array operations.
+
+    Parameters:
+        length (float or array): The length of the spiral's line
+        spacing (float or array): The decrease in radius per 1 turn of rotation
+        outer_radius (float or array): The outer radius of the spiral (OuterRadius by default)
+
+    Returns (arrays broadcast from the inputs, NaN where the spiral doesn't fit):
+        area_sum (array): The total area-sum of the spiral
+        inner_radius (array): The inner radius of the spiral
+        num_of_coils (array): The number of coils in the spiral
+    '''
+    length = np.asarray(length, dtype=float)
+    s = np.asarray(spacing, dtype=float)
+    if outer_radius is None:
+        outer_radius = default_constraints().outer_radius
+
+    r = np.asarray(outer_radius, dtype=float)
+
+    # Coil k (counting from 0) has radius r - k*s and uses 8*(r - k*s) of
+    # trace, so n coils use 8*(n*r - s*n*(n-1)/2). The spiral has the
+    # smallest n for which that covers length + s.
+    needed = length + s
+
+    def used(n):
+        return 8 * (n * r - 0.5 * s * n * (n - 1))
+
+    # Smaller root of 4*s*n^2 - (8*r + 4*s)*n + needed = 0,
+    # in a form that stays stable when s is 0
+    b = 8 * r + 4 * s
+    with np.errstate(invalid='ignore', divide='ignore'):
+        disc = np.sqrt(b ** 2 - 16 * s * needed)
+        n = np.ceil(2 * needed / (b + disc))
+    n = np.maximum(n, 0)
+
+    # Correct for rounding of the root right at a coil boundary
+    n = np.where((n > 0) & (used(n - 1) >= needed), n - 1, n)
+    n = np.where(used(n) < needed, n + 1, n)
+
+    # Series sums over the coil radii r_k = r - k*s, k = 0..n-1
+    sum_r = n * r - 0.5 * s * n * (n - 1)
+    sum_r2 = n * r ** 2 - r * s * n * (n - 1) + s ** 2 * (n - 1) * n * (2 * n - 1) / 6
+
+    inner_radius = r - (n - 1) * s
+    leftover = needed - 8 * sum_r
+    area_sum = -0.5 * s * r + 4 * sum_r2 + 0.5 * leftover * inner_radius
+
+    # Doesn't fit if the last coil would need a negative radius
+    fits = ~np.isnan(disc) & (r - n * s >= 0)
+    area_sum = np.where(fits, area_sum * 1e-6, np.nan)
+    inner_radius = np.where(fits, inner_radius, np.nan)
+    num_of_coils = np.where(fits, n, np.nan)
+
+    return area_sum, inner_radius, num_of_coils
+
+
+@instrument()
+def max_trace_length(resistance, outer_layer, constraints: Constraints = None):
     '''
     Calculates the maximum length of wire that can fit on the spiral.
 
-    Uses binary search and finds highest length that doesn't receive NaN
-    from spirals.properties_of_square_spiral().
+    The spacing grows linearly with length, s = k*length + gap. A length
+    fits in n coils when the spiral doesn't run past the center (n*s <= r)
+    and the n coils are long enough to hold it
+    (length + s <= 8*(n*r - s*n*(n-1)/2)). Each condition gives a linear
+    bound on length for a given n, so the maximum length is the best
+    n's smaller bound. That happens next to the n where both bounds meet,
+    which solves a quadratic.
 
     Paramters:
-        resistance (float - ohms): The intended resistance of the spiral.
+        resistance (float or array - ohms): The intended resistance of the spiral.
         outer_layer (bool): States whether spiral is on outer layer of the PCB
                             since that influences trace thickness
+        constraints (Constraints): config.ini by default
 
     Returns:
-        max_length (float - mm): Maximum length of wire that can fit on the spiral.
+        max_length (float or array - mm): Maximum length of wire that can fit on the spiral.
 
     '''
-    lower = 0
-    upper = 1e8  # TODO: Algorithmatize this hard coded value
+    constraints = constraints or default_constraints()
+    r = constraints.outer_radius
+    resistance = np.asarray(resistance, dtype=float)
 
-    while upper - lower > upper*0.001:
+    gap = spacing_from_length(0, resistance, outer_layer, constraints)
+    k = spacing_from_length(1, resistance, outer_layer, constraints) - gap
 
-        length_guess = (upper + lower)/2
-        s = spacing_from_length(length_guess, resistance, outer_layer)
+    # Coil count where the spiral reaches the center exactly when full:
+    # s = r/n and length + s = 4*r*(n + 1)
+    b = 4*k*r + gap
+    n_cross = (-b + np.sqrt(b**2 + 16*k*r*(k*r + r))) / (8*k*r)
 
-        if math.isnan(spiral(length_guess, s)[0]):
-            upper = length_guess
-        else:
-            lower = length_guess
+    n = np.floor(n_cross)[..., np.newaxis] + np.arange(-1, 3)
+    n = np.maximum(n, 1)
+    k = k[..., np.newaxis]
+    gap = gap[..., np.newaxis]
+    c = 1 + 4*n*(n - 1)
 
-    max_length = lower
+    fits_in_coils = (8*n*r - gap*c) / (1 + k*c)
+    fits_in_radius = (r/n - gap) / k
 
-    return max_length
+    max_length = np.max(np.minimum(fits_in_coils, fits_in_radius), axis=-1)
+    count(evaluations=n.size)
+    return np.maximum(max_length, 0)[()]
 
 
-def spiral_of_resistance(resistance: float, outer_layer: bool):
+@memoize(SPIRAL_FIELDS)
+@instrument()
+def spiral_of_resistance(resistance: float, outer_layer: bool, constraints: Constraints = None):
     '''
     Calculates a single-layer spiral that maximizes area-sum given a specific resistance
 
     Parameters:
         resistance (float): the desired resistance (in ohms) of the spiral
         outer_layer (bool): whether the spiral is on an exterior layer
+        constraints (Constraints): config.ini by default
 
     Returns:
         num_of_coils (float): The number of coils in the spiral
@@ -103,27 +183,199 @@ def spiral_of_resistance(resistance: float, outer_layer: bool):
         length (float): The total length of the trace (in mm)
 
     '''
+    constraints = constraints or default_constraints()
+
+    length = float(spiral_of_resistance_vectorized(resistance, outer_layer, constraints)[4])
+
+    # Calculate data from the optimal length
+    spacing = spacing_from_length(length, resistance, outer_layer, constraints)
+    optimal = spiral(length, spacing, constraints.outer_radius)
+
+    return *optimal, spacing, length
+
+
+@instrument()
+def spiral_of_resistance_bounded(resistance: float, outer_layer: bool, constraints: Constraints = None):
+    '''
+    The original spiral_of_resistance(), which searches the trace length with
+    Brent's method. The area-sum isn't smooth in length, so it can settle on
+    a local optimum. Kept to compare against.
+
+    Returns:
+        area_sum, inner_radius, num_of_coils, spacing, length
+    '''
+    from scipy import optimize
+
+    constraints = constraints or default_constraints()
 
     # Dummy function to meet requirements of `optimize.minimize_scalar`
     def neg_area_sum_from_length(length):
-        s = spacing_from_length(length, resistance, outer_layer)
-        return -spiral(length, s)[0]
+        s = spacing_from_length(length, resistance, outer_layer, constraints)
+        return -spiral(length, s, constraints.outer_radius)[0]
 
-    max_length = max_trace_length(resistance, outer_layer)
+    max_length = max_trace_length(resistance, outer_layer, constraints)
     # Finds length that gives maximum area-sum
-    length = optimize.minimize_scalar(
+    result = optimize.minimize_scalar(
         neg_area_sum_from_length,
         bounds=(0, max_length),
-        method='bounded'
-    ).x
+        method='bounded',
+        options={'xatol': constraints.tolerances.length_xatol}
+    )
+    count(result.nfev, result.nit)
+    length = result.x
 
-    # Calculate data from the optimal length
-    spacing = spacing_from_length(length, resistance, outer_layer)
-    optimal = spiral(length, spacing)
+    spacing = spacing_from_length(length, resistance, outer_layer, constraints)
+    optimal = spiral(length, spacing, constraints.outer_radius)
 
     return *optimal, spacing, length
 
 
+@instrument()
+def spiral_of_resistance_vectorized(resistance, outer_layer: bool, constraints: Constraints = None):
+    '''
+    Version of spiral_of_resistance() that accepts an array of resistances.
+
+    Area-sum jumps whenever the spiral gains a coil, so it isn't smooth in
+    trace length. For a fixed coil count n it is, though: with s = k*L + gap
+    the area-sum (see area_sum_per_ohm()) is a quadratic in the length L.
+    The lengths that give n coils are an interval between the bounds used in
+    max_trace_length(), so every n is solved exactly by checking the ends of
+    its interval and the quadratic's vertex, and the best of all of them is
+    the global optimum.
+
+    Parameters:
+        resistance (float or array): the desired resistances (in ohms) of the spirals
+        outer_layer (bool): whether the spirals are on an exterior layer
+        constraints (Constraints): config.ini by default
+
+    Returns (arrays shaped like resistance):
+        area_sum, inner_radius, num_of_coils, spacing, length
+    '''
+    constraints = constraints or default_constraints()
+    r = constraints.outer_radius
+    resistance = np.asarray(resistance, dtype=float)
+    ohms = resistance.ravel()
+
+    # Solve in chunks of about a million candidate lengths
+    max_coils = r / spacing_from_length(0, np.max(ohms), outer_layer, constraints)
+    chunk = max(1, int(2**20 // (3 * max_coils)))
+    length = np.concatenate([
+        _optimal_length(ohms[i:i + chunk], outer_layer, constraints)
+        for i in range(0, max(len(ohms), 1), chunk)
+    ]).reshape(resistance.shape)
+    spacing = spacing_from_length(length, resistance, outer_layer, constraints)
+
+    return (*spiral_vectorized(length, spacing, r), spacing, length)
+
+
+def _optimal_length(ohms, outer_layer: bool, constraints: Constraints):
+    '''
+    Returns: The optimal trace length (in mm) of every resistance in the 1D array
+    '''
+    r = constraints.outer_radius
+    ohms = ohms[:, np.newaxis]
+    max_length = max_trace_length(ohms, outer_layer, constraints)
+
+    gap = spacing_from_length(0, ohms, outer_layer, constraints)
+    k = spacing_from_length(1, ohms, outer_layer, constraints) - gap
+
+    # Coil counts up to just past where both bounds of max_trace_length() meet
+    b = 4*k*r + gap
+    n_cross = (-b + np.sqrt(b**2 + 16*k*r*(k*r + r))) / (8*k*r)
+    n = np.arange(1, int(np.max(n_cross)) + 3)
+
+    def fits_in_coils(n):
+        c = 1 + 4*n*(n - 1)
+        return (8*n*r - gap*c) / (1 + k*c)
+
+    # Lengths that give n coils, in (lo, hi]
+    lo = np.where(n > 1, fits_in_coils(n - 1), 0)
+    hi = np.minimum(np.minimum(fits_in_coils(n), (r/n - gap) / k), max_length)
+
+    # Area-sum in mm^2 with n coils is a*L^2 + b*L + constant
+    q = n - 1
+    m = n * q
+    c = (2 / 3) * m * (2 * n - 1) - 0.5 * q * (1 + 4 * m)
+    a = -0.5 * q * k + c * k**2
+    b = 0.5 * r + 2 * r * m * k - 0.5 * q * gap + 2 * c * k * gap
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = np.where(a < 0, -b / (2 * a), hi)
+
+    # Stay just inside the interval so rounding can't change the coil count
+    nudge = 1e-12 * max_length
+    lo = lo + nudge
+    hi = hi - nudge
+    candidates = np.stack([lo, np.clip(vertex, lo, hi), hi], axis=-1)
+    candidates = np.where((lo <= hi)[..., np.newaxis], candidates, np.nan)
+    candidates = np.maximum(candidates.reshape(len(ohms), -1), 0)
+
+    # Evaluating the candidates exactly keeps the result a real spiral
+    spacing = spacing_from_length(candidates, ohms, outer_layer, constraints)
+    area_sum = spiral_vectorized(candidates, spacing, r)[0]
+    count(evaluations=area_sum.size)
+    best = np.argmax(np.where(np.isnan(area_sum), -np.inf, area_sum), axis=1)
+
+    return candidates[np.arange(len(best)), best]
+
+
+def area_sum_per_ohm(resistance, outer_layer: bool, constraints: Constraints = None, optimal=None):
+    '''
+    Derivative of the optimal spiral's area-sum with respect to resistance.
+
+    The spacing is s = k*L + gap, where k is inversely proportional to
+    resistance. With n coils, area-sum in mm^2 is
+    0.5*r*L + 2*r*n*(n-1)*s - 0.5*(n-1)*L*s + c*s^2
+    where c = (2/3)*n*(n-1)*(2n-1) - 0.5*(n-1)*(1 + 4*n*(n-1)).
+    When the optimal length is the quadratic's vertex, only the change in
+    spacing matters to first order. When it's at an end of the lengths
+    that give n coils (see _optimal_length()), the length follows that end
+    as k changes, which adds its change in area-sum too.
+
+    Parameters:
+        resistance (float or array): the resistances (in ohms) of the spirals
+        outer_layer (bool): whether the spirals are on an exterior layer
+        constraints (Constraints): config.ini by default
+        optimal (tuple): spiral_of_resistance_vectorized() result, if already known
+
+    Returns:
+        d_area_sum (float or array): m^2 of area-sum gained per ohm
+    '''
+    constraints = constraints or default_constraints()
+    if optimal is None:
+        optimal = spiral_of_resistance_vectorized(resistance, outer_layer, constraints)
+
+    _, _, n, s, length = optimal
+    r = constraints.outer_radius
+    gap = constraints.gap_between_traces
+    k = (s - gap) / length
+
+    m = n * (n - 1)
+    c = (2 / 3) * m * (2 * n - 1) - 0.5 * (n - 1) * (1 + 4 * m)
+    d_area_d_spacing = 2 * r * m - 0.5 * (n - 1) * length + 2 * c * s
+    d_area_d_length = 0.5 * r - 0.5 * (n - 1) * s
+
+    # The ends of the lengths that give n coils, and their derivatives by k
+    def fits_in_coils(n):
+        c = 1 + 4*n*(n - 1)
+        fits = (8*n*r - gap*c) / (1 + k*c)
+        return fits, -fits * c / (1 + k*c)
+
+    fits_in_radius = (r/n - gap) / k
+    ends, d_ends_d_k = np.broadcast_arrays(*zip(
+        fits_in_coils(n - 1), fits_in_coils(n), (fits_in_radius, -fits_in_radius / k)))
+    ends, d_ends_d_k = np.stack(ends), np.stack(d_ends_d_k)
+
+    # Lengths at an end follow it, while the vertex doesn't move to first order
+    nearest = np.argmin(np.abs(ends - length), axis=0)[np.newaxis]
+    end = np.take_along_axis(ends, nearest, axis=0)[0]
+    d_length_d_k = np.where(np.abs(end - length) <= 1e-9 * length,
+                            np.take_along_axis(d_ends_d_k, nearest, axis=0)[0], 0)
+
+    # d(area)/dk with s = k*L + gap, and dk/d(ohms) = -k / resistance
+    d_area_d_k = d_area_d_spacing * (length + k * d_length_d_k) + d_area_d_length * d_length_d_k
+    return (d_area_d_k * -k / resistance * 1e-6)[()]
+
+
 class TestSquareSpiral(unittest.TestCase):
 
     # Square with 2 coils.
@@ -142,6 +394,70 @@ class TestSquareSpiral(unittest.TestCase):
         self.assertAlmostEqual(result[1], 2)
         self.assertAlmostEqual(result[2], 1)
 
+    # The closed form must agree with the coil-by-coil walk
+
+    def test_vectorized_matches_spiral(self):
+        rng = np.random.default_rng(0)
+        lengths = rng.uniform(0, 20000, 500)
+        spacings = rng.uniform(0.05, 2, 500)
+        result = spiral_vectorized(lengths, spacings, 40)
+
+        for i in range(len(lengths)):
+            expected = spiral(lengths[i], spacings[i], 40)
+            if math.isnan(expected[0]):
+                self.assertTrue(math.isnan(result[0][i]))
+                continue
+            self.assertAlmostEqual(result[0][i], expected[0], places=9)
+            self.assertAlmostEqual(result[1][i], expected[1], places=9)
+            self.assertEqual(result[2][i], expected[2])
+
+    def test_vectorized_examples(self):
+        result = spiral_vectorized([16, 4], [0, 1], [1, 2])
+        np.testing.assert_allclose(result[0], [8 * 1e-6, 4 * 1e-6])
+        np.testing.assert_allclose(result[1], [1, 2])
+        np.testing.assert_allclose(result[2], [2, 1])
+
+    # Anything longer than the maximum length must not fit
+
+    def test_max_trace_length(self):
+        for resistance in [0.5, 3, 20, 100, 1000]:
+            for outer_layer in [True, False]:
+                max_length = max_trace_length(resistance, outer_layer)
+                for factor, fits in [(1 - 1e-9, True), (1 + 1e-9, False)]:
+                    length = max_length * factor
+                    s = spacing_from_length(length, resistance, outer_layer)
+                    self.assertEqual(not math.isnan(spiral(length, s)[0]), fits)
+
+    # The exact optimum can't be beaten by Brent or by a dense grid of lengths
+
+    def test_spiral_of_resistance_is_global(self):
+        c = default_constraints()
+        for resistance in [0.13, 3, 20, 100]:
+            for outer_layer in [True, False]:
+                best = spiral_of_resistance.uncached(resistance, outer_layer, c)[0]
+                brent = spiral_of_resistance_bounded(resistance, outer_layer, c)[0]
+                self.assertGreaterEqual(best, brent * (1 - 1e-12))
+
+                length = np.linspace(0, max_trace_length(resistance, outer_layer, c), 100000)
+                s = spacing_from_length(length, resistance, outer_layer, c)
+                grid = np.nanmax(spiral_vectorized(length, s, c.outer_radius)[0])
+                self.assertGreaterEqual(best, grid * (1 - 1e-12))
+
+    # The marginal gain matches finite differences, also when the optimal
+    # length is at an end of its coil count's lengths, or the spiral has 1 coil
+
+    def test_area_sum_per_ohm(self):
+        c = default_constraints()
+        resistance = np.geomspace(1e-3, 300, 500)
+        gain = area_sum_per_ohm(resistance, True, c)
+        area_sum = [spiral_of_resistance_vectorized(resistance * (1 + h), True, c)[0]
+                    for h in (-1e-7, 0, 1e-7)]
+        # One-sided, since the gain jumps where the best coil count changes
+        below = (area_sum[1] - area_sum[0]) / (1e-7 * resistance)
+        above = (area_sum[2] - area_sum[1]) / (1e-7 * resistance)
+        error = np.minimum(np.abs(gain / below - 1), np.abs(gain / above - 1))
+        self.assertLess(np.max(error), 1e-5)
+        self.assertTrue(np.all(gain > 0))
 
 if __name__ == "__main__":
     unittest.main()
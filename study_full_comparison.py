@@ -29,8 +29,8 @@ if __name__ == "__main__":
         spiral_simple_circle.spiral_of_resistance, "Constant-trace-width circle")
     get_data(
         spiral_simple_square.spiral_of_resistance, "Constant-trace-width square")
-    get_data(
-        spiral_dynamic_square.spiral_of_resistance, "Variable-trace-width square")
+    ax.plot(ohms_list, spiral_dynamic_square.spiral_of_resistance_vectorized(ohms_list, True)[0],
+            '-o', label="Variable-trace-width square")
     #get_data(
     #    spiral_dynamic_square.spiral_of_resistance, "Dynamic Square Simple Radius", spiral_dynamic_square.radius_proportional)
     #get_data(
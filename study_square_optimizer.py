@@ -0,0 +1,31 @@
+from spiral_simple_square import *
+from benchmark import CASES
+import numpy as np
+
+'''
+EXPERIMENTAL
+Reports how much area-sum the bounded Brent search of trace length
+(spiral_of_resistance_bounded) misses against the exact per-coil-count
+optimizer, on the benchmark configurations
+'''
+
+if __name__ == "__main__":
+
+    base = Constraints.from_config()
+    ohms_list = np.exp(np.linspace(np.log(0.1), np.log(1000), 500))
+
+    for case, changes in CASES.items():
+        constraints = base.replace(**changes)
+        for outer_layer in [True, False]:
+            exact = spiral_of_resistance_vectorized(ohms_list, outer_layer, constraints)[0]
+            brent = np.array([
+                spiral_of_resistance_bounded(ohms, outer_layer, constraints)[0]
+                for ohms in ohms_list
+            ])
+
+            missed = 1 - brent / exact
+            worst = np.argmax(missed)
+            layer = "exterior" if outer_layer else "interior"
+            print(f"{case} ({layer} layers): Brent misses {np.median(missed):.2e} "
+                  f"(median), {missed[worst]:.2e} (worst, at {ohms_list[worst]:.3g} ohms); "
+                  f"{np.mean(missed > 1e-9) * 100:.1f}% of resistances miss by over 1e-9")
@@ -26,14 +26,10 @@ def get_data(trace_width):
         max_l = 450/trace_width
 
     lengths = np.linspace(0, max_l, 50)
-    areas_square = [
-        spiral_simple_square.spiral(l, trace_width, OUTER_RADIUS)[0]
-        for l in lengths
-    ]
-    areas_circle = [
-        spiral_simple_circle.spiral(l, trace_width, OUTER_RADIUS)[0]
-        for l in lengths
-    ]
+    areas_square = spiral_simple_square.spiral_vectorized(
+        lengths, trace_width, OUTER_RADIUS)[0]
+    areas_circle = spiral_simple_circle.spiral_vectorized(
+        lengths, trace_width, OUTER_RADIUS)[0]
     return max_l, lengths, areas_square, areas_circle
 
 
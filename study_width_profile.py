@@ -0,0 +1,40 @@
+import spiral_dynamic_square
+from helper_conversions import default_constraints
+import matplotlib.pyplot as plt
+import numpy as np
+
+'''
+EXPERIMENTAL
+Optimizes a piecewise linear trace width profile at a fixed resistance,
+and plots it against the real_radius_proportional width law
+'''
+
+OHMS = 10
+KNOTS = 8
+
+
+if __name__ == "__main__":
+
+    constraints = default_constraints()
+    law = spiral_dynamic_square.real_radius_proportional
+
+    profile, multiplier, best = spiral_dynamic_square.optimize_width_profile(
+        OHMS, True, KNOTS, constraints, workers=-1, seed=0)
+    law_multiplier = spiral_dynamic_square.trace_width_multiplier(OHMS, True, law, constraints)
+    reference = spiral_dynamic_square.spiral_of_resistance(OHMS, True, law, constraints=constraints)
+
+    print(f"Optimized profile: {best[0]:.6f} m^2 with {best[2]:d} coils")
+    print(f"real_radius_proportional: {reference[0]:.6f} m^2 with {reference[2]:d} coils")
+
+    # Plot trace width against radius for both
+    fig, ax = plt.subplots()
+    radius = np.linspace(spiral_dynamic_square.INNER_RADIUS, constraints.outer_radius, 200)
+    ax.plot(radius, profile(multiplier, radius), label="Optimized profile")
+    ax.plot(radius, law(law_multiplier, radius), label="real_radius_proportional")
+
+    ax.set_title(f"Trace width of a {OHMS} ohm exterior spiral")
+    ax.set_xlabel('Radius (mm)')
+    ax.set_ylabel('Trace width (mm)')
+    ax.legend()
+
+    plt.show()
@@ -0,0 +1,543 @@
+import argparse
+import base64
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from helper_conversions import Constraints
+from helper_precision import PRESETS
+import main
+
+'''
+Calculates the optimal magnetorquer over a grid of constraints,
+spread across every CPU core.
+
+Example:
+    python sweep.py --Resistance 20:200:10 --NumberOfLayers 4,6,8 --output sweep.csv
+
+Results are written in batches as they finish, to CSV or JSONL (by file
+extension). A checkpoint next to the output records the finished points,
+so an interrupted sweep continues where it stopped with --resume, as long
+as config.ini and the precision haven't changed.
+'''
+
+# Constraints that can be swept, and their types
+SWEEPABLE = {
+    "Resistance": float,
+    "NumberOfLayers": int,
+    "OuterRadius": float,
+    "GapBetweenTraces": float,
+    "OuterLayerThickness": float,
+    "InnerLayerThickness": float,
+}
+
+
+def parse_range(text: str, kind=float) -> list:
+    '''
+    Parses the values of one swept constraint.
+
+    Parameters:
+        text (str): "start:stop:count" for evenly spaced values,
+                    or a comma-separated list of values
+        kind (type): Type of the constraint's values
+
+    Returns:
+        - List of values
+    '''
+    if ":" in text:
+        start, stop, count = text.split(":")
+        values = np.linspace(float(start), float(stop), int(count))
+    else:
+        values = [float(v) for v in text.split(",")]
+
+    if kind is int:
+        return sorted(set(int(round(v)) for v in values))
+    return [float(v) for v in values]
+
+
+def grid_points(ranges: dict, skip=None):
+    '''
+    Yields every combination of the swept constraints as a dictionary,
+    numbered by its position in the grid under the "index" key.
+
+    Parameters:
+        ranges (dict): List of values per constraint name
+        skip (array): Boolean per grid index, True for points to leave out
+    '''
+    names = list(ranges)
+    for index, values in enumerate(itertools.product(*ranges.values())):
+        if skip is None or not skip[index]:
+            yield {"index": index, **dict(zip(names, values))}
+
+
+def grid_size(ranges: dict) -> int:
+    '''
+    Returns: Number of points in the grid of the swept constraints
+    '''
+    return math.prod(len(values) for values in ranges.values())
+
+
+# Result columns that hold text rather than numbers
+TEXT_COLUMNS = ("precision", "error")
+
+
+def columns(ranges: dict, base: Constraints) -> list:
+    '''
+    Returns: The names of the result columns of a sweep, the same for every
+             point. Stackups with LayerThicknesses get one column per layer
+             of every "layer_" property, numbered from the front
+    '''
+    names = ["index", *ranges, "total_area_sum"]
+    if base.layer_thicknesses is not None:
+        names.append("precision")
+        for name in ("ohms", *main.SPIRAL_PROPERTIES):
+            names += [f"layer_{name}_{i}" for i in range(len(base.layer_thicknesses))]
+    else:
+        names += ["evaluations", "precision"]
+        for prefix in ("ext_", "int_"):
+            names += [prefix + name for name in ("ohms", *main.SPIRAL_PROPERTIES)]
+    return names + ["error"]
+
+
+def flatten(row: dict) -> dict:
+    '''
+    Returns: The row with every list of layer properties split into
+             one value per layer, named like columns()
+    '''
+    flat = {}
+    for name, value in row.items():
+        if isinstance(value, list):
+            flat.update({f"{name}_{i}": x for i, x in enumerate(value)})
+        else:
+            flat[name] = value
+    return flat
+
+
+def evaluate_chunk(points: list, base: Constraints = None) -> list:
+    '''
+    Calculates the optimal design of every point in a worker process.
+
+    Parameters:
+        points (list): Constraint dictionaries
+        base (Constraints): Values of the constraints that aren't swept
+                            (config.ini by default)
+
+    Returns:
+        - A dictionary per point of its constraints and get_optimal_design() output.
+          Points that fail have an "error" instead of the output
+    '''
+    base = base or Constraints.from_config()
+
+    rows = []
+    for point in points:
+        changes = {k: v for k, v in point.items() if k != "index"}
+        try:
+            rows.append({**point, **main.get_optimal_design(base.replace(**changes))})
+        except Exception as e:
+            rows.append({**point, "error": f"{type(e).__name__}: {e}"})
+    return rows
+
+
+def chunks(iterable, size: int):
+    '''
+    Splits an iterable into lists of at most the given size.
+    '''
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def check_ranges(ranges: dict):
+    '''
+    Raises KeyError if a constraint can't be swept.
+    '''
+    for name in ranges:
+        if name not in SWEEPABLE:
+            raise KeyError(f"Can't sweep {name}")
+
+
+def iter_sweep(ranges: dict, workers: int = None, chunk_size: int = 64, skip=None,
+               base: Constraints = None):
+    '''
+    Calculates the optimal design at every combination of the swept
+    constraints, yielding each result as soon as its chunk finishes.
+    Only a few chunks per worker are queued at a time, so memory use
+    doesn't depend on the size of the grid.
+
+    Parameters:
+        ranges (dict): List of values per constraint name
+        workers (int): Number of worker processes (all CPU cores by default)
+        chunk_size (int): Number of points sent to a worker at a time
+        skip (array): Boolean per grid index, True for points already done
+        base (Constraints): Values of the constraints that aren't swept
+                            (config.ini by default)
+
+    Yields:
+        - A dictionary per point of its grid index, constraints,
+          and get_optimal_design() output, in order of completion
+    '''
+    check_ranges(ranges)
+    pending = chunks(grid_points(ranges, skip), chunk_size)
+
+    max_queued = 2 * (workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        while True:
+            for chunk in itertools.islice(pending, max_queued - len(running)):
+                running.add(executor.submit(evaluate_chunk, chunk, base))
+            if not running:
+                break
+
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield from future.result()
+
+
+def sweep(ranges: dict, workers: int = None, chunk_size: int = 64,
+          base: Constraints = None) -> dict:
+    '''
+    Calculates the optimal design at every combination of the swept
+    constraints. Constraints that aren't swept keep their config.ini values.
+
+    Parameters:
+        ranges (dict): List of values per constraint name
+        workers (int): Number of worker processes (all CPU cores by default)
+        chunk_size (int): Number of points sent to a worker at a time
+        base (Constraints): Values of the constraints that aren't swept
+                            (config.ini by default)
+
+    Returns:
+        - Result table as a dictionary of NumPy arrays, one per name in
+          columns(), sorted by grid index. Values a point doesn't have,
+          such as "int_" properties of 2 layers or the design of a point
+          that failed, are NaN ("" for text)
+    '''
+    base = base or Constraints.from_config()
+    names = columns(ranges, base)
+    rows = sorted((flatten(row) for row in iter_sweep(ranges, workers, chunk_size, base=base)),
+                  key=lambda row: row["index"])
+
+    table = {}
+    for name in names:
+        if name == "index" or name in ranges:
+            # Every point has these, with the type they're swept with
+            table[name] = np.array([row[name] for row in rows])
+        elif name in TEXT_COLUMNS:
+            table[name] = np.array([row.get(name, "") for row in rows], dtype=str)
+        else:
+            table[name] = np.array([row.get(name, np.nan) for row in rows], dtype=float)
+    return table
+
+
+def save_csv(table: dict, file):
+    '''
+    Writes a result table from sweep() as CSV to a path or file object,
+    with empty cells for missing (NaN) values.
+    '''
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "w", newline="") as f:
+            return save_csv(table, f)
+
+    def cells(column):
+        if column.dtype.kind == "f":
+            return ["" if math.isnan(x) else x for x in column.tolist()]
+        return column.tolist()
+
+    writer = csv.writer(file)
+    writer.writerow(table.keys())
+    writer.writerows(zip(*(cells(column) for column in table.values())))
+
+
+def checkpoint_path(output) -> str:
+    '''
+    Returns: Path of the checkpoint file kept next to the output file
+    '''
+    return os.fspath(output) + ".checkpoint"
+
+
+def checkpoint_constraints(base: Constraints) -> list:
+    '''
+    Returns: The values of the constraints, as they're stored in a checkpoint
+    '''
+    return json.loads(json.dumps(base.key()))
+
+
+def load_checkpoint(output, ranges: dict, base: Constraints):
+    '''
+    Reads the checkpoint of an interrupted sweep into the same output.
+    Results written after the last checkpoint are cut off the output,
+    since their points will be calculated again.
+
+    Returns:
+        - Boolean per grid index, True for points already done
+
+    Raises:
+        ValueError: The checkpoint belongs to a sweep over other ranges
+                    or with other constraints that aren't swept
+    '''
+    with open(checkpoint_path(output)) as f:
+        checkpoint = json.load(f)
+
+    if checkpoint["ranges"] != ranges:
+        raise ValueError("The checkpoint belongs to a sweep over different ranges")
+    if checkpoint.get("base") != checkpoint_constraints(base):
+        raise ValueError("The checkpoint belongs to a sweep with different constraints "
+                         "or precision, start it again without --resume")
+
+    with open(output, "r+b") as f:
+        f.truncate(checkpoint["output_bytes"])
+
+    packed = np.frombuffer(base64.b64decode(checkpoint["done"]), dtype=np.uint8)
+    return np.unpackbits(packed, count=grid_size(ranges)).astype(bool)
+
+
+def save_checkpoint(output, ranges: dict, base: Constraints, done, output_bytes: int):
+    '''
+    Atomically records which points are done and how much of the output is valid.
+    '''
+    checkpoint = {
+        "ranges": ranges,
+        "base": checkpoint_constraints(base),
+        "output_bytes": output_bytes,
+        "done": base64.b64encode(np.packbits(done)).decode(),
+    }
+    path = checkpoint_path(output)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+def run_sweep(ranges: dict, output, workers: int = None, chunk_size: int = 64,
+              batch_size: int = 1000, resume: bool = False, base: Constraints = None) -> int:
+    '''
+    Streams a sweep into a CSV or JSONL file (chosen by extension), written
+    in batches of results. After each batch the file is flushed to disk and
+    the checkpoint is updated. The checkpoint is removed once the sweep is done.
+
+    Parameters:
+        ranges (dict): List of values per constraint name
+        output (str): Path of the .csv or .jsonl output file
+        workers (int): Number of worker processes (all CPU cores by default)
+        chunk_size (int): Number of points sent to a worker at a time
+        batch_size (int): Number of results written per batch
+        resume (bool): Continue an interrupted sweep into the same output
+        base (Constraints): Values of the constraints that aren't swept
+                            (config.ini by default)
+
+    Returns:
+        - Number of points calculated by this run
+
+    Raises:
+        FileNotFoundError: Resuming into an output that has no checkpoint
+    '''
+    check_ranges(ranges)
+    jsonl = os.fspath(output).endswith(".jsonl")
+    base = base or Constraints.from_config()
+
+    if resume and os.path.exists(checkpoint_path(output)):
+        done = load_checkpoint(output, ranges, base)
+    elif resume and os.path.exists(output):
+        raise FileNotFoundError(f"{output} has no checkpoint to resume from, "
+                                "start it again without --resume")
+    else:
+        done = np.zeros(grid_size(ranges), dtype=bool)
+        open(output, "w").close()
+
+    calculated = 0
+    with open(output, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns(ranges, base), restval="")
+        if not jsonl and f.tell() == 0:
+            writer.writeheader()
+        batch = []
+
+        def write_batch():
+            if jsonl:
+                f.writelines(json.dumps(row) + "\n" for row in batch)
+            else:
+                writer.writerows(flatten(row) for row in batch)
+            f.flush()
+            os.fsync(f.fileno())
+
+            done[[row["index"] for row in batch]] = True
+            save_checkpoint(output, ranges, base, done, f.tell())
+            batch.clear()
+
+        for row in iter_sweep(ranges, workers, chunk_size, skip=done, base=base):
+            batch.append(row)
+            calculated += 1
+            if len(batch) >= batch_size:
+                write_batch()
+        if batch:
+            write_batch()
+
+    os.remove(checkpoint_path(output))
+    return calculated
+
+
+class TestSweep(unittest.TestCase):
+
+    ranges = {"Resistance": [20.0, 30.0, 40.0, 50.0, 60.0], "NumberOfLayers": [4, 6]}
+
+    def read(self, output):
+        with open(output) as f:
+            return sorted((json.loads(line) for line in f), key=lambda row: row["index"])
+
+    def test_sweep(self):
+        base = Constraints.from_config().replace(precision="draft")
+        ranges = {"Resistance": [20.0, 50.0], "NumberOfLayers": [1, 2, 4]}
+        table = sweep(ranges, workers=1, base=base)
+
+        self.assertEqual(list(table), columns(ranges, base))
+        np.testing.assert_array_equal(table["index"], np.arange(6))
+        np.testing.assert_array_equal(table["NumberOfLayers"], [1, 2, 4] * 2)
+        for i in range(6):
+            point = {name: table[name][i].item() for name in ranges}
+            if point["NumberOfLayers"] == 1:
+                self.assertIn("ValueError", table["error"][i])
+                self.assertTrue(np.isnan(table["total_area_sum"][i]))
+                continue
+            design = main.get_optimal_design(base.replace(**point))
+            self.assertEqual(table["error"][i], "")
+            for name in columns(ranges, base)[3:-1]:
+                expected = design.get(name, np.nan)
+                if name == "precision":
+                    self.assertEqual(table[name][i], expected)
+                else:
+                    np.testing.assert_equal(table[name][i], expected)
+
+        # Empty cells where a point has no value
+        text = io.StringIO()
+        save_csv(table, text)
+        text.seek(0)
+        rows = list(csv.DictReader(text))
+        self.assertEqual(list(rows[0]), columns(ranges, base))
+        self.assertEqual([row["int_ohms"] == "" for row in rows], [True, True, False] * 2)
+        self.assertEqual([row["error"] != "" for row in rows], [True, False, False] * 2)
+        self.assertEqual(rows[0]["ext_area_sum"], "")
+        self.assertEqual(float(rows[5]["int_ohms"]), table["int_ohms"][5])
+        self.assertEqual(int(rows[5]["NumberOfLayers"]), 4)
+
+    def test_sweep_layer_thicknesses(self):
+        base = Constraints.from_config().replace(
+            precision="draft", NumberOfLayers=4, LayerThicknesses=(1, 0.5, 0.5, 1))
+        ranges = {"Resistance": [20.0, 50.0]}
+        table = sweep(ranges, workers=1, base=base)
+
+        self.assertIn("layer_ohms_3", table)
+        for i, resistance in enumerate(ranges["Resistance"]):
+            design = main.get_optimal_design(base.replace(Resistance=resistance))
+            self.assertEqual(table["total_area_sum"][i], design["total_area_sum"])
+            for layer, ohms in enumerate(design["layer_ohms"]):
+                self.assertEqual(table[f"layer_ohms_{layer}"][i], ohms)
+            self.assertEqual(table["layer_coils_0"][i], design["layer_coils"][0])
+
+    def test_resume(self):
+        base = Constraints.from_config().replace(precision="draft")
+        with tempfile.TemporaryDirectory() as directory:
+            expected = os.path.join(directory, "expected.jsonl")
+            self.assertEqual(run_sweep(self.ranges, expected, workers=1, base=base), 10)
+
+            # Interrupted after 7 results, so only the first 2 batches of 3 are kept
+            def interrupted(*args, real=iter_sweep, **kwargs):
+                rows = real(*args, **kwargs)
+                yield from itertools.islice(rows, 7)
+                rows.close()
+                raise KeyboardInterrupt
+
+            output = os.path.join(directory, "sweep.jsonl")
+            with unittest.mock.patch(f"{__name__}.iter_sweep", interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    run_sweep(self.ranges, output, workers=1, batch_size=3, base=base)
+            self.assertTrue(os.path.exists(checkpoint_path(output)))
+            with open(output, "a") as f:
+                f.write('{"index": 9, "partly written')
+
+            with self.assertRaises(ValueError):
+                run_sweep(self.ranges, output, workers=1, resume=True,
+                          base=base.replace(precision="standard"))
+            with self.assertRaises(ValueError):
+                run_sweep(self.ranges, output, workers=1, resume=True, base=base.replace(OuterRadius=30))
+
+            self.assertEqual(run_sweep(self.ranges, output, workers=1, resume=True, base=base), 4)
+            self.assertFalse(os.path.exists(checkpoint_path(output)))
+            self.assertEqual(self.read(output), self.read(expected))
+
+    def test_killed(self):
+        # A sweep of 2 and 4 layers to CSV, killed partway through and resumed
+        arguments = ["--Resistance", "20:200:40", "--NumberOfLayers", "2,4", "--precision", "draft"]
+        ranges = {"Resistance": parse_range("20:200:40"), "NumberOfLayers": parse_range("2,4", int)}
+        base = Constraints.from_config().replace(precision="draft")
+
+        with tempfile.TemporaryDirectory() as directory:
+            expected = os.path.join(directory, "expected.csv")
+            run_sweep(ranges, expected, workers=1, base=base)
+
+            output = os.path.join(directory, "sweep.csv")
+            command = [sys.executable, __file__, *arguments, "--output", output,
+                       "--workers", "1", "--batch-size", "4"]
+            process = subprocess.Popen(command, start_new_session=True)
+            while not os.path.exists(checkpoint_path(output)) and process.poll() is None:
+                time.sleep(0.01)
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            self.assertTrue(os.path.exists(checkpoint_path(output)))
+
+            # Resuming without the checkpoint would overwrite the results
+            with self.assertRaises(FileNotFoundError):
+                run_sweep(ranges, expected, workers=1, resume=True, base=base)
+
+            subprocess.run([*command, "--resume"], check=True)
+            self.assertFalse(os.path.exists(checkpoint_path(output)))
+            with open(expected) as f, open(output) as g:
+                expected_lines, lines = f.read().splitlines(), g.read().splitlines()
+            self.assertEqual(lines[0], expected_lines[0])
+            self.assertEqual(sorted(lines[1:]), sorted(expected_lines[1:]))
+            self.assertEqual(len(lines), 81)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    for name, kind in SWEEPABLE.items():
+        parser.add_argument(f"--{name}", metavar="RANGE",
+                            help="start:stop:count or comma-separated values")
+    parser.add_argument("--workers", type=int, help="Number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=64,
+                        help="Number of points sent to a worker at a time")
+    parser.add_argument("--output", default="-",
+                        help="CSV or JSONL file, or - for CSV on stdout")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="Number of results written to the output at a time")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted sweep into the same output")
+    parser.add_argument("--precision", choices=list(PRESETS),
+                        help="Solver tolerances, instead of the Precision of config.ini")
+    args = parser.parse_args()
+
+    base = Constraints.from_config()
+    if args.precision:
+        base = base.replace(precision=args.precision)
+
+    ranges = {
+        name: parse_range(getattr(args, name), kind)
+        for name, kind in SWEEPABLE.items() if getattr(args, name) is not None
+    }
+
+    if args.output == "-":
+        writer = csv.DictWriter(sys.stdout, fieldnames=columns(ranges, base), restval="")
+        writer.writeheader()
+        for row in iter_sweep(ranges, args.workers, args.chunk_size, base=base):
+            writer.writerow(flatten(row))
+    else:
+        run_sweep(ranges, args.output, args.workers, args.chunk_size,
+                  args.batch_size, args.resume, base)